@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+网卡级流量计量 (ACCOUNTING_MODE=interface)。
+
+默认的负载计量只统计应用层收到的字节 (HTTP 的 len(chunk)、种子的 total_payload_download)，
+TLS、HTTP 头、TCP 重传和 BitTorrent 协议开销都不计入，而运营商按线路上的实际流量计费。
+接口计量模式下由控制器定期读取网卡的内核计数 (/proc/net/dev)，把增量计入每日配额；
+工作进程不再逐块上报下载量、也不再申领配额租约 (见 shared_state._ControlPlane)。
+负载字节数改为在任务结束时按调度器的各来源统计汇总，与线路字节数并列报告。
+
+容器内的 /proc/net/dev 属于容器自己的网络命名空间，读到的就是本容器的流量；cgroup v2 不提供网络计数，
+需要统计其他网络命名空间时可将 ACCOUNTING_NET_DEV 指向 /proc/<pid>/net/dev。
+"""
+
+import os
+import time
+import logging
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# 接近配额上限时采样间隔的下限 (秒)
+MIN_SAMPLE_INTERVAL = 0.1
+
+
+def read_net_dev(path=None):
+    """解析 /proc/net/dev，返回 {网卡: (接收字节数, 发送字节数)}"""
+    counters = {}
+    with open(path or config.ACCOUNTING_NET_DEV) as f:
+        for line in f.readlines()[2:]:
+            name, _, fields = line.partition(':')
+            fields = fields.split()
+            if len(fields) >= 9:
+                counters[name.strip()] = (int(fields[0]), int(fields[8]))
+    return counters
+
+
+def default_interface(net_dev_path=None):
+    """默认路由所在的网卡 (读取与 net/dev 同目录的 route 文件)，找不到时返回 None"""
+    route_path = os.path.join(os.path.dirname(net_dev_path or config.ACCOUNTING_NET_DEV), 'route')
+    try:
+        with open(route_path) as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if len(fields) > 1 and fields[1] == '00000000':
+                    return fields[0]
+    except OSError:
+        pass
+    return None
+
+
+class InterfaceAccounting:
+    """
+    在控制器进程中定期采样网卡计数。
+
+    :param attribute: 为 True 时把增量计入共享状态的下载量 (接口计量模式)；
+                      为 False 时只采样，用于在负载计量模式下对比线路开销
+    """
+    def __init__(self, shared_state, interface=None, attribute=True, path=None, direction=None, interval=None):
+        self._shared_state = shared_state
+        self._path = path or config.ACCOUNTING_NET_DEV
+        self.interface = interface or config.ACCOUNTING_INTERFACE or default_interface(self._path)
+        if not self.interface:
+            raise ValueError("无法确定默认路由所在的网卡，请设置 ACCOUNTING_INTERFACE")
+        self._both = (direction or config.ACCOUNTING_DIRECTION) == 'both'
+        self._interval = config.ACCOUNTING_INTERVAL if interval is None else interval
+        self.attribute = attribute
+        # 首次读取失败 (例如网卡不存在) 时直接抛出，由调用方在启动时报告
+        self._last = self._read()
+        self._last_time = time.monotonic()
+        self._read_failed = False
+        self.rate = 0.0          # 最近一次采样区间的线路速率 (字节/秒)
+        self._wire = 0           # 自启动或最近一次重置以来的线路字节数
+        self._payload_base = 0.0
+
+    def _read(self):
+        counters = read_net_dev(self._path)
+        if self.interface not in counters:
+            raise ValueError(f"网卡 {self.interface} 不存在 (可用: {', '.join(sorted(counters))})")
+        rx, tx = counters[self.interface]
+        return rx + tx if self._both else rx
+
+    def sample(self, now=None):
+        """读取一次计数，计入自上次采样以来的增量，返回增量字节数"""
+        now = time.monotonic() if now is None else now
+        try:
+            value = self._read()
+        except (OSError, ValueError) as e:
+            if not self._read_failed:
+                logger.warning(f"读取网卡计数失败: {e}")
+                self._read_failed = True
+            return 0
+        self._read_failed = False
+        # 计数变小说明网卡被重建，计数从 0 重新开始
+        delta = value - self._last if value >= self._last else value
+        self._last = value
+        elapsed, self._last_time = now - self._last_time, now
+        if elapsed > 0:
+            self.rate = delta / elapsed
+        self._wire += delta
+        if delta and self.attribute:
+            self._shared_state.add_wire_bytes(delta)
+        return delta
+
+    def next_sample(self, remaining_bytes=None):
+        """
+        下一次采样的时间 (time.monotonic())。计入配额时按当前速率估算到达上限的时间，
+        距离上限越近采样越密，使超出量不超过约半个采样区间的流量。
+        """
+        interval = self._interval
+        if self.attribute and remaining_bytes is not None and self.rate > 0:
+            interval = min(interval, max(MIN_SAMPLE_INTERVAL, max(0.0, remaining_bytes) / self.rate / 2))
+        return self._last_time + interval
+
+    def reset(self, payload_total):
+        """启动和每日重置时调用，以调度器当前的各来源累计量之和作为负载字节数的基线"""
+        self._wire = 0
+        self._payload_base = payload_total
+
+    def info(self, payload_total):
+        """自启动或最近一次重置以来的线路字节数和负载字节数"""
+        payload = max(0.0, payload_total - self._payload_base)
+        return {
+            'mode': 'interface' if self.attribute else 'payload',
+            'interface': self.interface,
+            'wire_bytes': self._wire,
+            'payload_bytes': payload,
+            'overhead': (self._wire / payload - 1) if payload > 0 else None,
+        }
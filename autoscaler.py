@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+工作进程池与自动伸缩。
+
+- WorkerPool 按目标数量启动工作进程；缩容时通知多余的进程在完成当前任务后退出 (排空)，
+  超过 AUTOSCALE_DRAIN_TIMEOUT 仍未退出的进程才被强制终止。异常退出的进程按退避时间重新拉起。
+- Autoscaler 每隔 AUTOSCALE_INTERVAL 秒测量一次总吞吐量，按加性增、乘性减 (AIMD) 决定目标进程数：
+  新增的进程带来了足够的吞吐量就继续增加，否则按 AUTOSCALE_DECREASE 缩减；
+  全局速率上限已经跑满时，更多的进程只会争抢带宽，同样缩减。
+两者都只在控制器进程中使用。
+"""
+
+import time
+import logging
+import multiprocessing
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# 异常退出的工作进程第 n 次连续重启前等待 2^(n-1) 秒，不超过该值
+RESPAWN_BACKOFF_MAX = 60.0
+# 进程运行超过该时长 (秒) 后再退出，不再视为连续崩溃
+RESPAWN_RESET_AFTER = 60.0
+# 吞吐量达到全局速率上限的这个比例即视为已跑满
+RATE_SATURATION = 0.9
+
+
+class _Worker:
+    def __init__(self, process, stop_event):
+        self.process = process
+        self.stop_event = stop_event
+        self.started = time.monotonic()
+        self.drain_deadline = None
+
+
+class WorkerPool:
+    """
+    :param target: 工作进程的执行体，调用方式为 target(进程序号, *args, stop_event)；
+                   stop_event 被设置后应在当前任务结束时返回
+    :param args: 传给 target 的其余参数
+    :param scheduler: TaskScheduler，进程退出后释放其登记的活动任务
+    """
+    def __init__(self, target, args=(), scheduler=None, drain_timeout=None):
+        self._target = target
+        self._args = tuple(args)
+        self._scheduler = scheduler
+        self._drain_timeout = config.AUTOSCALE_DRAIN_TIMEOUT if drain_timeout is None else drain_timeout
+        self._workers = {}      # 进程序号 -> _Worker
+        self._draining = {}     # 正在排空的进程
+        self._respawn_at = {}   # 等待重启的进程序号 -> time.monotonic()
+        self._crashes = {}      # 进程序号 -> 连续崩溃次数
+
+    @property
+    def size(self):
+        """目标进程数：运行中的进程加上等待重启的进程，不含正在排空的进程"""
+        return len(self._workers) + len(self._respawn_at)
+
+    def _free_id(self):
+        # 进程序号同时是进程名和速度键，优先复用最小的空闲序号，共享状态中的槽位也随之复用
+        used = set(self._workers) | set(self._draining) | set(self._respawn_at)
+        process_id = 0
+        while process_id in used:
+            process_id += 1
+        return process_id
+
+    def _spawn(self, process_id):
+        stop_event = multiprocessing.Event()
+        p = multiprocessing.Process(
+            target=self._target,
+            args=(process_id,) + self._args + (stop_event,),
+            name=f"Worker-{process_id}"
+        )
+        p.start()
+        self._workers[process_id] = _Worker(p, stop_event)
+
+    def scale_to(self, count):
+        """启动或排空进程，使目标进程数等于 count"""
+        while self.size < count:
+            self._spawn(self._free_id())
+        while self.size > count:
+            if self._respawn_at:
+                # 先放弃等待重启的进程
+                del self._respawn_at[max(self._respawn_at)]
+                continue
+            process_id = max(self._workers)
+            worker = self._workers.pop(process_id)
+            worker.stop_event.set()
+            worker.drain_deadline = time.monotonic() + self._drain_timeout
+            self._draining[process_id] = worker
+            logger.info(f"工作进程-{process_id} 正在排空，完成当前任务后退出。")
+
+    def _reap(self, process_id, worker):
+        worker.process.join()
+        if self._scheduler is not None:
+            released = self._scheduler.release_process(worker.process.pid)
+            if released:
+                logger.debug(f"已释放工作进程-{process_id} 遗留的 {released} 个活动任务。")
+
+    def maintain(self):
+        """回收已退出的进程：异常退出的按退避时间重新拉起，排空超时的强制终止"""
+        now = time.monotonic()
+        for process_id, worker in list(self._workers.items()):
+            if worker.process.is_alive():
+                continue
+            del self._workers[process_id]
+            self._reap(process_id, worker)
+            if now - worker.started >= RESPAWN_RESET_AFTER:
+                self._crashes[process_id] = 0
+            crashes = self._crashes.get(process_id, 0) + 1
+            self._crashes[process_id] = crashes
+            delay = min(RESPAWN_BACKOFF_MAX, 2 ** (crashes - 1))
+            self._respawn_at[process_id] = now + delay
+            logger.warning(f"工作进程-{process_id} 已退出 (退出码 {worker.process.exitcode})，"
+                           f"将在 {delay:.0f} 秒后重新启动。")
+
+        for process_id, worker in list(self._draining.items()):
+            if worker.process.is_alive():
+                if now < worker.drain_deadline:
+                    continue
+                logger.warning(f"工作进程-{process_id} 排空超时，强制终止。")
+                worker.process.terminate()
+            else:
+                logger.info(f"工作进程-{process_id} 已排空退出。")
+            del self._draining[process_id]
+            self._reap(process_id, worker)
+
+        for process_id, respawn_at in list(self._respawn_at.items()):
+            if now >= respawn_at:
+                del self._respawn_at[process_id]
+                self._spawn(process_id)
+                logger.info(f"工作进程-{process_id} 已重新启动。")
+
+    def next_deadline(self):
+        """下一次需要调用 maintain() 的时间 (time.monotonic())，没有待处理事项时返回 None"""
+        deadlines = list(self._respawn_at.values())
+        deadlines += [worker.drain_deadline for worker in self._draining.values()]
+        return min(deadlines) if deadlines else None
+
+    def stop(self):
+        """立即终止所有进程 (程序退出时使用)"""
+        for process_id, worker in list(self._workers.items()) + list(self._draining.items()):
+            worker.process.terminate()
+            self._reap(process_id, worker)
+        self._workers.clear()
+        self._draining.clear()
+        self._respawn_at.clear()
+
+
+class Autoscaler:
+    """
+    按总吞吐量的边际增益调整工作进程数的 AIMD 控制器。
+
+    每个测量周期结束时与上一个周期比较：
+    - 进程数增加了：新增进程的边际吞吐量不低于原有进程平均吞吐量的 AUTOSCALE_MIN_GAIN 倍则继续增加，否则乘性缩减；
+    - 进程数减少了：吞吐量明显下降则立即加回，否则保持一个周期后再试探；
+    - 进程数不变：试探性地增加。
+    暂停、每日重置等使测量失真的情况下调用 invalidate() 丢弃当前周期。
+    """
+    def __init__(self, min_workers=None, max_workers=None, step=None, decrease=None, min_gain=None, interval=None):
+        self.min_workers = max(1, config.AUTOSCALE_MIN_WORKERS if min_workers is None else min_workers)
+        self.max_workers = max(self.min_workers, config.AUTOSCALE_MAX_WORKERS if max_workers is None else max_workers)
+        self._step = max(1, config.AUTOSCALE_STEP if step is None else step)
+        self._decrease = config.AUTOSCALE_DECREASE if decrease is None else decrease
+        self._min_gain = config.AUTOSCALE_MIN_GAIN if min_gain is None else min_gain
+        self._interval = config.AUTOSCALE_INTERVAL if interval is None else interval
+        self._sample = None     # 本周期开始时的 (时间, 下载量, 进程数)
+        self._previous = None   # 上一个周期的 (进程数, 吞吐量)
+
+    def clamp(self, count):
+        return min(self.max_workers, max(self.min_workers, count))
+
+    def invalidate(self):
+        self._sample = None
+        self._previous = None
+
+    def next_update(self):
+        """当前测量周期结束的时间 (time.monotonic())，尚未开始测量时返回 None"""
+        return self._sample[0] + self._interval if self._sample else None
+
+    def update(self, workers, total_bytes, rate_limit=0.0, now=None):
+        """
+        记录当前的下载量，测量周期结束时返回新的目标进程数，否则返回 workers 不变。
+
+        :param workers: 当前的目标进程数
+        :param total_bytes: SharedState.get_bytes() 的值
+        :param rate_limit: 当前的全局速率上限 (字节/秒)，0 表示不限速
+        """
+        now = time.monotonic() if now is None else now
+        if self._sample is None or self._sample[2] != workers:
+            # 首次测量，或进程数在周期中途被改变，重新开始测量
+            self._sample = (now, total_bytes, workers)
+            return workers
+        start, start_bytes, _ = self._sample
+        if now - start < self._interval:
+            return workers
+        if total_bytes < start_bytes:
+            # 周期内发生了每日重置
+            self.invalidate()
+            return workers
+        throughput = (total_bytes - start_bytes) / (now - start)
+        target = self._decide(workers, throughput, rate_limit)
+        self._previous = (workers, throughput)
+        self._sample = (now, total_bytes, self.clamp(target))
+        return self.clamp(target)
+
+    def _decide(self, workers, throughput, rate_limit):
+        shrink = min(workers - 1, int(workers * self._decrease))
+        if rate_limit and throughput >= RATE_SATURATION * rate_limit:
+            logger.debug(f"吞吐量已达到全局速率上限，减少工作进程: {workers} -> {shrink}")
+            return shrink
+        if self._previous is None:
+            return workers + self._step
+        prev_workers, prev_throughput = self._previous
+        if workers > prev_workers:
+            marginal = (throughput - prev_throughput) / (workers - prev_workers)
+            average = prev_throughput / prev_workers
+            if marginal >= self._min_gain * average:
+                return workers + self._step
+            logger.debug(f"新增进程的边际吞吐量 {marginal / 1024 / 1024:.2f} MB/s 不足，"
+                         f"减少工作进程: {workers} -> {shrink}")
+            return shrink
+        if workers < prev_workers and throughput < (1 - self._min_gain) * prev_throughput:
+            return prev_workers
+        if workers < prev_workers:
+            return workers
+        return workers + self._step
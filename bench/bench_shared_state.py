@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+SharedState 后端微基准：测量各后端每秒能处理的操作数。
+
+用法：
+    python -m bench.bench_shared_state [--duration 2] [--workers 4]
+"""
+
+import argparse
+import json
+import multiprocessing
+import time
+
+from shared_state import SharedState, ShmSharedState
+
+
+def _make_state(backend):
+    if backend == 'manager':
+        return SharedState(multiprocessing.Manager())
+    return ShmSharedState(64)
+
+
+def _time_op(fn, duration):
+    """在 duration 秒内反复调用 fn，返回每秒操作数"""
+    ops = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            fn()
+        ops += 100
+    return ops / duration
+
+
+def _chunk_loop(state, process_id, duration, result_queue):
+    """模拟 download_http 每个数据块的操作：is_paused + add_bytes + update_speed"""
+    def chunk():
+        state.is_paused()
+        state.add_bytes(1024 * 1024)
+        state.update_speed(process_id, 1.0)
+    result_queue.put(_time_op(chunk, duration))
+
+
+def _lock_latency(state, duration, interval=0.001):
+    """在 duration 秒内反复获取共享状态的全局锁，返回获取耗时的分位数 (微秒)"""
+    samples = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        with state._lock:
+            samples.append((time.perf_counter() - start) * 1e6)
+        time.sleep(interval)
+    samples.sort()
+    return {
+        'p50': samples[len(samples) // 2],
+        'p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        'max': samples[-1],
+    }
+
+
+def bench_backend(backend, duration, workers):
+    state = _make_state(backend)
+    results = {
+        'add_bytes': _time_op(lambda: state.add_bytes(1), duration),
+        'is_paused': _time_op(state.is_paused, duration),
+        'update_speed': _time_op(lambda: state.update_speed(0, 1.0), duration),
+        'get_bytes': _time_op(state.get_bytes, duration),
+    }
+    state.set_quota(float('inf'))
+    results['acquire_quota'] = _time_op(lambda: state.acquire_quota(1024 * 1024), duration)
+
+    # 多进程并发：每个进程执行与 download_http 相同的每块操作序列
+    result_queue = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=_chunk_loop, args=(state, i, duration, result_queue))
+        for i in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    # 工作进程运行期间测量控制器获取全局锁的延迟
+    results['lock_latency_us'] = _lock_latency(state, duration)
+    chunk_rates = [result_queue.get() for _ in procs]
+    for p in procs:
+        p.join()
+    results[f'chunk_ops_{workers}_workers'] = sum(chunk_rates)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SharedState 后端微基准")
+    parser.add_argument('--duration', type=float, default=2.0, help="每项测试的持续秒数")
+    parser.add_argument('--workers', type=int, default=4, help="并发测试的进程数")
+    parser.add_argument('--json', action='store_true', help="以 JSON 输出结果")
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method("fork", force=True)
+    report = {backend: bench_backend(backend, args.duration, args.workers) for backend in ('manager', 'shm')}
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for backend, results in report.items():
+        print(f"[{backend}]")
+        for op, rate in results.items():
+            if isinstance(rate, dict):
+                print(f"  {op:<24} " + ' '.join(f"{k}={v:,.1f}" for k, v in rate.items()))
+            else:
+                print(f"  {op:<24} {rate:>14,.0f} ops/s")
+
+
+if __name__ == "__main__":
+    main()
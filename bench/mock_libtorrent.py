@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试用的模拟 Torrent 来源：实现 TorrentEngine 和 download_torrent 用到的 libtorrent 接口子集，
+按设定的速度"下载"种子并产生与真实会话相同的事件流，不访问网络。
+
+磁力链接参数：
+    xl=N      种子大小 (字节)，默认 64 MB
+    rate=B    该种子的下载速度 (字节/秒)，默认 BENCH_TORRENT_RATE
+    meta=S    获取元数据 (DHT 查找和 info 字典下载) 的耗时 (秒)，默认 0；由续传数据添加的种子没有这段等待
+    btih 中包含 "dead" 的链接永远没有进度，用于模拟死链
+
+install() 把本模块注册为 libtorrent；已安装真实 libtorrent 时需显式传入 force=True。
+"""
+
+import sys
+import json
+import time
+import threading
+from urllib.parse import parse_qs
+
+DEFAULT_SIZE = 64 * 1024 * 1024
+BENCH_TORRENT_RATE = 32 * 1024 * 1024
+PIECE_SIZE = 4 * 1024 * 1024
+
+
+class alert:
+    class category_t:
+        error_notification = 0x1
+        status_notification = 0x40
+        storage_notification = 0x20
+        piece_progress_notification = 0x200000
+
+
+class state_update_alert:
+    def __init__(self, status):
+        self.status = status
+
+
+class piece_finished_alert:
+    def __init__(self, handle, piece_index):
+        self.handle = handle
+        self.piece_index = piece_index
+
+
+class torrent_finished_alert:
+    def __init__(self, handle):
+        self.handle = handle
+
+
+class metadata_received_alert:
+    def __init__(self, handle):
+        self.handle = handle
+
+
+class save_resume_data_alert:
+    def __init__(self, handle, params):
+        self.handle = handle
+        self.params = params
+
+
+class peer_info:
+    def __init__(self, ip, total_download):
+        self.ip = ip
+        self.total_download = int(total_download)
+
+
+class torrent_error_alert:
+    def __init__(self, handle, message):
+        self.handle = handle
+        self._message = message
+
+    def message(self):
+        return self._message
+
+
+class add_torrent_params:
+    def __init__(self, uri):
+        self.uri = uri
+        self.save_path = ''
+        query = parse_qs(uri.split('?', 1)[-1])
+        self.size = int(query.get('xl', [DEFAULT_SIZE])[0])
+        self.rate = float(query.get('rate', [BENCH_TORRENT_RATE])[0])
+        btih = query.get('xt', [''])[0]
+        if 'dead' in btih:
+            self.rate = 0.0
+        self.name = query.get('dn', [btih.rsplit(':', 1)[-1] or 'mock'])[0]
+        self.metadata_delay = float(query.get('meta', [0])[0])
+        self.peers = []
+        self.have_pieces = []
+        self.verified_pieces = []
+        self.unfinished_pieces = {}
+
+
+def parse_magnet_uri(uri):
+    return add_torrent_params(uri)
+
+
+def write_resume_data_buf(params):
+    return json.dumps({'uri': params.uri}).encode()
+
+
+def read_resume_data(buf):
+    try:
+        params = add_torrent_params(json.loads(buf)['uri'])
+    except (ValueError, KeyError, TypeError):
+        raise RuntimeError("invalid resume data")
+    # 续传数据中已包含 info 字典，不需要再获取元数据
+    params.metadata_delay = 0.0
+    return params
+
+
+class torrent_status:
+    def __init__(self, handle, payload, rate):
+        self.handle = handle
+        self.total_payload_download = int(payload)
+        self.download_rate = int(rate)
+        self.name = handle._name
+
+
+class torrent_handle:
+    save_info_dict = 0x2
+
+    def __init__(self, session, params):
+        self._session = session
+        self._params = params
+        self._metadata_at = time.monotonic() + params.metadata_delay
+        self._has_metadata = False
+        self._name = params.name
+        self._size = params.size
+        self._rate = params.rate
+        self._payload = 0.0
+        self._paused = False
+        self._finished = False
+        self._pieces_done = 0
+
+    def pause(self):
+        with self._session._lock:
+            self._paused = True
+
+    def resume(self):
+        with self._session._lock:
+            self._paused = False
+
+    def name(self):
+        return self._name
+
+    def status(self):
+        with self._session._lock:
+            self._session._advance()
+            return self._status()
+
+    def _status(self):
+        return torrent_status(self, self._payload, self._current_rate() if self._running() else 0)
+
+    def _current_rate(self):
+        limit = self._session._rate_limit
+        active = max(1, len([h for h in self._session._handles if h._running()]))
+        return min(self._rate, limit / active) if limit > 0 else self._rate
+
+    def _running(self):
+        return self._has_metadata and not (self._paused or self._session._paused or self._finished)
+
+    def save_resume_data(self, flags=0):
+        with self._session._lock:
+            self._session._alerts.append(save_resume_data_alert(self, self._params))
+            self._session._alert_ready.set()
+
+    def get_peer_info(self):
+        with self._session._lock:
+            return [peer_info(('10.0.0.1', 6881), self._payload)]
+
+    def torrent_file(self):
+        # 模拟种子没有文件布局，TorrentStorage.discard_piece 会直接跳过
+        return None
+
+
+class session:
+    def __init__(self, settings=None):
+        self._lock = threading.Lock()
+        self._handles = []
+        self._alerts = []
+        self._updates_requested = False
+        self._paused = False
+        self._rate_limit = 0.0
+        self._last = time.monotonic()
+        self._alert_ready = threading.Event()
+        self.apply_settings(settings or {})
+
+    def apply_settings(self, settings):
+        with self._lock:
+            self._advance()
+            self._rate_limit = float(settings.get('download_rate_limit', self._rate_limit))
+
+    def add_torrent(self, params):
+        with self._lock:
+            self._advance()
+            handle = torrent_handle(self, params)
+            self._handles.append(handle)
+            return handle
+
+    def remove_torrent(self, handle):
+        with self._lock:
+            self._advance()
+            if handle in self._handles:
+                self._handles.remove(handle)
+
+    def pause(self):
+        with self._lock:
+            self._advance()
+            self._paused = True
+
+    def resume(self):
+        with self._lock:
+            self._advance()
+            self._paused = False
+
+    def post_torrent_updates(self):
+        with self._lock:
+            self._advance()
+            self._alerts.append(state_update_alert([h._status() for h in self._handles]))
+            self._alert_ready.set()
+
+    def wait_for_alert(self, timeout_ms):
+        deadline = time.monotonic() + timeout_ms / 1000.0
+        while True:
+            with self._lock:
+                self._advance()
+                if self._alerts:
+                    return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            # 按较细的粒度推进模拟时间，使完成事件能及时送达
+            self._alert_ready.wait(min(remaining, 0.05))
+            self._alert_ready.clear()
+
+    def pop_alerts(self):
+        with self._lock:
+            self._advance()
+            alerts, self._alerts = self._alerts, []
+            return alerts
+
+    def _advance(self):
+        """调用方必须持有 self._lock：按经过的时间推进每个种子的下载进度"""
+        now = time.monotonic()
+        elapsed, self._last = now - self._last, now
+        for handle in self._handles:
+            if not handle._has_metadata and now >= handle._metadata_at:
+                handle._has_metadata = True
+                self._alerts.append(metadata_received_alert(handle))
+            if not handle._running():
+                continue
+            handle._payload = min(handle._size, handle._payload + handle._current_rate() * elapsed)
+            pieces = int(handle._payload // PIECE_SIZE)
+            while handle._pieces_done < pieces:
+                self._alerts.append(piece_finished_alert(handle, handle._pieces_done))
+                handle._pieces_done += 1
+            if handle._payload >= handle._size:
+                handle._finished = True
+                self._alerts.append(torrent_finished_alert(handle))
+
+
+def install(force=False):
+    """在 sys.modules 中注册为 libtorrent (真实模块可用且未指定 force 时不替换)，返回是否使用了模拟模块"""
+    if not force:
+        try:
+            import libtorrent  # noqa: F401
+            return False
+        except ImportError:
+            pass
+    sys.modules['libtorrent'] = sys.modules[__name__]
+    return True
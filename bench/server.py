@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试用的本地 HTTP 服务器，在独立进程中运行，避免与被测代码争用 GIL。
+
+支持的路径 (参数均为可选)：
+    /fixed?size=N             带 Content-Length 的定长响应，支持 Range 和 HEAD
+    /chunked?size=N&chunk=M   Transfer-Encoding: chunked 响应
+    /slow?size=N&rate=B       以约 B 字节/秒的速度慢速滴灌的定长响应
+    /redirect?to=PATH         302 跳转到同一服务器上的 PATH
+    /error?status=S           返回指定状态码
+
+单独运行：
+    python -m bench.server [--port 8765]
+"""
+
+import argparse
+import time
+import socket
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+DEFAULT_SIZE = 64 * 1024 * 1024
+DEFAULT_CHUNK = 64 * 1024
+DEFAULT_SLOW_RATE = 256 * 1024
+WRITE_BLOCK = 1024 * 1024
+# 所有响应体都从同一块预分配的缓冲区切片发送
+_PAYLOAD = memoryview(b'\xa5' * WRITE_BLOCK)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self):
+        parts = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        return parts.path, query
+
+    def _write_body(self, length, rate=0.0):
+        block = WRITE_BLOCK if rate <= 0 else max(1024, min(WRITE_BLOCK, int(rate / 20)))
+        start = time.monotonic()
+        sent = 0
+        while sent < length:
+            n = min(block, length - sent)
+            self.wfile.write(_PAYLOAD[:n])
+            sent += n
+            if rate > 0:
+                delay = start + sent / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def _send_fixed(self, query, head=False):
+        size = int(query.get('size', DEFAULT_SIZE))
+        start, end = 0, size - 1
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            first, _, last = range_header[6:].partition('-')
+            start = int(first) if first else max(0, size - int(last))
+            end = min(size - 1, int(last)) if first and last else size - 1
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not head:
+            self._write_body(end - start + 1, float(query.get('rate', 0)))
+
+    def _send_chunked(self, query):
+        size = int(query.get('size', DEFAULT_SIZE))
+        chunk = int(query.get('chunk', DEFAULT_CHUNK))
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        sent = 0
+        while sent < size:
+            n = min(chunk, size - sent, WRITE_BLOCK)
+            self.wfile.write(b'%x\r\n' % n)
+            self.wfile.write(_PAYLOAD[:n])
+            self.wfile.write(b'\r\n')
+            sent += n
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_HEAD(self):
+        path, query = self._params()
+        if path in ('/fixed', '/slow'):
+            self._send_fixed(query, head=True)
+        else:
+            self.send_error(404)
+
+    def do_GET(self):
+        path, query = self._params()
+        try:
+            if path == '/fixed':
+                self._send_fixed(query)
+            elif path == '/slow':
+                query.setdefault('rate', DEFAULT_SLOW_RATE)
+                self._send_fixed(query)
+            elif path == '/chunked':
+                self._send_chunked(query)
+            elif path == '/redirect':
+                self.send_response(302)
+                self.send_header('Location', query.get('to', '/fixed'))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            elif path == '/error':
+                self.send_error(int(query.get('status', 500)))
+            else:
+                self.send_error(404)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前关闭连接 (例如暂停或配额用完) 是正常情况
+            self.close_connection = True
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class BenchServer:
+    """在子进程中运行的本地 HTTP 服务器。端口为 0 时由系统分配，可通过 url() 获得完整地址。"""
+    def __init__(self, host='127.0.0.1', port=0):
+        self._server = _Server((host, port), _Handler)
+        self.host, self.port = self._server.server_address[:2]
+        self.process = None
+
+    def url(self, path='/fixed', **query):
+        suffix = '&'.join(f'{k}={v}' for k, v in query.items())
+        return f"http://{self.host}:{self.port}{path}" + (f"?{suffix}" if suffix else '')
+
+    def start(self):
+        # 监听套接字已在父进程中绑定，fork 后由子进程负责接受连接
+        self.process = multiprocessing.Process(target=self._server.serve_forever, name="BenchServer", daemon=True)
+        self.process.start()
+        self._server.socket.close()
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def wait_ready(host, port, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="基准测试用的本地 HTTP 服务器")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    server = _Server((args.host, args.port), _Handler)
+    print(f"监听 http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
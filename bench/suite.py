@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+离线基准测试套件：启动本地 HTTP 服务器，按设定的大小和速率驱动真实的代码路径。
+
+场景：
+    shared_state  SharedState 各后端的每秒操作数和全局锁延迟 (见 bench_shared_state)
+    http          单进程调用 download_http / download_http_raw / download_http_async / download_http_segmented：
+                  吞吐量、CPU 秒/GB
+    workers       多个 worker_process 进程：总吞吐量、CPU 秒/GB、暂停反应时间
+    main          完整的 main() 控制循环：达到下载上限后的暂停反应时间和配额超出量
+
+用法：
+    python -m bench.suite [--only http,workers] [--duration 5] [--workers 4] [--output result.json]
+    python -m bench.suite --mock-torrent     # 同时运行模拟 Torrent 来源 (bench.mock_libtorrent)
+
+结果以 JSON 输出 (--json 或 --output)，可在不同版本之间对比。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+import multiprocessing
+import urllib.request
+
+from bench import mock_libtorrent
+from bench.server import BenchServer, wait_ready
+
+# 未安装 libtorrent 时 downloader 包无法导入，此时使用模拟模块
+MOCK_TORRENT_INSTALLED = mock_libtorrent.install()
+
+import config
+from bench.bench_shared_state import bench_backend
+from downloader import download_http, download_http_async, download_http_raw, download_http_segmented
+from scheduler import TaskScheduler
+from shared_state import ShmSharedState
+
+GB = 1024 ** 3
+MB = 1024 * 1024
+# 判断下载已停止所需的无增长时长 (秒)
+QUIET_PERIOD = 0.5
+POLL_INTERVAL = 0.01
+
+
+def _cpu_children():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _cpu_self():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _throughput(num_bytes, wall, cpu):
+    return {
+        'bytes': num_bytes,
+        'seconds': wall,
+        'bytes_per_sec': num_bytes / wall if wall > 0 else 0.0,
+        'cpu_seconds': cpu,
+        'cpu_seconds_per_gb': cpu / (num_bytes / GB) if num_bytes else None,
+    }
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_until_quiet(read_bytes, since, timeout=30.0):
+    """轮询 read_bytes()，直到连续 QUIET_PERIOD 秒没有增长；返回 (最后一次增长的时间, 最终字节数)"""
+    last_value = read_bytes()
+    last_change = since
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        value = read_bytes()
+        now = time.monotonic()
+        if value != last_value:
+            last_value, last_change = value, now
+        elif now - last_change >= QUIET_PERIOD:
+            break
+    return last_change, last_value
+
+
+def _new_state(rate_bytes=0.0):
+    state = ShmSharedState(64)
+    state.set_quota(None)
+    state.set_rate_limit(rate_bytes)
+    return state
+
+
+# ---- http：单进程下载函数 ----
+
+def bench_http(server, duration, size, rate_bytes):
+    """每个引擎对每种响应类型循环下载 duration 秒"""
+    engines = {
+        'requests': lambda url, state: download_http(url, state, 'bench'),
+        'raw': lambda url, state: download_http_raw(url, state, 'bench'),
+        'asyncio': lambda url, state: asyncio.run(download_http_async(url, state, 'bench')),
+    }
+    urls = {
+        'fixed': server.url('/fixed', size=size),
+        'chunked': server.url('/chunked', size=size),
+    }
+    results = {}
+    for engine, download in engines.items():
+        for kind, url in urls.items():
+            state = _new_state(rate_bytes)
+            failures = 0
+            ttfbs = []
+            wall_start, cpu_start = time.monotonic(), _cpu_self()
+            while time.monotonic() - wall_start < duration:
+                result = download(url, state)
+                if not result.ok:
+                    failures += 1
+                elif result.ttfb is not None:
+                    ttfbs.append(result.ttfb)
+            entry = _throughput(state.get_bytes(), time.monotonic() - wall_start, _cpu_self() - cpu_start)
+            entry['failures'] = failures
+            entry['ttfb_avg'] = sum(ttfbs) / len(ttfbs) if ttfbs else None
+            if rate_bytes > 0:
+                entry['rate_target_bytes_per_sec'] = rate_bytes
+            results[f'{engine}.{kind}'] = entry
+
+    # 慢速响应：测量首字节时间和对慢速来源的吞吐量
+    state = _new_state()
+    slow_rate = 2 * MB
+    wall_start, cpu_start = time.monotonic(), _cpu_self()
+    result = download_http(server.url('/slow', size=4 * MB, rate=slow_rate), state, 'bench')
+    entry = _throughput(state.get_bytes(), time.monotonic() - wall_start, _cpu_self() - cpu_start)
+    entry['ttfb'] = result.ttfb
+    entry['server_rate_bytes_per_sec'] = slow_rate
+    results['requests.slow'] = entry
+
+    # 同一个按连接限速的慢速来源改用多连接分段下载
+    segments, segment_size = config.HTTP_SEGMENTS, config.HTTP_SEGMENT_SIZE
+    config.HTTP_SEGMENTS, config.HTTP_SEGMENT_SIZE = max(4, segments), MB
+    try:
+        state = _new_state()
+        wall_start, cpu_start = time.monotonic(), _cpu_self()
+        result = download_http_segmented(server.url('/slow', size=4 * MB, rate=slow_rate), state, 'bench')
+        entry = _throughput(state.get_bytes(), time.monotonic() - wall_start, _cpu_self() - cpu_start)
+        entry['ttfb'] = result.ttfb
+        entry['segments'] = config.HTTP_SEGMENTS
+        entry['server_rate_bytes_per_sec'] = slow_rate
+        results['segmented.slow'] = entry
+    finally:
+        config.HTTP_SEGMENTS, config.HTTP_SEGMENT_SIZE = segments, segment_size
+    return results
+
+
+# ---- workers：多进程 worker_process ----
+
+def _worker_tasks(server, size, mock_torrent):
+    config.HTTP_URLS = [server.url('/fixed', size=size), server.url('/chunked', size=size)]
+    config.MAGNET_LINKS = []
+    if mock_torrent:
+        # 引擎进程在启动时才导入 libtorrent，此时替换为模拟模块即可
+        mock_libtorrent.install(force=True)
+        config.MAGNET_LINKS = [f"magnet:?xt=urn:btih:mock{i}&xl={size * 4}" for i in range(2)]
+        config.TORRENT_ENGINE = 'shared'
+        config.TORRENT_TMP_DIR = tempfile.mkdtemp(prefix='bench-torrent-')
+
+
+def bench_workers(server, duration, workers, size, engine, rate_bytes, mock_torrent):
+    import main
+    from downloader import TorrentEngine
+
+    config.HTTP_ENGINE = engine
+    _worker_tasks(server, size, mock_torrent)
+    state = _new_state(rate_bytes)
+    scheduler = TaskScheduler(main._all_tasks())
+    cpu_start = _cpu_children()
+
+    processes = [multiprocessing.Process(target=main.worker_process, args=(i, state, scheduler), name=f"Worker-{i}")
+                 for i in range(workers)]
+    if mock_torrent:
+        torrent_engine = TorrentEngine(state, scheduler=scheduler)
+        for link in config.MAGNET_LINKS:
+            torrent_engine.submit(link)
+        processes.append(torrent_engine.start())
+    for p in processes[:workers]:
+        p.start()
+
+    # 先预热，再测量稳定状态下的吞吐量
+    time.sleep(min(1.0, duration / 4))
+    bytes_start, wall_start = state.get_bytes(), time.monotonic()
+    time.sleep(duration)
+    bytes_end, wall_end = state.get_bytes(), time.monotonic()
+
+    # 暂停反应时间：从 pause() 到所有进程停止计入下载量
+    bytes_at_pause, pause_time = state.get_bytes(), time.monotonic()
+    state.pause()
+    last_change, final_bytes = _wait_until_quiet(state.get_bytes, pause_time)
+
+    for p in processes:
+        p.terminate()
+        p.join()
+    cpu = _cpu_children() - cpu_start
+
+    entry = _throughput(bytes_end - bytes_start, wall_end - wall_start, cpu)
+    # 进程的 CPU 时间覆盖整个运行期间，按全部下载量折算
+    entry['cpu_seconds_per_gb'] = cpu / (final_bytes / GB) if final_bytes else None
+    entry['pause_reaction_seconds'] = last_change - pause_time
+    entry['bytes_after_pause'] = final_bytes - bytes_at_pause
+    entry['sources'] = {link: {k: st[k] for k in ('bytes', 'successes', 'failures')}
+                        for link, st in scheduler.snapshot().items()}
+    return entry
+
+
+# ---- main：完整控制循环 ----
+
+def _run_main(overrides):
+    """在子进程中运行 main.main()，config 的覆盖项在导入 main 之前生效"""
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    import main
+    logging.getLogger().setLevel(config.LOG_LEVEL)
+    main.main()
+
+
+def _fetch_status(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/status", timeout=2) as response:
+        return json.load(response)
+
+
+def bench_main(server, workers, size, engine, limit_bytes, rate_bytes, mock_torrent, timeout=120.0):
+    data_dir = tempfile.mkdtemp(prefix='bench-main-')
+    port = _free_port()
+    _worker_tasks(server, size, mock_torrent)
+    overrides = {
+        'HTTP_URLS': config.HTTP_URLS,
+        'MAGNET_LINKS': config.MAGNET_LINKS,
+        'TORRENT_ENGINE': config.TORRENT_ENGINE,
+        'TORRENT_TMP_DIR': config.TORRENT_TMP_DIR,
+        'HTTP_ENGINE': engine,
+        'CONCURRENT_DOWNLOADS': workers,
+        'DOWNLOAD_LIMIT_GB': limit_bytes / GB,
+        'MAX_RATE_MBPS': rate_bytes * 8 / MB,
+        'MAX_RATE_BYTES': rate_bytes,
+        'ALLOWED_TIME_WINDOWS': config.parse_time_windows('00:00-24:00'),
+        'STATE_FILE': os.path.join(data_dir, 'download_state.json'),
+        'SCHEDULER_STATE_FILE': os.path.join(data_dir, 'scheduler_state.json'),
+        'JOURNAL_FILE': os.path.join(data_dir, 'download_state.journal'),
+        'METRICS_PORT': port,
+        'METRICS_HOST': '127.0.0.1',
+        'LOG_LEVEL': 'WARNING',
+    }
+    cpu_start = _cpu_children()
+    wall_start = time.monotonic()
+    proc = multiprocessing.Process(target=_run_main, args=(overrides,), name="BenchMain")
+    proc.start()
+    try:
+        if not wait_ready('127.0.0.1', port, timeout=10):
+            raise RuntimeError("main() 的状态服务没有启动")
+
+        # 高频轮询状态服务，记录下载开始、暂停和停止的时间点
+        first_bytes_time = pause_time = None
+        status = {}
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            status = _fetch_status(port)
+            now = time.monotonic()
+            if first_bytes_time is None and status['downloaded_bytes'] > 0:
+                first_bytes_time = now
+            if first_bytes_time is not None and status['paused'] and 'limit' in status['pause_reasons']:
+                pause_time = now
+                break
+            time.sleep(POLL_INTERVAL)
+        if pause_time is None:
+            raise RuntimeError(f"{timeout:.0f} 秒内没有达到下载上限")
+        bytes_at_pause = status['downloaded_bytes']
+        last_change, final_bytes = _wait_until_quiet(lambda: _fetch_status(port)['downloaded_bytes'], pause_time)
+    finally:
+        os.kill(proc.pid, signal.SIGINT)
+        proc.join(10)
+        if proc.is_alive():
+            proc.terminate()
+            proc.join()
+    cpu = _cpu_children() - cpu_start
+
+    download_seconds = pause_time - first_bytes_time
+    return {
+        'limit_bytes': limit_bytes,
+        'final_bytes': final_bytes,
+        'overshoot_bytes': final_bytes - limit_bytes,
+        'bytes_after_pause': final_bytes - bytes_at_pause,
+        'pause_reaction_seconds': last_change - pause_time,
+        'startup_seconds': first_bytes_time - wall_start,
+        'bytes_per_sec': bytes_at_pause / download_seconds if download_seconds > 0 else 0.0,
+        'cpu_seconds': cpu,
+        'cpu_seconds_per_gb': cpu / (final_bytes / GB) if final_bytes else None,
+    }
+
+
+# ---- 入口 ----
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _print_report(report, indent=0):
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print(f"{'  ' * indent}[{key}]")
+            _print_report(value, indent + 1)
+        elif isinstance(value, float):
+            print(f"{'  ' * indent}{key:<28} {value:,.4f}")
+        else:
+            print(f"{'  ' * indent}{key:<28} {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TideFlowControl 离线基准测试套件")
+    parser.add_argument('--only', default='shared_state,http,workers,main', help="要运行的场景，逗号分隔")
+    parser.add_argument('--duration', type=float, default=5.0, help="每个吞吐量测试的持续秒数")
+    parser.add_argument('--workers', type=int, default=4, help="工作进程数量")
+    parser.add_argument('--engine', default='requests', choices=('requests', 'raw', 'asyncio'),
+                        help="workers/main 场景使用的 HTTP 引擎")
+    parser.add_argument('--size-mb', type=int, default=64, help="每个 HTTP 响应的大小 (MB)")
+    parser.add_argument('--rate-mbps', type=float, default=0.0, help="全局速率上限 (Mbps)，0 表示不限速")
+    parser.add_argument('--limit-mb', type=int, default=1024, help="main 场景的下载上限 (MB)")
+    parser.add_argument('--mock-torrent', action='store_true', help="同时运行模拟 Torrent 来源")
+    parser.add_argument('--json', action='store_true', help="以 JSON 输出结果")
+    parser.add_argument('--output', help="把 JSON 结果写入文件")
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method("fork", force=True)
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    scenarios = [s.strip() for s in args.only.split(',') if s.strip()]
+    size = args.size_mb * MB
+    rate_bytes = args.rate_mbps * MB / 8
+    results = {}
+    with BenchServer() as server:
+        wait_ready(server.host, server.port)
+        if 'shared_state' in scenarios:
+            results['shared_state'] = {backend: bench_backend(backend, min(args.duration, 2.0), args.workers)
+                                       for backend in ('manager', 'shm')}
+        if 'http' in scenarios:
+            results['http'] = bench_http(server, args.duration, size, rate_bytes)
+        if 'workers' in scenarios:
+            results['workers'] = bench_workers(server, args.duration, args.workers, size, args.engine,
+                                               rate_bytes, args.mock_torrent)
+        if 'main' in scenarios:
+            results['main'] = bench_main(server, args.workers, size, args.engine, args.limit_mb * MB,
+                                         rate_bytes, args.mock_torrent)
+
+    report = {
+        'meta': {
+            'revision': _git_revision(),
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'mock_libtorrent': MOCK_TORRENT_INSTALLED or args.mock_torrent,
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(report['results'])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import socket
 
 # 配置现在将直接从容器的环境变量中读取
 # Docker Compose 会负责从 .env 文件加载这些变量
@@ -10,42 +11,227 @@ def parse_urls(env_var: str) -> list[str]:
         return []
     return [url.strip() for url in env_var.split(',') if url.strip()]
 
-def parse_time_windows(env_var: str) -> list[tuple[str, str]]:
-    """解析时间窗口字符串 "HH:MM-HH:MM,..." """
+_WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+_DAY_GROUPS = {'weekday': (0, 1, 2, 3, 4), 'weekdays': (0, 1, 2, 3, 4), 'weekend': (5, 6), 'weekends': (5, 6)}
+
+def parse_days(spec: str) -> tuple[int, ...]:
+    """解析星期规则："weekday"、"weekend"、"mon-fri"、"sat+sun" 等，返回星期序号 (周一为 0)"""
+    days = set()
+    for part in spec.lower().split('+'):
+        if part in _DAY_GROUPS:
+            days.update(_DAY_GROUPS[part])
+        elif '-' in part:
+            first, last = (_WEEKDAYS.index(p[:3]) for p in part.split('-'))
+            days.update((first + i) % 7 for i in range((last - first) % 7 + 1))
+        else:
+            days.add(_WEEKDAYS.index(part[:3]))
+    return tuple(sorted(days))
+
+def parse_time_windows(env_var: str) -> list[tuple]:
+    """
+    解析时间窗口字符串 "[星期 ]HH:MM-HH:MM[@Mbps],..."，返回 [(开始, 结束, 星期, 速率目标)]。
+    星期省略表示每天；@Mbps 省略表示该窗口内不设速率目标。
+    """
     if not env_var:
-        return [("00:00", "23:59")]
+        return [("00:00", "23:59", None, None)]
     windows = []
     parts = [part.strip() for part in env_var.split(',') if part.strip()]
     for part in parts:
         try:
-            start, end = part.split('-')
-            windows.append((start.strip(), end.strip()))
+            tokens = part.split()
+            days = parse_days(tokens[0]) if len(tokens) == 2 else None
+            span, _, rate = tokens[-1].partition('@')
+            start, end = span.split('-')
+            windows.append((start.strip(), end.strip(), days, float(rate) if rate else None))
         except ValueError:
             print(f"警告：跳过无效的时间窗口格式: {part}")
-    return windows if windows else [("00:00", "23:59")]
+    return windows if windows else [("00:00", "23:59", None, None)]
 
 # 1. 要测试的链接列表 (从环境变量读取)
 HTTP_URLS = parse_urls(os.getenv("HTTP_URLS", ""))
 MAGNET_LINKS = parse_urls(os.getenv("MAGNET_LINKS", ""))
 
 # 2. 并发设置
+# 工作进程数量
 CONCURRENT_DOWNLOADS = int(os.getenv("CONCURRENT_DOWNLOADS", 5))
+# HTTP 下载引擎："requests" 每个进程一个阻塞连接；"raw" 同样每进程一个连接，
+# 但使用 recv_into 预分配缓冲区的零拷贝接收路径，CPU 开销最低；"asyncio" 每个进程并发多个流
+HTTP_ENGINE = os.getenv("HTTP_ENGINE", "requests").lower()
+# asyncio 引擎下每个工作进程的并发流数量，总连接数 = CONCURRENT_DOWNLOADS × STREAMS_PER_PROCESS
+STREAMS_PER_PROCESS = int(os.getenv("STREAMS_PER_PROCESS", 1))
+
+# 工作进程池自动伸缩：按总吞吐量的边际增益在最小/最大进程数之间做加性增、乘性减 (AIMD)
+# 关闭时进程数固定为 CONCURRENT_DOWNLOADS；无论是否开启，异常退出的工作进程都会被重新拉起
+AUTOSCALE = os.getenv("AUTOSCALE", "false").lower() in ("1", "true", "yes")
+AUTOSCALE_MIN_WORKERS = int(os.getenv("AUTOSCALE_MIN_WORKERS", 1))
+AUTOSCALE_MAX_WORKERS = int(os.getenv("AUTOSCALE_MAX_WORKERS", CONCURRENT_DOWNLOADS * 2))
+# 每次测量吞吐量并调整进程数的间隔 (秒)
+AUTOSCALE_INTERVAL = float(os.getenv("AUTOSCALE_INTERVAL", 30))
+# 每次增加的进程数，以及吞吐量不再增长时进程数乘以的系数
+AUTOSCALE_STEP = int(os.getenv("AUTOSCALE_STEP", 1))
+AUTOSCALE_DECREASE = float(os.getenv("AUTOSCALE_DECREASE", 0.75))
+# 新增进程带来的吞吐量至少要达到现有进程平均吞吐量的这个比例，才继续增加
+AUTOSCALE_MIN_GAIN = float(os.getenv("AUTOSCALE_MIN_GAIN", 0.25))
+# 缩容时等待工作进程完成当前任务的最长时间 (秒)，超时后强制终止
+AUTOSCALE_DRAIN_TIMEOUT = float(os.getenv("AUTOSCALE_DRAIN_TIMEOUT", 120))
+# 同时存在的工作进程数上限，共享状态的槽位和配额租约按此计算
+MAX_WORKERS = max(CONCURRENT_DOWNLOADS, AUTOSCALE_MAX_WORKERS) if AUTOSCALE else CONCURRENT_DOWNLOADS
 
 # 3. 流量控制
 DOWNLOAD_LIMIT_GB = int(os.getenv("DOWNLOAD_LIMIT_GB", 500))
 
+# 配额租约：每个工作进程一次申领的配额大小 (MB)，在本地扣减，用完再申领
+QUOTA_LEASE_MB = int(os.getenv("QUOTA_LEASE_MB", 64))
+QUOTA_LEASE_BYTES = QUOTA_LEASE_MB * 1024 * 1024
+# 剩余配额接近 0 时租约会缩小，但不小于该值 (字节)
+QUOTA_MIN_LEASE_BYTES = int(os.getenv("QUOTA_MIN_LEASE_BYTES", 64 * 1024))
+# 配额分完后，等待其他进程用完手中租约的最长时间 (秒)；超时后即使仍有租约未用完 (例如持有租约的进程空闲) 也暂停
+QUOTA_DRAIN_TIMEOUT = float(os.getenv("QUOTA_DRAIN_TIMEOUT", 10))
+
+# 全局速率上限 (Mbps)，所有工作进程共享一个令牌桶；0 表示不限速
+MAX_RATE_MBPS = float(os.getenv("MAX_RATE_MBPS", 0))
+MAX_RATE_BYTES = MAX_RATE_MBPS * 1024 * 1024 / 8
+
 # 4. 重置时间点
 RESET_TIME = os.getenv("RESET_TIME", "03:00")
 
 # 5. 允许下载的时间段
+# 格式 "[星期 ]HH:MM-HH:MM[@Mbps]"，例如 "weekday 01:00-07:00@200,weekend 00:00-24:00"
 ALLOWED_TIME_WINDOWS = parse_time_windows(os.getenv("ALLOWED_TIME_WINDOWS", "00:00-23:59"))
+# 配额匀速模式：把剩余的每日配额均匀分摊到下次重置前剩余的允许下载时间上，而不是一开始就全速用完
+SCHEDULE_PACING = os.getenv("SCHEDULE_PACING", "false").lower() in ("1", "true", "yes")
 
 # 6. 状态持久化文件
 # 将其指向容器内的一个挂载卷
 STATE_FILE = "/app/data/download_state.json"
+# 追加写入的用量日志，检查点 (STATE_FILE) 之后的增量记录在这里
+JOURNAL_FILE = "/app/data/download_state.journal"
+# 检查点间隔 (秒)：把完整状态原子地写入 STATE_FILE 并清空日志
+JOURNAL_CHECKPOINT_INTERVAL = float(os.getenv("JOURNAL_CHECKPOINT_INTERVAL", 300))
+# 按小时保留用量历史的天数，更早的记录汇总为按天记录
+HISTORY_HOURLY_DAYS = int(os.getenv("HISTORY_HOURLY_DAYS", 14))
+# 按天保留用量历史的天数
+HISTORY_DAILY_DAYS = int(os.getenv("HISTORY_DAILY_DAYS", 400))
 
 # 7. 下载块大小 (Bytes)
 CHUNK_SIZE = 1024 * 1024  # 1 MB
 
 # 8. 日志级别
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# 9. 共享状态后端
+# "shm": 基于共享内存的无锁计数器 (默认)；"manager": 基于 multiprocessing.Manager 的旧实现
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "shm").lower()
+# 共享内存后端中每类计数器的槽位数量 (需大于并发进程/连接数)
+STATE_SLOTS = int(os.getenv("STATE_SLOTS", 64))
+
+# 10. HTTP 连接池
+# 每个工作进程对每个主机保留的空闲长连接数量
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 4))
+# 空闲连接的最长保留时间 (秒)
+HTTP_POOL_IDLE_TIMEOUT = float(os.getenv("HTTP_POOL_IDLE_TIMEOUT", 60))
+# 进程内 DNS 缓存的有效期 (秒)，0 表示不缓存 (仅 raw 引擎)
+DNS_CACHE_TTL = float(os.getenv("DNS_CACHE_TTL", 300))
+# 新建 TLS 连接时是否复用之前的 TLS 会话 (仅 raw 引擎)
+TLS_SESSION_RESUMPTION = os.getenv("TLS_SESSION_RESUMPTION", "true").lower() in ("1", "true", "yes")
+# 分段下载 (仅 requests 引擎)：每个大文件同时使用的 Range 连接数，1 表示不分段
+HTTP_SEGMENTS = int(os.getenv("HTTP_SEGMENTS", 1))
+# 分段下载时每个区间的大小 (MB)；小于两个区间的文件仍使用单连接
+HTTP_SEGMENT_SIZE_MB = int(os.getenv("HTTP_SEGMENT_SIZE_MB", 16))
+HTTP_SEGMENT_SIZE = HTTP_SEGMENT_SIZE_MB * 1024 * 1024
+
+# 11. Torrent 引擎
+# "shared": 由一个独立进程持有长期存活的 libtorrent 会话，同时运行多个种子 (默认)
+# "per_task": 旧实现，每个任务在工作进程内新建一个会话
+TORRENT_ENGINE = os.getenv("TORRENT_ENGINE", "shared").lower()
+# 共享引擎同时运行的种子数量
+TORRENT_MAX_ACTIVE = int(os.getenv("TORRENT_MAX_ACTIVE", 4))
+# 共享引擎的监听端口
+TORRENT_LISTEN_PORT = int(os.getenv("TORRENT_LISTEN_PORT", 6881))
+# 向 libtorrent 请求种子状态更新的间隔 (秒)，越短配额计量越及时
+TORRENT_UPDATE_INTERVAL = float(os.getenv("TORRENT_UPDATE_INTERVAL", 0.5))
+# 种子负载的存放方式："discard" 分片校验通过后立即释放内存 (默认)；"tmpfs" 保留完整文件直到种子移除
+TORRENT_STORAGE = os.getenv("TORRENT_STORAGE", "discard").lower()
+# 种子临时目录 (应位于 tmpfs)，程序启动时会被清空
+TORRENT_TMP_DIR = os.getenv("TORRENT_TMP_DIR", "/dev/shm/tideflowcontrol")
+# 所有种子在途分片占用内存的上限 (MB)，超过后暂停种子直到释放跟上；0 表示不限制
+TORRENT_MAX_INFLIGHT_MB = int(os.getenv("TORRENT_MAX_INFLIGHT_MB", 256))
+TORRENT_MAX_INFLIGHT_BYTES = TORRENT_MAX_INFLIGHT_MB * 1024 * 1024
+# 磁力链接缓存：按 info-hash 保存种子元数据、可用节点和续传数据，重复下载同一链接时跳过 DHT 查找和元数据下载
+TORRENT_CACHE = os.getenv("TORRENT_CACHE", "true").lower() in ("1", "true", "yes")
+# 缓存目录 (应位于持久化存储，而不是 tmpfs)
+TORRENT_CACHE_DIR = os.getenv("TORRENT_CACHE_DIR", "/app/data/torrent_cache")
+# 缓存总大小上限 (MB)，超过时先淘汰最久未使用的条目
+TORRENT_CACHE_MAX_MB = int(os.getenv("TORRENT_CACHE_MAX_MB", 64))
+TORRENT_CACHE_MAX_BYTES = TORRENT_CACHE_MAX_MB * 1024 * 1024
+# 超过该天数未使用的条目被删除
+TORRENT_CACHE_MAX_AGE_DAYS = float(os.getenv("TORRENT_CACHE_MAX_AGE_DAYS", 30))
+# 每个种子保存的已知可用节点数量上限
+TORRENT_CACHE_MAX_PEERS = int(os.getenv("TORRENT_CACHE_MAX_PEERS", 50))
+
+# 12. 任务调度
+# 同一主机上同时运行的下载任务数上限，0 表示不限制
+SCHEDULER_MAX_PER_HOST = int(os.getenv("SCHEDULER_MAX_PER_HOST", 0))
+# 失败来源的退避时间 (秒)：第 n 次连续失败后等待 BASE × 2^(n-1)，不超过 MAX
+SCHEDULER_BACKOFF_BASE = float(os.getenv("SCHEDULER_BACKOFF_BASE", 5))
+SCHEDULER_BACKOFF_MAX = float(os.getenv("SCHEDULER_BACKOFF_MAX", 600))
+# 忽略统计、均匀随机选择来源的概率，用于发现变快的来源
+SCHEDULER_EXPLORE = float(os.getenv("SCHEDULER_EXPLORE", 0.1))
+# 种子在该时长 (秒) 内没有任何下载进度时视为失败并换下，0 表示不检测
+SCHEDULER_STALL_TIMEOUT = float(os.getenv("SCHEDULER_STALL_TIMEOUT", 300))
+# 各来源统计的持久化文件
+SCHEDULER_STATE_FILE = "/app/data/scheduler_state.json"
+
+# 13. 状态服务
+# 提供 /metrics (Prometheus 文本格式) 和 /status (JSON) 的 HTTP 端口，0 表示不启动
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+# 状态服务监听的地址
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+
+# 14. 多节点协调服务
+# 多台主机共享一个上游流量预算时，由协调服务 (python -m coordinator serve) 统一持有全局配额并按租约分配给各节点
+# 协调服务地址，例如 "http://10.0.0.2:8731"；留空表示不使用，仅按本机的 DOWNLOAD_LIMIT_GB 限制
+COORDINATOR_URL = os.getenv("COORDINATOR_URL", "").rstrip('/')
+# 本节点在协调服务中的名称，默认使用主机名
+NODE_NAME = os.getenv("NODE_NAME", "") or socket.gethostname()
+# 节点向协调服务批量汇报用量的间隔 (秒)；本地剩余租约不足一半时会提前汇报并申请
+COORDINATOR_SYNC_INTERVAL = float(os.getenv("COORDINATOR_SYNC_INTERVAL", 5))
+# 每次申请的租约大小 (MB)
+COORDINATOR_LEASE_MB = int(os.getenv("COORDINATOR_LEASE_MB", 1024))
+COORDINATOR_LEASE_BYTES = COORDINATOR_LEASE_MB * 1024 * 1024
+# 超过该时长 (秒) 联系不上协调服务时进入降级模式，只在已获得的租约之外再使用 COORDINATOR_FALLBACK_MB
+COORDINATOR_TIMEOUT = float(os.getenv("COORDINATOR_TIMEOUT", 30))
+COORDINATOR_FALLBACK_MB = int(os.getenv("COORDINATOR_FALLBACK_MB", 256))
+COORDINATOR_FALLBACK_BYTES = COORDINATOR_FALLBACK_MB * 1024 * 1024
+# 以下为协调服务自身的设置：监听地址和端口、全局每日上限 (GB)，重置时间沿用 RESET_TIME
+COORDINATOR_HOST = os.getenv("COORDINATOR_HOST", "0.0.0.0")
+COORDINATOR_PORT = int(os.getenv("COORDINATOR_PORT", 8731))
+COORDINATOR_LIMIT_GB = float(os.getenv("COORDINATOR_LIMIT_GB", DOWNLOAD_LIMIT_GB))
+# 节点超过该时长 (秒) 没有汇报时视为失联，不再计入活动节点数；节点端同时作废尚未用完的租约。
+# 必须大于 COORDINATOR_TIMEOUT 加一个汇报间隔，保证节点先进入降级模式
+COORDINATOR_NODE_TIMEOUT = max(float(os.getenv("COORDINATOR_NODE_TIMEOUT", 120)),
+                               COORDINATOR_TIMEOUT + COORDINATOR_SYNC_INTERVAL + 1)
+# 协调服务的状态文件 (全局用量和各节点租约)，重启后继续当前周期
+COORDINATOR_STATE_FILE = "/app/data/coordinator_state.json"
+
+# 15. 剖析模式
+# 设为 1 (或使用 python main.py --profile) 时记录各热路径阶段的耗时直方图，退出时打印汇总报告
+PROFILE = os.getenv("PROFILE", "0").lower() in ('1', 'true', 'yes')
+# 各进程的剖析数据和报告的存放目录，每次启动时清空
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/app/data/profile")
+# 调用栈采样间隔 (秒，按进程 CPU 时间计)，例如 0.01；0 表示只记录阶段耗时，不采样
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", 0))
+
+# 16. 流量计量
+# "payload": 按应用层收到的负载字节计入每日配额 (默认)
+# "interface": 由控制器定期读取网卡的内核计数，按线路上的实际流量 (含 TLS、协议头、重传和 BitTorrent 协议开销) 计入配额，
+#              工作进程不再逐块上报下载量
+ACCOUNTING_MODE = os.getenv("ACCOUNTING_MODE", "payload").lower()
+# 计量的网卡，留空表示默认路由所在的网卡；payload 模式下设置该项时只采样，与负载字节数并列报告，不计入配额
+ACCOUNTING_INTERFACE = os.getenv("ACCOUNTING_INTERFACE", "")
+# 计入的方向："rx" 只计下行 (默认)；"both" 同时计入上行
+ACCOUNTING_DIRECTION = os.getenv("ACCOUNTING_DIRECTION", "rx").lower()
+# 网卡计数的来源，可指向 /proc/<pid>/net/dev 统计其他网络命名空间 (容器内默认就是容器自己的网络命名空间)
+ACCOUNTING_NET_DEV = os.getenv("ACCOUNTING_NET_DEV", "/proc/net/dev")
+# 采样间隔 (秒)；接近配额上限时按当前速率自动缩短
+ACCOUNTING_INTERVAL = float(os.getenv("ACCOUNTING_INTERVAL", 1))
@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+"""
+多节点共享配额的协调服务。
+
+多台主机共享一个上游流量预算时，由协调服务持有全局每日配额，按租约分配给各节点：
+- 节点每隔 COORDINATOR_SYNC_INTERVAL 秒 (或本地剩余租约不足一半时) 汇报一次本周期的累计下载量，
+  同时把租约补足到 COORDINATOR_LEASE_MB，不会逐块通信。汇报的是累计值，请求重试不会重复计数。
+- 节点在本地把 "已下载量 + 剩余租约" 作为配额上限 (并且不超过本机的 DOWNLOAD_LIMIT_GB)，
+  因此全局总下载量不会超过协调服务的上限。
+- 协调服务可以广播暂停/恢复，节点通过长轮询 /watch 及时收到。
+- 联系不上协调服务超过 COORDINATOR_TIMEOUT 秒时，节点进入降级模式：
+  只在已获得的租约之外再使用 COORDINATOR_FALLBACK_MB，恢复联系后自动退出。
+- 失联超过 COORDINATOR_NODE_TIMEOUT 秒后，节点作废尚未用完的租约，只在最后一次同步的用量之外再使用
+  COORDINATOR_FALLBACK_MB。协调服务不会把失联节点的租约转给其他节点 (节点可能已经用掉了其中一部分)，
+  直到节点恢复汇报、按实际用量结算，或每日重置。
+- 每日重置沿用 RESET_TIME，协调服务和各节点各自按本地时钟重置。
+
+运行协调服务和管理命令：
+    python -m coordinator serve [--port 8731] [--limit-gb 500]
+    python -m coordinator status|pause|resume [--url http://host:8731]
+"""
+
+import json
+import time
+import logging
+import argparse
+import threading
+import urllib.request
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import config
+from journal import atomic_write_text
+from schedule_engine import get_schedule
+
+logger = logging.getLogger(__name__)
+
+# 长轮询 /watch 的最长等待时间 (秒)
+WATCH_TIMEOUT = 25.0
+# 普通请求的超时时间 (秒)
+REQUEST_TIMEOUT = 5.0
+# 协调服务把状态写入文件的间隔 (秒)
+SAVE_INTERVAL = 10.0
+# 节点提前这么多秒作废失联期间的租约，覆盖同步线程的检查间隔和控制器收紧配额所需的时间
+LEASE_EXPIRY_MARGIN = 2.0
+
+
+# ---- 协调服务 ----
+
+class CoordinatorServer:
+    """
+    持有全局配额的协调服务，基于标准库 http.server，每个请求在独立线程中处理。
+
+    - POST /sync    节点汇报 {node, used, reset, want}，返回本节点的剩余租约和全局状态
+    - GET  /watch   长轮询，参数 version、timeout；暂停状态变化或超时后返回
+    - GET  /status  全局用量和各节点状态 (JSON)
+    - POST /pause、POST /resume  广播暂停/恢复
+    """
+    def __init__(self, limit_bytes=None, port=None, host=None, state_file=None, node_timeout=None):
+        self._limit = config.COORDINATOR_LIMIT_GB * (1024 ** 3) if limit_bytes is None else limit_bytes
+        self._address = (host or config.COORDINATOR_HOST, config.COORDINATOR_PORT if port is None else port)
+        self._state_file = state_file or config.COORDINATOR_STATE_FILE
+        self._node_timeout = config.COORDINATOR_NODE_TIMEOUT if node_timeout is None else node_timeout
+        self._cond = threading.Condition()
+        self._period = None     # 当前周期开始的重置时间 (时间戳)
+        self._epoch = 0
+        self._nodes = {}        # 节点名 -> {'used', 'granted', 'reported', 'node_reset', 'seen'}
+        self._paused = False
+        self._version = 0       # 暂停状态每变化一次加一
+        self._dirty = False
+        self._server = None
+        self._stopped = threading.Event()
+        self._load()
+
+    # -- 配额 --
+
+    def _roll(self):
+        """调用方必须持有 self._cond。越过每日重置时间后开始新的周期"""
+        period = get_schedule().previous_reset(datetime.now()).timestamp()
+        if period == self._period:
+            return
+        if self._period is not None:
+            logger.info("已到达每日重置时间，全局用量和各节点租约已清零。")
+        self._period = period
+        self._epoch += 1
+        for node in self._nodes.values():
+            node['used'] = node['granted'] = 0.0
+        self._dirty = True
+
+    def _available(self):
+        """
+        调用方必须持有 self._cond。返回尚未分配的配额。
+        失联节点的租约仍计为已分配：最后一次汇报之后它可能已经用掉了其中一部分，
+        转给其他节点会使全局用量超出上限。节点恢复汇报后按实际用量结算。
+        """
+        return self._limit - sum(max(node['granted'], node['used']) for node in self._nodes.values())
+
+    def sync(self, name, used, node_reset, want):
+        """
+        记录节点的用量并补足租约。
+
+        :param used: 节点本周期的累计下载量 (SharedState.get_bytes())
+        :param node_reset: 节点上次重置的时间，变化说明节点已重置，累计值从 0 开始
+        :param want: 节点希望持有的剩余租约大小
+        """
+        now = time.time()
+        with self._cond:
+            self._roll()
+            node = self._nodes.get(name)
+            if node is None:
+                node = self._nodes[name] = {'used': 0.0, 'granted': 0.0, 'reported': 0.0,
+                                            'node_reset': node_reset, 'seen': now}
+                logger.info(f"节点 {name} 已加入。")
+            delta = used if node_reset != node['node_reset'] else used - node['reported']
+            node['used'] += max(0.0, delta)
+            node['reported'] = used
+            node['node_reset'] = node_reset
+            node['seen'] = now
+
+            outstanding = max(0.0, node['granted'] - node['used'])
+            if want > outstanding:
+                grant = max(0.0, min(want - outstanding, self._available()))
+                node['granted'] = max(node['granted'], node['used']) + grant
+            self._dirty = True
+            return self._reply(node, now)
+
+    def _reply(self, node, now):
+        used = sum(n['used'] for n in self._nodes.values())
+        active = len([n for n in self._nodes.values() if now - n['seen'] <= self._node_timeout])
+        return {
+            'epoch': self._epoch,
+            'lease': max(0.0, node['granted'] - node['used']),
+            'paused': self._paused,
+            'version': self._version,
+            'limit': self._limit,
+            'used': used,
+            'remaining': max(0.0, self._limit - used),
+            'nodes': max(1, active),
+            'node_timeout': self._node_timeout,
+        }
+
+    def set_paused(self, paused):
+        with self._cond:
+            if self._paused != paused:
+                self._paused = paused
+                self._version += 1
+                self._dirty = True
+                self._cond.notify_all()
+                logger.info("已广播暂停。" if paused else "已广播恢复。")
+
+    def watch(self, version, timeout=WATCH_TIMEOUT):
+        """阻塞直到暂停状态的版本号不同于 version 或超时，返回 {'paused', 'version'}"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._version != version or self._stopped.is_set(),
+                                timeout=min(timeout, WATCH_TIMEOUT))
+            return {'paused': self._paused, 'version': self._version}
+
+    def info(self):
+        now = time.time()
+        with self._cond:
+            self._roll()
+            result = self._reply({'granted': 0.0, 'used': 0.0}, now)
+            del result['lease']
+            result['nodes'] = {name: {'used': node['used'],
+                                      'lease': max(0.0, node['granted'] - node['used']),
+                                      'last_seen': node['seen'],
+                                      'active': now - node['seen'] <= self._node_timeout}
+                               for name, node in self._nodes.items()}
+            return result
+
+    # -- 持久化 --
+
+    def _load(self):
+        try:
+            with open(self._state_file, 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {}
+        except (OSError, ValueError) as e:
+            logger.error(f"无法读取协调服务状态文件 {self._state_file}: {e}")
+            state = {}
+        with self._cond:
+            self._paused = state.get('paused', False)
+            self._roll()
+            if state.get('period') == self._period:
+                # 仍在同一个周期内，继续使用保存的用量和租约
+                self._epoch = state.get('epoch', self._epoch)
+                self._nodes = state.get('nodes', {})
+                logger.info(f"协调服务状态已加载：{len(self._nodes)} 个节点，"
+                            f"已用 {sum(n['used'] for n in self._nodes.values()) / (1024**3):.2f} GB")
+
+    def save(self):
+        with self._cond:
+            if not self._dirty:
+                return
+            data = json.dumps({'period': self._period, 'epoch': self._epoch,
+                               'paused': self._paused, 'nodes': self._nodes})
+            self._dirty = False
+        atomic_write_text(self._state_file, data)
+
+    def _save_loop(self):
+        while not self._stopped.wait(SAVE_INTERVAL):
+            try:
+                self.save()
+            except OSError as e:
+                logger.error(f"保存协调服务状态失败: {e}")
+
+    # -- HTTP --
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send_json(self, data):
+                body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+                if parts.path == '/watch':
+                    self._send_json(server.watch(int(query.get('version', -1)),
+                                                 float(query.get('timeout', WATCH_TIMEOUT))))
+                elif parts.path in ('/status', '/'):
+                    self._send_json(server.info())
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                path = urlsplit(self.path).path
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    body = json.loads(self.rfile.read(length) or b'{}')
+                    if path == '/sync':
+                        self._send_json(server.sync(str(body['node']), float(body['used']),
+                                                    float(body['reset']), float(body.get('want', 0))))
+                    elif path in ('/pause', '/resume'):
+                        server.set_paused(path == '/pause')
+                        self._send_json(server.info())
+                    else:
+                        self.send_error(404)
+                except (KeyError, ValueError) as e:
+                    logger.warning(f"无效的协调请求 {path}: {e}")
+                    self.send_error(400)
+
+            def log_message(self, format, *args):
+                logger.debug(f"协调服务请求: {format % args}")
+
+        self._server = ThreadingHTTPServer(self._address, Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="Coordinator", daemon=True).start()
+        threading.Thread(target=self._save_loop, name="CoordinatorSave", daemon=True).start()
+        logger.info(f"协调服务已启动: http://{self._address[0]}:{self._server.server_port}，"
+                    f"全局每日上限 {self._limit / (1024**3):.2f} GB")
+        return self
+
+    @property
+    def port(self):
+        return self._server.server_port if self._server else None
+
+    def stop(self):
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        try:
+            self.save()
+        except OSError as e:
+            logger.error(f"保存协调服务状态失败: {e}")
+
+
+# ---- 节点端 ----
+
+def _request(url, path, body=None, timeout=REQUEST_TIMEOUT):
+    data = None if body is None else json.dumps(body).encode('utf-8')
+    request = urllib.request.Request(f"{url}{path}", data=data, method='GET' if body is None else 'POST',
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.load(response)
+
+
+class CoordinatorClient:
+    """
+    节点端：在控制器进程的后台线程中与协调服务同步，控制器通过 limit_bytes()/is_paused() 读取结果。
+    状态变化 (获得新租约、暂停/恢复、进入降级模式、租约作废) 时唤醒控制器。
+    """
+    def __init__(self, shared_state, url=None, node=None, lease_bytes=None, sync_interval=None,
+                 timeout=None, fallback_bytes=None):
+        self._shared_state = shared_state
+        self._url = (url or config.COORDINATOR_URL).rstrip('/')
+        self._node = node or config.NODE_NAME
+        self._lease_bytes = config.COORDINATOR_LEASE_BYTES if lease_bytes is None else lease_bytes
+        self._sync_interval = config.COORDINATOR_SYNC_INTERVAL if sync_interval is None else sync_interval
+        self._timeout = config.COORDINATOR_TIMEOUT if timeout is None else timeout
+        self._fallback_bytes = config.COORDINATOR_FALLBACK_BYTES if fallback_bytes is None else fallback_bytes
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._base = 0.0            # 最近一次同步时本地的累计下载量
+        self._lease = 0.0           # 最近一次同步时剩余的租约
+        self._paused = False
+        self._version = -1
+        self._remaining = None      # 全局剩余配额
+        self._nodes = 1
+        self._last_success = None   # time.monotonic()
+        self._last_attempt = 0.0
+        # 最近一次成功同步的请求发出时间 (time.monotonic())。协调服务按收到请求的时间计算失联，
+        # 从发出时算起可以保证节点先于协调服务认定失联
+        self._contact = None
+        self._node_timeout = config.COORDINATOR_NODE_TIMEOUT
+        self._degraded = False
+        self._starved = False       # 上次同步时协调服务已无配额可分
+
+    def start(self):
+        """先同步一次 (失败则直接进入降级模式)，再启动后台线程"""
+        if not self._sync():
+            self._set_degraded(True)
+        threading.Thread(target=self._sync_loop, name="CoordinatorSync", daemon=True).start()
+        threading.Thread(target=self._watch_loop, name="CoordinatorWatch", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    # -- 供控制器读取 --
+
+    def limit_bytes(self, local_limit):
+        """
+        本节点当前可用的配额上限 (与 SharedState.get_bytes() 同一计量)，不超过本机上限 local_limit。
+        失联超过协调服务的节点超时后不再计入剩余租约，降级模式下只在最后一次同步的用量之外使用后备额度。
+        """
+        with self._lock:
+            limit = self._base
+            if self._lease_valid(time.monotonic()):
+                limit += self._lease
+            if self._degraded:
+                limit += self._fallback_bytes
+        return min(local_limit, limit)
+
+    def _lease_valid(self, now):
+        """调用方必须持有 self._lock"""
+        return self._contact is not None and now - self._contact < self._node_timeout - LEASE_EXPIRY_MARGIN
+
+    def is_paused(self):
+        return self._paused
+
+    def is_degraded(self):
+        return self._degraded
+
+    def pacing_remaining(self, local_remaining):
+        """匀速模式下本节点分摊的剩余配额：全局剩余配额按活动节点数平分，不超过本机剩余配额"""
+        with self._lock:
+            if self._remaining is None or self._degraded:
+                return local_remaining
+            return min(local_remaining, self._remaining / self._nodes)
+
+    def on_reset(self, bytes_before_reset):
+        """本地每日重置后调用：把同步基线换算到新周期的计量上，并尽快重新同步"""
+        with self._lock:
+            self._base -= bytes_before_reset
+        self._wake.set()
+
+    def kick(self):
+        """本地配额用完时由控制器调用，立即同步一次"""
+        self._wake.set()
+
+    def info(self):
+        with self._lock:
+            return {
+                'node': self._node,
+                'connected': not self._degraded,
+                'lease_bytes': self._lease,
+                'global_remaining_bytes': self._remaining,
+                'nodes': self._nodes,
+                'paused': self._paused,
+            }
+
+    # -- 后台线程 --
+
+    def _set_degraded(self, degraded):
+        if degraded == self._degraded:
+            return
+        with self._lock:
+            self._degraded = degraded
+        if degraded:
+            logger.warning(f"无法联系协调服务 {self._url}，进入降级模式："
+                           f"在已获得的租约之外最多再下载 {self._fallback_bytes / (1024**2):.0f} MB。")
+        else:
+            logger.info("已恢复与协调服务的联系，退出降级模式。")
+        self._shared_state.notify_controller()
+
+    def _apply_paused(self, paused, version):
+        self._version = version
+        if paused != self._paused:
+            self._paused = paused
+            logger.info("协调服务要求暂停下载。" if paused else "协调服务已解除暂停。")
+            self._shared_state.notify_controller()
+
+    def _sync(self):
+        """汇报本地累计用量并补足租约，返回是否成功"""
+        started = self._last_attempt = time.monotonic()
+        used = self._shared_state.get_bytes()
+        node_reset = self._shared_state.get_last_reset_time()
+        try:
+            reply = _request(self._url, '/sync', {'node': self._node, 'used': used,
+                                                  'reset': node_reset, 'want': self._lease_bytes})
+        except (OSError, ValueError) as e:
+            logger.debug(f"与协调服务同步失败: {e}")
+            return False
+        if self._shared_state.get_last_reset_time() != node_reset:
+            # 请求期间发生了本地重置，这次的基线已经过时，稍后重新同步
+            self._wake.set()
+            return True
+        with self._lock:
+            old_limit = self._base + self._lease
+            self._base = used
+            self._lease = reply['lease']
+            self._remaining = reply['remaining']
+            self._nodes = reply['nodes']
+            self._starved = reply['lease'] < self._lease_bytes / 2
+            self._contact = started
+            self._node_timeout = reply.get('node_timeout', self._node_timeout)
+        self._last_success = time.monotonic()
+        self._set_degraded(False)
+        self._apply_paused(reply['paused'], reply['version'])
+        if used + reply['lease'] != old_limit:
+            self._shared_state.notify_controller()
+        return True
+
+    def _sync_loop(self):
+        while not self._stopped.is_set():
+            woken = self._wake.wait(1.0)
+            self._wake.clear()
+            self._step(woken)
+
+    def _step(self, woken=False):
+        """同步线程的一轮检查：按需同步，联系不上时进入降级模式并在节点超时前作废租约"""
+        now = time.monotonic()
+        with self._lock:
+            low = self._base + self._lease - self._shared_state.get_bytes() < self._lease_bytes / 2
+        # 定期汇报；剩余租约不足一半时提前申请 (联系不上或全局配额已分完时按正常间隔重试)
+        early = low and not self._degraded and not self._starved
+        if woken or now - self._last_attempt >= self._sync_interval or early:
+            if not self._sync():
+                last = self._last_success
+                if last is None or time.monotonic() - last >= self._timeout:
+                    self._set_degraded(True)
+        with self._lock:
+            expired = self._lease > 0 and not self._lease_valid(time.monotonic())
+            if expired:
+                self._lease = 0.0
+        if expired:
+            logger.warning(f"与协调服务失联已超过 {self._node_timeout:.0f} 秒，作废尚未用完的租约。")
+            self._set_degraded(True)
+            self._shared_state.notify_controller()
+
+    def _watch_loop(self):
+        while not self._stopped.is_set():
+            try:
+                reply = _request(self._url, f"/watch?version={self._version}&timeout={WATCH_TIMEOUT:.0f}",
+                                 timeout=WATCH_TIMEOUT + REQUEST_TIMEOUT)
+                self._apply_paused(reply['paused'], reply['version'])
+            except (OSError, ValueError):
+                self._stopped.wait(self._sync_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多节点共享配额的协调服务")
+    sub = parser.add_subparsers(dest='command', required=True)
+    serve = sub.add_parser('serve', help="运行协调服务")
+    serve.add_argument('--host', default=None)
+    serve.add_argument('--port', type=int, default=None)
+    serve.add_argument('--limit-gb', type=float, default=None, help="全局每日上限 (GB)")
+    serve.add_argument('--state-file', default=None)
+    for command, help_text in (('status', "查看全局用量和各节点状态"), ('pause', "广播暂停"), ('resume', "广播恢复")):
+        cmd = sub.add_parser(command, help=help_text)
+        cmd.add_argument('--url', default=None, help="协调服务地址，默认使用 COORDINATOR_URL")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=config.LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.command == 'serve':
+        limit = None if args.limit_gb is None else args.limit_gb * (1024 ** 3)
+        server = CoordinatorServer(limit, args.port, args.host, args.state_file).start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.stop()
+        return
+
+    url = (args.url or config.COORDINATOR_URL or f"http://127.0.0.1:{config.COORDINATOR_PORT}").rstrip('/')
+    path = '/status' if args.command == 'status' else f"/{args.command}"
+    print(json.dumps(_request(url, path, None if args.command == 'status' else {}), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
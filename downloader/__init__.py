@@ -1,4 +1,11 @@
 # -*- coding: utf-8 -*-
 
+from .result import DownloadResult
 from .http_downloader import download_http
+from .segmented_downloader import download_http_segmented
+from .async_http_downloader import download_http_async
+from .raw_http_downloader import download_http_raw
 from .torrent_downloader import download_torrent
+from .torrent_engine import TorrentEngine
+from .torrent_storage import TorrentStorage
+from .torrent_cache import TorrentCache
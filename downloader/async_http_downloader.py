@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import ssl
+import time
+import threading
+import logging
+from urllib.parse import urlsplit, urljoin
+
+import profiling
+from config import CHUNK_SIZE
+from .result import DownloadResult
+
+logger = logging.getLogger(__name__)
+
+MAX_REDIRECTS = 5
+READ_TIMEOUT = 30
+
+
+class AsyncHTTPError(Exception):
+    """HTTP 状态码错误或协议错误"""
+
+
+_ssl_context = None
+
+def _get_ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+_resume_events = {}
+
+def _get_resume_event(shared_state):
+    """
+    返回当前事件循环的 asyncio.Event，执行恢复时被置位。
+    由一个后台线程阻塞等待共享状态的暂停/恢复事件，再转发到事件循环中，
+    同一进程内所有流共用这一个 Event。
+    """
+    loop = asyncio.get_running_loop()
+    event = _resume_events.get(loop)
+    if event is None:
+        event = _resume_events[loop] = asyncio.Event()
+        threading.Thread(target=_watch_pause, args=(shared_state, loop, event), daemon=True).start()
+    return event
+
+
+def _watch_pause(shared_state, loop, event):
+    try:
+        while True:
+            if shared_state.is_paused():
+                loop.call_soon_threadsafe(event.clear)
+                shared_state.wait_until_resumed()
+            else:
+                loop.call_soon_threadsafe(event.set)
+                shared_state.wait_until_paused()
+    except RuntimeError:
+        # 事件循环已关闭
+        _resume_events.pop(loop, None)
+
+
+async def _open(url):
+    """建立连接并发送 GET 请求，返回 (reader, writer, status, headers)"""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        raise AsyncHTTPError(f"不支持的协议: {parts.scheme}")
+    secure = parts.scheme == 'https'
+    port = parts.port or (443 if secure else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parts.hostname, port, ssl=_get_ssl_context() if secure else None,
+                                limit=CHUNK_SIZE),
+        READ_TIMEOUT,
+    )
+    request = (
+        f"GET {path} HTTP/1.1\r\n"
+        f"Host: {parts.netloc}\r\n"
+        "User-Agent: TideFlowControl\r\n"
+        "Accept: */*\r\n"
+        "Accept-Encoding: identity\r\n"
+        "Connection: close\r\n\r\n"
+    )
+    writer.write(request.encode('latin-1'))
+    await writer.drain()
+
+    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), READ_TIMEOUT)
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        status = int(lines[0].split(' ', 2)[1])
+    except (IndexError, ValueError):
+        raise AsyncHTTPError(f"无效的状态行: {lines[0]!r}")
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    return reader, writer, status, headers
+
+
+async def _reserve_quota(shared_state, want):
+    """异步版本的 SharedState.wait_for_quota：配额用完时等待控制器暂停，再等待恢复"""
+    while True:
+        granted = shared_state.acquire_quota(want)
+        if granted:
+            return granted
+        for _ in range(20):
+            if shared_state.is_paused():
+                break
+            await asyncio.sleep(0.05)
+        await _get_resume_event(shared_state).wait()
+
+
+async def _read(reader, want, shared_state):
+    """先预留配额，再读取不超过预留量的数据"""
+    granted = await _reserve_quota(shared_state, want)
+    with profiling.stage('http.recv'):
+        data = await asyncio.wait_for(reader.read(granted), READ_TIMEOUT)
+    shared_state.release_quota(granted - len(data))
+    return data
+
+
+async def _iter_body(reader, headers, shared_state):
+    """按 Content-Length、chunked 或读到连接关闭三种方式逐块产出响应体，读取受配额租约约束"""
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        while True:
+            size_line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+            try:
+                size = int(size_line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise AsyncHTTPError(f"无效的分块长度: {size_line!r}")
+            if size == 0:
+                return
+            while size > 0:
+                data = await _read(reader, min(size, CHUNK_SIZE), shared_state)
+                if not data:
+                    raise AsyncHTTPError("分块数据提前结束")
+                size -= len(data)
+                yield data
+            await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+    elif 'content-length' in headers:
+        remaining = int(headers['content-length'])
+        while remaining > 0:
+            data = await _read(reader, min(remaining, CHUNK_SIZE), shared_state)
+            if not data:
+                raise AsyncHTTPError("连接在响应体结束前关闭")
+            remaining -= len(data)
+            yield data
+    else:
+        while True:
+            data = await _read(reader, CHUNK_SIZE, shared_state)
+            if not data:
+                return
+            yield data
+
+
+async def download_http_async(url: str, shared_state, stream_id: str):
+    """
+    执行单个HTTP下载任务的协程，多个协程在同一个工作进程内并发运行。
+
+    :param url: 要下载的文件的URL
+    :param shared_state: 共享状态对象
+    :param stream_id: 当前流的ID ("进程ID.流序号")，用于日志记录和速度汇报
+    :return: DownloadResult
+    """
+    logger.info(f"[流-{stream_id}] 开始 HTTP 下载: {url}")
+    start_time = time.time()
+    bytes_downloaded_session = 0
+    ttfb = None
+    writer = None
+    try:
+        for _ in range(MAX_REDIRECTS + 1):
+            with profiling.stage('http.connect'):
+                reader, writer, status, headers = await _open(url)
+            if status in (301, 302, 303, 307, 308) and 'location' in headers:
+                writer.close()
+                url = urljoin(url, headers['location'])
+                continue
+            break
+        else:
+            raise AsyncHTTPError("重定向次数过多")
+        if status >= 400:
+            raise AsyncHTTPError(f"{status} 错误: {url}")
+
+        last_report_time = time.time()
+        bytes_since_last_report = 0
+
+        async for chunk in _iter_body(reader, headers, shared_state):
+            # 1. 检查是否需要暂停，暂停期间等待恢复事件
+            if shared_state.is_paused():
+                shared_state.update_speed(stream_id, 0) # 暂停时速度为0
+                await _get_resume_event(shared_state).wait()
+                last_report_time = time.time() # 重置计时器
+
+            # 2. 更新共享的下载总量，并按全局速率上限限速
+            if ttfb is None:
+                ttfb = time.time() - start_time
+                profiling.record('http.ttfb', ttfb)
+            chunk_len = len(chunk)
+            shared_state.add_bytes(chunk_len)
+            delay = shared_state.reserve_bandwidth(chunk_len)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            bytes_downloaded_session += chunk_len
+            bytes_since_last_report += chunk_len
+
+            # 3. 定期计算并汇报速度
+            current_time = time.time()
+            if current_time - last_report_time >= 2: # 每2秒汇报一次
+                duration = current_time - last_report_time
+                speed_mbps = (bytes_since_last_report / (1024*1024)) / duration
+                shared_state.update_speed(stream_id, speed_mbps)
+                last_report_time = current_time
+                bytes_since_last_report = 0
+
+        # 下载结束，将自己的速度清零
+        shared_state.update_speed(stream_id, 0)
+        duration = time.time() - start_time
+        if duration > 0:
+            speed_mbps = (bytes_downloaded_session * 8) / (duration * 1024 * 1024)
+            logger.info(f"[流-{stream_id}] 完成下载: {url}。"
+                         f"已下载 {bytes_downloaded_session / (1024*1024):.2f} MB "
+                         f"用时 {duration:.2f}秒。平均速度: {speed_mbps:.2f} Mbps")
+        else:
+            logger.info(f"[流-{stream_id}] 瞬间完成下载: {url}。")
+        return DownloadResult(True, bytes_downloaded_session, duration, ttfb)
+
+    except (AsyncHTTPError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError) as e:
+        shared_state.update_speed(stream_id, 0)
+        logger.error(f"[流-{stream_id}] HTTP 下载错误 ({url}): {e}")
+    except Exception as e:
+        shared_state.update_speed(stream_id, 0)
+        logger.error(f"[流-{stream_id}] HTTP 下载期间发生意外错误 ({url}): {e}")
+    finally:
+        if writer is not None:
+            writer.close()
+    return DownloadResult(False, bytes_downloaded_session, time.time() - start_time, ttfb)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import select
+import socket
+import ssl
+import logging
+from collections import deque
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class DNSCache:
+    """进程内的 DNS 缓存，按 TTL 过期"""
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._entries = {}
+
+    def resolve(self, host, port, on_stat=None):
+        key = (host, port)
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is not None and entry[0] > now:
+            if on_stat:
+                on_stat('dns_cache_hits')
+            return entry[1]
+        addrs = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        if on_stat:
+            on_stat('dns_lookups')
+        if self._ttl > 0:
+            self._entries[key] = (now + self._ttl, addrs)
+        return addrs
+
+    def invalidate(self, host, port):
+        self._entries.pop((host, port), None)
+
+
+class ConnectionPool:
+    """
+    每个工作进程内的持久连接池，按 (协议, 主机, 端口) 分组保存空闲的长连接。
+
+    - 空闲时间超过 idle_timeout 或已被服务器关闭的连接在取出时丢弃。
+    - 新建 TLS 连接时复用该主机上一次的 TLS 会话，以跳过完整握手。
+    - 连接建立、复用、TLS 会话恢复、DNS 查询等计数通过 on_stat 回调上报。
+    """
+    def __init__(self, max_per_host, idle_timeout, dns_ttl, tls_resumption=True):
+        self._max_per_host = max_per_host
+        self._idle_timeout = idle_timeout
+        self._tls_resumption = tls_resumption
+        self._dns = DNSCache(dns_ttl)
+        self._idle = {}
+        self._tls_sessions = {}
+        self._ssl_context = ssl.create_default_context()
+        self.on_stat = None
+
+    def _stat(self, name):
+        if self.on_stat:
+            self.on_stat(name)
+
+    def get_idle(self, key):
+        """
+        取出一个可用的空闲连接，没有则返回 None。
+        取出时还不计为复用：调用方读到响应状态行后用 reuse_result() 上报结果。
+        """
+        idle = self._idle.get(key)
+        now = time.monotonic()
+        while idle:
+            conn, released_at = idle.pop()
+            if now - released_at > self._idle_timeout or not _is_idle_alive(conn.sock):
+                conn.close()
+                self._stat('conn_expired')
+                continue
+            return conn
+        return None
+
+    def reuse_result(self, ok):
+        """上报 get_idle() 取出的连接是否成功承载了请求；失败的连接按已过期计数"""
+        self._stat('conn_reused' if ok else 'conn_expired')
+
+    def release(self, key, conn):
+        """响应读取完毕后把连接放回池中"""
+        if self._tls_resumption and isinstance(conn.sock, ssl.SSLSocket):
+            # TLS 1.3 的会话票据在握手后才到达，读取完响应后再保存
+            self._tls_sessions[key] = conn.sock.session
+        idle = self._idle.setdefault(key, deque())
+        if len(idle) >= self._max_per_host:
+            conn.close()
+            return
+        idle.append((conn, time.monotonic()))
+
+    def connect(self, key, timeout):
+        """新建一条到 key 的连接，返回 socket (https 时为 SSLSocket)"""
+        scheme, host, port = key
+        addrs = self._dns.resolve(host, port, self._stat)
+        sock = None
+        last_error = None
+        for family, socktype, proto, _, sockaddr in addrs:
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.settimeout(timeout)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.connect(sockaddr)
+                break
+            except OSError as e:
+                last_error = e
+                sock.close()
+                sock = None
+        if sock is None:
+            # 缓存的地址全部不可用时，下次重新解析
+            self._dns.invalidate(host, port)
+            raise last_error or OSError(f"无法解析主机: {host}")
+        self._stat('conn_created')
+
+        if scheme == 'https':
+            session = self._tls_sessions.get(key) if self._tls_resumption else None
+            try:
+                sock = self._ssl_context.wrap_socket(sock, server_hostname=host, session=session)
+            except BaseException:
+                sock.close()
+                raise
+            if sock.session_reused:
+                self._stat('tls_resumed')
+        return sock
+
+    def clear(self):
+        for idle in self._idle.values():
+            for conn, _ in idle:
+                conn.close()
+        self._idle.clear()
+
+
+def _is_idle_alive(sock):
+    """空闲连接上不应有可读数据；可读意味着服务器已关闭连接 (或发送了意外数据)"""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+
+_pool = None
+
+def get_pool():
+    """返回当前进程的连接池 (fork 后子进程会重新创建)"""
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(
+            config.HTTP_POOL_SIZE,
+            config.HTTP_POOL_IDLE_TIMEOUT,
+            config.DNS_CACHE_TTL,
+            config.TLS_SESSION_RESUMPTION,
+        )
+    return _pool
+
+
+def _reset_pool_after_fork():
+    global _pool
+    _pool = None
+
+os.register_at_fork(after_in_child=_reset_pool_after_fork)
@@ -1,12 +1,83 @@
 # -*- coding: utf-8 -*-
 
+import os
 import time
 import requests
 import logging
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, DecodeError, ReadTimeoutError, SSLError
+
+import config
+import profiling
 from config import CHUNK_SIZE
+from .result import DownloadResult
 
 logger = logging.getLogger(__name__)
 
+_session = None
+_session_last_used = 0.0
+
+
+def _get_session():
+    """
+    返回当前进程复用的 requests.Session，连接池在多个下载任务之间保持长连接。
+    空闲超过 HTTP_POOL_IDLE_TIMEOUT 后重建会话，避免复用早已被服务器关闭的连接。
+    """
+    global _session, _session_last_used
+    now = time.monotonic()
+    if _session is not None and now - _session_last_used > config.HTTP_POOL_IDLE_TIMEOUT:
+        _session.close()
+        _session = None
+    if _session is None:
+        _session = requests.Session()
+        # 分段下载时同一主机上同时有 HTTP_SEGMENTS 个连接，连接池要能全部保留
+        pool_size = max(config.HTTP_POOL_SIZE, config.HTTP_SEGMENTS)
+        adapter = HTTPAdapter(pool_connections=config.HTTP_POOL_SIZE, pool_maxsize=pool_size)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    _session_last_used = now
+    return _session
+
+
+def _pool_counters(session):
+    """汇总 urllib3 连接池中的 (新建连接数, 请求数)"""
+    connections = requests_count = 0
+    # http:// 与 https:// 挂载的是同一个适配器，去重后再统计
+    for adapter in {id(a): a for a in session.adapters.values()}.values():
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests_count += pool.num_requests
+    return connections, requests_count
+
+
+def _read_chunk(r, amt):
+    """
+    读取响应体中不超过 amt 字节的下一块 (按内容编码解码)，读完时返回 None。
+    iter_content 每次固定读取一整块，配额只剩零头时会多读；这里的读取量由调用方按已获得的配额决定。
+    urllib3 的异常与 iter_content 一样转换为 requests 的异常。
+    """
+    try:
+        chunk = r.raw.read(amt, decode_content=True)
+    except ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except DecodeError as e:
+        raise requests.exceptions.ContentDecodingError(e)
+    except ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+    except SSLError as e:
+        raise requests.exceptions.SSLError(e)
+    return chunk or None
+
+
+def _reset_session_after_fork():
+    global _session
+    _session = None
+
+os.register_at_fork(after_in_child=_reset_session_after_fork)
+
 def download_http(url: str, shared_state, process_id: int):
     """
     执行单个HTTP下载任务的函数，设计为在单独的进程中运行。
@@ -14,32 +85,51 @@ def download_http(url: str, shared_state, process_id: int):
     :param url: 要下载的文件的URL
     :param shared_state: multiprocessing.Manager创建的共享状态对象
     :param process_id: 当前进程的ID，用于日志记录
+    :return: DownloadResult
     """
     logger.info(f"[进程-{process_id}] 开始 HTTP 下载: {url}")
     start_time = time.time()
+    bytes_downloaded_session = 0
+    ttfb = None
+    session = _get_session()
+    connections_before, requests_before = _pool_counters(session)
     try:
-        with requests.get(url, stream=True, timeout=30) as r:
+        with profiling.stage('http.connect'):
+            r = session.get(url, stream=True, timeout=30)
+        with r:
             r.raise_for_status()
             
-            bytes_downloaded_session = 0
             last_report_time = time.time()
             bytes_since_last_report = 0
 
-            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
-                # 1. 检查是否需要暂停
-                while shared_state.is_paused():
+            while True:
+                # 1. 检查是否需要暂停，暂停期间阻塞等待恢复事件
+                if shared_state.is_paused():
                     shared_state.update_speed(process_id, 0) # 暂停时速度为0
-                    time.sleep(1)
+                    shared_state.wait_until_resumed()
                     last_report_time = time.time() # 重置计时器
 
-                # 2. 更新共享的下载总量
+                # 2. 读取下一块之前先预留配额，配额用完时在此阻塞；读取量不超过预留量
+                granted = shared_state.wait_for_quota(CHUNK_SIZE)
+                with profiling.stage('http.recv'):
+                    chunk = _read_chunk(r, granted)
+                if chunk is None:
+                    shared_state.release_quota(granted)
+                    break
+
+                # 3. 归还未用完的预留，更新共享的下载总量，并按全局速率上限限速
+                shared_state.release_quota(granted - len(chunk))
                 if chunk:
+                    if ttfb is None:
+                        ttfb = time.time() - start_time
+                        profiling.record('http.ttfb', ttfb)
                     chunk_len = len(chunk)
                     shared_state.add_bytes(chunk_len)
+                    shared_state.throttle(chunk_len)
                     bytes_downloaded_session += chunk_len
                     bytes_since_last_report += chunk_len
 
-                # 3. 定期计算并汇报速度
+                # 4. 定期计算并汇报速度
                 current_time = time.time()
                 if current_time - last_report_time >= 2: # 每2秒汇报一次
                     duration = current_time - last_report_time
@@ -61,8 +151,16 @@ def download_http(url: str, shared_state, process_id: int):
                              f"用时 {duration:.2f}秒。平均速度: {speed_mbps:.2f} Mbps")
             else:
                 logger.info(f"[进程-{process_id}] 瞬间完成下载: {url}。")
+            return DownloadResult(True, bytes_downloaded_session, duration, ttfb)
 
     except requests.exceptions.RequestException as e:
         logger.error(f"[进程-{process_id}] HTTP 下载错误 ({url}): {e}")
     except Exception as e:
         logger.error(f"[进程-{process_id}] HTTP 下载期间发生意外错误 ({url}): {e}")
+    finally:
+        connections_after, requests_after = _pool_counters(session)
+        created = connections_after - connections_before
+        shared_state.add_stat('conn_created', created)
+        shared_state.add_stat('conn_reused', max(0, (requests_after - requests_before) - created))
+    shared_state.update_speed(process_id, 0)
+    return DownloadResult(False, bytes_downloaded_session, time.time() - start_time, ttfb)
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+from urllib.parse import urlsplit, urljoin
+
+import profiling
+from config import CHUNK_SIZE
+from .result import DownloadResult
+from .connection_pool import get_pool
+
+logger = logging.getLogger(__name__)
+
+MAX_REDIRECTS = 5
+READ_TIMEOUT = 30
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class RawHTTPError(Exception):
+    """HTTP 状态码错误或协议错误"""
+
+
+class _DiscardConnection:
+    """
+    一个只计数、不保留数据的 HTTP/1.1 连接。
+
+    整个连接只使用一块预分配的 bytearray，通过 socket.recv_into 写入，
+    响应体数据从不被复制成 bytes 对象，只统计其长度。
+    buf[pos:end] 是已接收但尚未解析的数据 (状态行、头部、分块长度行)。
+    """
+    def __init__(self, sock, buffer_size=CHUNK_SIZE):
+        self.sock = sock
+        self.buf = bytearray(max(buffer_size, MAX_HEADER_SIZE))
+        self.view = memoryview(self.buf)
+        self.pos = 0
+        self.end = 0
+
+    def close(self):
+        self.view.release()
+        self.sock.close()
+
+    def _fill(self):
+        """把未解析的数据移到缓冲区开头，再接收更多数据"""
+        if self.pos:
+            pending = self.end - self.pos
+            self.buf[:pending] = self.view[self.pos:self.end]
+            self.pos, self.end = 0, pending
+        if self.end >= len(self.buf):
+            raise RawHTTPError("响应头或分块长度行过长")
+        n = self.sock.recv_into(self.view[self.end:])
+        if n == 0:
+            raise RawHTTPError("连接在响应结束前关闭")
+        self.end += n
+
+    def _read_until(self, marker):
+        """返回直到 marker (包含) 的数据，只用于体积很小的头部和分块长度行"""
+        while True:
+            idx = self.buf.find(marker, self.pos, self.end)
+            if idx >= 0:
+                stop = idx + len(marker)
+                data = bytes(self.view[self.pos:stop])
+                self.pos = stop
+                return data
+            self._fill()
+
+    def read_head(self):
+        head = self._read_until(b'\r\n\r\n').decode('latin-1')
+        lines = head.split('\r\n')
+        try:
+            status = int(lines[0].split(' ', 2)[1])
+        except (IndexError, ValueError):
+            raise RawHTTPError(f"无效的状态行: {lines[0]!r}")
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        return status, headers
+
+    def _discard(self, limit, quota):
+        """
+        丢弃最多 limit 字节 (None 表示直到连接关闭)，逐次产出本次丢弃的字节数。
+        先消耗缓冲区中剩余的数据，之后直接 recv_into 到整个缓冲区。
+        给定 quota 时，每次接收前先预留配额，单次接收量不超过预留量。
+        """
+        buffered = self.end - self.pos
+        if buffered:
+            n = buffered if limit is None else min(buffered, limit)
+            self.pos += n
+            if limit is not None:
+                limit -= n
+            if quota is not None:
+                # 这部分数据已随响应头一起收到，只能事后计入配额
+                quota.acquire_quota(n)
+            yield n
+        size = len(self.buf)
+        while limit is None or limit > 0:
+            want = size if limit is None else min(size, limit)
+            granted = want
+            if quota is not None:
+                granted = quota.wait_for_quota(want)
+            n = self.sock.recv_into(self.view, granted)
+            if quota is not None:
+                quota.release_quota(granted - n)
+            if n == 0:
+                if limit is None:
+                    return
+                raise RawHTTPError("连接在响应体结束前关闭")
+            self.pos = self.end = 0
+            if limit is not None:
+                limit -= n
+            yield n
+
+    def iter_body(self, headers, quota=None):
+        """
+        按 Content-Length、chunked 或读到连接关闭三种方式，逐次产出响应体的字节数。
+        quota 为共享状态对象时，响应体的读取受配额租约约束。
+        """
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            while True:
+                size_line = self._read_until(b'\r\n')
+                try:
+                    size = int(size_line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise RawHTTPError(f"无效的分块长度: {size_line!r}")
+                if size == 0:
+                    # 跳过可能存在的 trailer，直到空行
+                    while self._read_until(b'\r\n') != b'\r\n':
+                        pass
+                    return
+                yield from self._discard(size, quota)
+                self._read_until(b'\r\n')
+        elif 'content-length' in headers:
+            yield from self._discard(int(headers['content-length']), quota)
+        else:
+            yield from self._discard(None, quota)
+
+
+def _request(url, shared_state):
+    """
+    通过连接池发送 GET 请求，返回 (conn, key, status, headers)。
+    复用的空闲连接可能已被服务器悄悄关闭，这种情况下换一条新连接重试一次。
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        raise RawHTTPError(f"不支持的协议: {parts.scheme}")
+    secure = parts.scheme == 'https'
+    key = (parts.scheme, parts.hostname, parts.port or (443 if secure else 80))
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    request = (
+        f"GET {path} HTTP/1.1\r\n"
+        f"Host: {parts.netloc}\r\n"
+        "User-Agent: TideFlowControl\r\n"
+        "Accept: */*\r\n"
+        "Accept-Encoding: identity\r\n"
+        "Connection: keep-alive\r\n\r\n"
+    ).encode('latin-1')
+
+    pool = get_pool()
+    pool.on_stat = shared_state.add_stat
+    conn = pool.get_idle(key)
+    if conn is not None:
+        try:
+            conn.sock.sendall(request)
+            status, headers = conn.read_head()
+        except (RawHTTPError, OSError):
+            conn.close()
+            pool.reuse_result(False)
+        else:
+            pool.reuse_result(True)
+            return conn, key, status, headers
+
+    sock = pool.connect(key, READ_TIMEOUT)
+    conn = _DiscardConnection(sock)
+    try:
+        sock.sendall(request)
+        status, headers = conn.read_head()
+    except BaseException:
+        conn.close()
+        raise
+    return conn, key, status, headers
+
+
+def _reusable(headers):
+    """响应体读完后连接能否放回连接池"""
+    if headers.get('connection', '').lower() == 'close':
+        return False
+    return 'content-length' in headers or 'chunked' in headers.get('transfer-encoding', '').lower()
+
+
+def download_http_raw(url: str, shared_state, process_id: int):
+    """
+    执行单个HTTP下载任务的函数，使用零拷贝的丢弃式接收路径。
+    与 download_http 行为一致，但绕过 requests/urllib3，响应体只计数不保留。
+
+    :param url: 要下载的文件的URL
+    :param shared_state: 共享状态对象
+    :param process_id: 当前进程的ID，用于日志记录
+    :return: DownloadResult
+    """
+    logger.info(f"[进程-{process_id}] 开始 HTTP 下载 (raw): {url}")
+    start_time = time.time()
+    bytes_downloaded_session = 0
+    ttfb = None
+    conn = None
+    try:
+        for _ in range(MAX_REDIRECTS + 1):
+            with profiling.stage('http.connect'):
+                conn, key, status, headers = _request(url, shared_state)
+            if status in (301, 302, 303, 307, 308) and 'location' in headers:
+                if _reusable(headers):
+                    for _ in conn.iter_body(headers):
+                        pass
+                    get_pool().release(key, conn)
+                else:
+                    conn.close()
+                conn = None
+                url = urljoin(url, headers['location'])
+                continue
+            break
+        else:
+            raise RawHTTPError("重定向次数过多")
+        if status >= 400:
+            raise RawHTTPError(f"{status} 错误: {url}")
+
+        last_report_time = time.time()
+        bytes_since_last_report = 0
+
+        for chunk_len in profiling.timed_iter('http.recv', conn.iter_body(headers, quota=shared_state)):
+            # 1. 检查是否需要暂停，暂停期间阻塞等待恢复事件
+            if shared_state.is_paused():
+                shared_state.update_speed(process_id, 0) # 暂停时速度为0
+                shared_state.wait_until_resumed()
+                last_report_time = time.time() # 重置计时器
+
+            # 2. 更新共享的下载总量，并按全局速率上限限速
+            if ttfb is None:
+                ttfb = time.time() - start_time
+                profiling.record('http.ttfb', ttfb)
+            shared_state.add_bytes(chunk_len)
+            shared_state.throttle(chunk_len)
+            bytes_downloaded_session += chunk_len
+            bytes_since_last_report += chunk_len
+
+            # 3. 定期计算并汇报速度
+            current_time = time.time()
+            if current_time - last_report_time >= 2: # 每2秒汇报一次
+                duration = current_time - last_report_time
+                speed_mbps = (bytes_since_last_report / (1024*1024)) / duration
+                shared_state.update_speed(process_id, speed_mbps)
+                last_report_time = current_time
+                bytes_since_last_report = 0
+
+        # 响应体已完整读取，连接可以留给下一个任务复用
+        if _reusable(headers):
+            get_pool().release(key, conn)
+            conn = None
+
+        # 下载结束，将自己的速度清零
+        shared_state.update_speed(process_id, 0)
+        duration = time.time() - start_time
+        if duration > 0:
+            speed_mbps = (bytes_downloaded_session * 8) / (duration * 1024 * 1024)
+            logger.info(f"[进程-{process_id}] 完成下载: {url}。"
+                         f"已下载 {bytes_downloaded_session / (1024*1024):.2f} MB "
+                         f"用时 {duration:.2f}秒。平均速度: {speed_mbps:.2f} Mbps")
+        else:
+            logger.info(f"[进程-{process_id}] 瞬间完成下载: {url}。")
+        return DownloadResult(True, bytes_downloaded_session, duration, ttfb)
+
+    except (RawHTTPError, OSError) as e:
+        shared_state.update_speed(process_id, 0)
+        logger.error(f"[进程-{process_id}] HTTP 下载错误 ({url}): {e}")
+    except Exception as e:
+        shared_state.update_speed(process_id, 0)
+        logger.error(f"[进程-{process_id}] HTTP 下载期间发生意外错误 ({url}): {e}")
+    finally:
+        if conn is not None:
+            conn.close()
+    return DownloadResult(False, bytes_downloaded_session, time.time() - start_time, ttfb)
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+from typing import NamedTuple, Optional
+
+
+class DownloadResult(NamedTuple):
+    """一次下载任务的结果，供任务调度器统计各来源的吞吐量和失败率"""
+    ok: bool
+    bytes: int
+    duration: float
+    ttfb: Optional[float] = None   # 从发起请求到收到第一个负载字节的秒数
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+from collections import deque
+
+import requests
+
+import config
+import profiling
+from config import CHUNK_SIZE
+from .http_downloader import download_http, _get_session, _pool_counters, _read_chunk
+from .result import DownloadResult
+
+logger = logging.getLogger(__name__)
+
+# 剩余不足该字节数的区间不再被拆分窃取
+MIN_STEAL_BYTES = 2 * CHUNK_SIZE
+# 每个文件允许的区间失败次数 = 连接数 × 该值，超过后放弃整个文件
+FAILURES_PER_SEGMENT = 2
+
+# 本进程中已知不支持 Range 请求的 URL，之后直接走单连接下载，不再发送 HEAD
+_no_range_urls = set()
+
+# 共享状态的进程内计量状态 (字节槽的读改写、告警线累计、令牌桶的本地额度) 按单线程设计，
+# 分段下载的多个连接线程在此锁内串行更新；配额租约的本地额度由 QuotaAllocator 自己的线程锁保护
+_accounting_lock = threading.Lock()
+
+
+class _RangeUnsupported(Exception):
+    pass
+
+
+class _Range:
+    """一个正在下载的字节区间 [pos, end)。end 可能因被其他连接窃取后半段而缩小"""
+    __slots__ = ('pos', 'end', 'started', 'start_pos')
+
+    def __init__(self, start, end):
+        self.pos = self.start_pos = start
+        self.end = end
+        self.started = time.monotonic()
+
+    def remaining(self):
+        return self.end - self.pos
+
+    def eta(self, now):
+        """按该区间到目前为止的速度估算剩余时间；尚无数据的区间视为最慢"""
+        elapsed = now - self.started
+        done = self.pos - self.start_pos
+        if done <= 0 or elapsed <= 0:
+            return float('inf')
+        return self.remaining() / (done / elapsed)
+
+
+class _RangeQueue:
+    """
+    待下载区间的队列。文件先按 HTTP_SEGMENT_SIZE 切成若干区间；队列取空后，
+    空闲的连接从预计最晚完成的区间窃取后半段，慢连接因此不会拖住整个文件。
+    """
+    def __init__(self, size, segment_size, max_failures):
+        self._lock = threading.Lock()
+        self._pending = deque((start, min(size, start + segment_size)) for start in range(0, size, segment_size))
+        self._active = set()
+        self._failures = 0
+        self._max_failures = max_failures
+        self.steals = 0
+
+    def take(self):
+        """返回下一个要下载的区间；没有可下载或可窃取的区间时返回 None"""
+        with self._lock:
+            if self._pending:
+                rng = _Range(*self._pending.popleft())
+                self._active.add(rng)
+                return rng
+            now = time.monotonic()
+            candidates = [r for r in self._active if r.remaining() >= 2 * MIN_STEAL_BYTES]
+            if not candidates:
+                return None
+            victim = max(candidates, key=lambda r: r.eta(now))
+            middle = victim.pos + victim.remaining() // 2
+            rng = _Range(middle, victim.end)
+            victim.end = middle
+            self._active.add(rng)
+            self.steals += 1
+            return rng
+
+    def advance(self, rng, num_bytes):
+        """记录区间收到了 num_bytes 字节，返回该区间是否已经下载完毕"""
+        with self._lock:
+            rng.pos = min(rng.end, rng.pos + num_bytes)
+            return rng.pos >= rng.end
+
+    def finish(self, rng):
+        with self._lock:
+            self._active.discard(rng)
+
+    def fail(self, rng):
+        """把失败区间的剩余部分放回队列，返回是否还允许重试"""
+        with self._lock:
+            self._active.discard(rng)
+            self._failures += 1
+            if rng.remaining() > 0:
+                self._pending.append((rng.pos, rng.end))
+            return self._failures <= self._max_failures
+
+    def complete(self):
+        with self._lock:
+            return not self._pending and not self._active
+
+
+class _Progress:
+    def __init__(self, start_time):
+        self._lock = threading.Lock()
+        self.start_time = start_time
+        self.bytes = 0
+        self.ttfb = None
+
+    def add(self, num_bytes):
+        with self._lock:
+            if self.ttfb is None:
+                self.ttfb = time.time() - self.start_time
+                profiling.record('http.ttfb', self.ttfb)
+            self.bytes += num_bytes
+
+
+def _probe(session, url):
+    """
+    发送 HEAD 请求，返回 (最终 URL, 文件大小)；不支持 Range 时文件大小为 None。
+    其他错误状态 (例如 5xx、429) 可能只是暂时的，抛出 HTTPError，由调用方只对本次下载回退。
+    """
+    r = session.head(url, allow_redirects=True, timeout=30)
+    # 不接受 HEAD 的服务器 (405、501) 同样按不支持 Range 处理，交给单连接下载
+    if r.status_code in (405, 501):
+        return r.url, None
+    r.raise_for_status()
+    length = r.headers.get('Content-Length')
+    if r.headers.get('Accept-Ranges', '').lower() != 'bytes' or not length or not length.isdigit():
+        return r.url, None
+    return r.url, int(length)
+
+
+def _fetch_ranges(session, url, queue, shared_state, progress, abort):
+    """一个连接的执行体：不断从队列中取区间下载，直到队列取空或下载被放弃"""
+    while not abort.is_set():
+        rng = queue.take()
+        if rng is None:
+            return
+        try:
+            headers = {'Range': f'bytes={rng.pos}-{rng.end - 1}'}
+            with profiling.stage('http.connect'):
+                r = session.get(url, headers=headers, stream=True, timeout=30)
+            with r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise _RangeUnsupported()
+                finished = False
+                while not finished and not abort.is_set():
+                    if shared_state.is_paused():
+                        shared_state.wait_until_resumed()
+                    granted = shared_state.wait_for_quota(CHUNK_SIZE)
+                    with profiling.stage('http.recv'):
+                        chunk = _read_chunk(r, granted)
+                    if chunk is None:
+                        shared_state.release_quota(granted)
+                        break
+                    shared_state.release_quota(granted - len(chunk))
+                    if chunk:
+                        chunk_len = len(chunk)
+                        with _accounting_lock:
+                            shared_state.add_bytes(chunk_len)
+                            delay = shared_state.reserve_bandwidth(chunk_len)
+                        # 在锁外等待，限速时其他连接仍可计量
+                        if delay > 0:
+                            time.sleep(delay)
+                        progress.add(chunk_len)
+                        # 区间的后半段可能已被窃取，读到新的结束位置即关闭连接
+                        finished = queue.advance(rng, chunk_len)
+            if rng.remaining() > 0 and not abort.is_set():
+                raise IOError(f"区间 {rng.pos}-{rng.end - 1} 提前结束")
+            queue.finish(rng)
+        except _RangeUnsupported:
+            queue.finish(rng)
+            abort.set()
+            raise
+        except (requests.exceptions.RequestException, IOError) as e:
+            logger.warning(f"分段下载区间失败 ({url}): {e}")
+            if not queue.fail(rng):
+                abort.set()
+                return
+
+
+def download_http_segmented(url: str, shared_state, process_id: int):
+    """
+    多连接分段下载单个大文件。
+
+    先用 HEAD 检查 Accept-Ranges 和文件大小，把文件切成 HTTP_SEGMENT_SIZE 大小的区间，
+    由 HTTP_SEGMENTS 个连接并行下载；区间取完后空闲连接窃取慢区间的后半段。
+    HEAD 失败、不支持 Range (包括下载中途才发现服务器忽略了 Range) 或文件太小时回退到单连接的 download_http。
+
+    :param url: 要下载的文件的URL
+    :param shared_state: 共享状态对象
+    :param process_id: 当前进程的ID，用于日志记录
+    :return: DownloadResult
+    """
+    segment_size = config.HTTP_SEGMENT_SIZE
+    if url in _no_range_urls:
+        return download_http(url, shared_state, process_id)
+    session = _get_session()
+    try:
+        final_url, size = _probe(session, url)
+    except requests.exceptions.RequestException as e:
+        # 不记入 _no_range_urls：连接失败或 5xx、429 等状态可能只是暂时的，下次仍尝试分段下载
+        logger.warning(f"[进程-{process_id}] HEAD 请求失败，使用单连接下载 ({url}): {e}")
+        return download_http(url, shared_state, process_id)
+    if size is None:
+        logger.info(f"[进程-{process_id}] 服务器不支持 Range 请求，使用单连接下载: {url}")
+        _no_range_urls.add(url)
+        return download_http(url, shared_state, process_id)
+    if size < 2 * segment_size:
+        return download_http(url, shared_state, process_id)
+
+    # 连接数可以多于区间数，多出的连接一开始就会去窃取区间的后半段
+    num_connections = config.HTTP_SEGMENTS
+    logger.info(f"[进程-{process_id}] 开始分段下载: {url} "
+                f"({size / (1024*1024):.0f} MB，{num_connections} 个连接)")
+    start_time = time.time()
+    progress = _Progress(start_time)
+    queue = _RangeQueue(size, segment_size, num_connections * FAILURES_PER_SEGMENT)
+    abort = threading.Event()
+    errors = []
+    connections_before, requests_before = _pool_counters(session)
+
+    def run():
+        try:
+            _fetch_ranges(session, final_url, queue, shared_state, progress, abort)
+        except _RangeUnsupported as e:
+            errors.append(e)
+        except Exception as e:
+            logger.error(f"[进程-{process_id}] 分段下载期间发生意外错误 ({url}): {e}")
+            errors.append(e)
+            abort.set()
+
+    threads = [threading.Thread(target=run, name=f"Segment-{i}", daemon=True) for i in range(num_connections)]
+    for t in threads:
+        t.start()
+
+    # 等待所有连接结束，期间每 2 秒汇报一次本进程的总速度
+    last_report_time, last_report_bytes = time.time(), 0
+    while True:
+        alive = [t for t in threads if t.is_alive()]
+        if not alive:
+            break
+        alive[0].join(2)
+        current_time = time.time()
+        if current_time - last_report_time >= 2:
+            speed_mbps = ((progress.bytes - last_report_bytes) / (1024*1024)) / (current_time - last_report_time)
+            shared_state.update_speed(process_id, 0 if shared_state.is_paused() else speed_mbps)
+            last_report_time, last_report_bytes = current_time, progress.bytes
+    shared_state.update_speed(process_id, 0)
+
+    connections_after, requests_after = _pool_counters(session)
+    created = connections_after - connections_before
+    shared_state.add_stat('conn_created', created)
+    shared_state.add_stat('conn_reused', max(0, (requests_after - requests_before) - created))
+
+    duration = time.time() - start_time
+    if any(isinstance(e, _RangeUnsupported) for e in errors):
+        logger.info(f"[进程-{process_id}] 服务器忽略了 Range 请求，改用单连接重新下载: {url}")
+        _no_range_urls.add(url)
+        # 已收到的部分字节同样计入了下载量，一并计入本任务的结果
+        retry = download_http(url, shared_state, process_id)
+        return DownloadResult(retry.ok, progress.bytes + retry.bytes, time.time() - start_time,
+                              progress.ttfb if progress.ttfb is not None else retry.ttfb)
+    if not queue.complete():
+        logger.error(f"[进程-{process_id}] 分段下载失败 ({url})：已下载 {progress.bytes / (1024*1024):.2f} MB")
+        return DownloadResult(False, progress.bytes, duration, progress.ttfb)
+
+    speed_mbps = (progress.bytes * 8) / (duration * 1024 * 1024) if duration > 0 else 0.0
+    logger.info(f"[进程-{process_id}] 完成分段下载: {url}。"
+                f"已下载 {progress.bytes / (1024*1024):.2f} MB 用时 {duration:.2f}秒，"
+                f"窃取 {queue.steals} 次。平均速度: {speed_mbps:.2f} Mbps")
+    return DownloadResult(True, progress.bytes, duration, progress.ttfb)
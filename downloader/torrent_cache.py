@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import base64
+import logging
+from urllib.parse import urlsplit, parse_qs
+
+import config
+from journal import atomic_write_text
+
+logger = logging.getLogger(__name__)
+
+
+def info_hash(magnet_link):
+    """取出磁力链接 xt 参数中的 info-hash (base32 统一转换为小写十六进制)，无法识别时返回 None"""
+    for xt in parse_qs(urlsplit(magnet_link).query).get('xt', []):
+        prefix, _, value = xt.rpartition(':')
+        if prefix.lower() not in ('urn:btih', 'urn:btmh') or not value.isalnum():
+            continue
+        if prefix.lower() == 'urn:btih' and len(value) == 32:
+            try:
+                return base64.b32decode(value.upper()).hex()
+            except ValueError:
+                return None
+        return value.lower()
+    return None
+
+
+class TorrentCache:
+    """
+    按 info-hash 保存在 TORRENT_CACHE_DIR 中的磁力链接缓存，每个种子一个 JSON 文件：
+    - resume: libtorrent 的续传数据 (base64)，包含种子元数据 (info 字典)、tracker 和 DHT 节点
+    - peers: 曾经提供过负载的节点地址，最近的在前
+    - hits: 命中次数；文件的修改时间即最近一次使用的时间
+
+    再次下载同一链接时直接用续传数据和已知节点构造 add_torrent_params，跳过 DHT 查找和元数据下载。
+    负载在任务结束后即被丢弃，续传数据中的分片进度不会沿用，每次仍完整下载一遍。
+    超过 TORRENT_CACHE_MAX_AGE_DAYS 未使用的条目被删除，总大小超过上限时先淘汰最久未使用的条目。
+    多个进程可以同时使用同一个目录，每个文件都是原子替换的。
+    """
+    def __init__(self, root=None, max_bytes=None, max_age=None, max_peers=None, enabled=None):
+        self.enabled = config.TORRENT_CACHE if enabled is None else enabled
+        self.root = root or config.TORRENT_CACHE_DIR
+        self.max_bytes = config.TORRENT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_age = config.TORRENT_CACHE_MAX_AGE_DAYS * 86400 if max_age is None else max_age
+        self.max_peers = config.TORRENT_CACHE_MAX_PEERS if max_peers is None else max_peers
+
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.json")
+
+    def _read(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"磁力链接缓存条目损坏，已忽略 ({key}): {e}")
+            return None
+
+    def _write(self, key, entry):
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            atomic_write_text(self._path(key), json.dumps(entry))
+        except OSError as e:
+            logger.error(f"写入磁力链接缓存失败 ({key}): {e}")
+
+    def params(self, lt, magnet_link):
+        """
+        返回 (add_torrent_params, 是否命中缓存)。命中时参数中已带有种子元数据和已知节点，
+        未命中时与 lt.parse_magnet_uri 相同。
+        """
+        key = info_hash(magnet_link) if self.enabled else None
+        entry = self._read(key) if key else None
+        if not entry or not entry.get('resume'):
+            return lt.parse_magnet_uri(magnet_link), False
+        try:
+            params = lt.read_resume_data(base64.b64decode(entry['resume']))
+        except (RuntimeError, ValueError) as e:
+            logger.warning(f"磁力链接缓存中的续传数据无效，重新获取元数据 ({key}): {e}")
+            return lt.parse_magnet_uri(magnet_link), False
+        # 上次的负载已被丢弃，分片进度不能沿用，否则种子会被当作已经下载完成
+        params.have_pieces = []
+        params.verified_pieces = []
+        params.unfinished_pieces = {}
+        known = [tuple(peer) for peer in entry.get('peers', [])]
+        params.peers = (known + [peer for peer in params.peers if peer not in known])[:self.max_peers]
+        entry['hits'] = entry.get('hits', 0) + 1
+        self._write(key, entry)
+        return params, True
+
+    def request_save(self, lt, handle):
+        """元数据到达后请求续传数据，结果以 save_resume_data_alert 的形式送达，交给 store()"""
+        if self.enabled:
+            handle.save_resume_data(getattr(lt.torrent_handle, 'save_info_dict', 0))
+
+    def store(self, lt, magnet_link, alert):
+        """保存 save_resume_data_alert 中的续传数据，并按大小和时间淘汰旧条目"""
+        key = info_hash(magnet_link) if self.enabled else None
+        if not key:
+            return
+        entry = self._read(key) or {'created': time.time(), 'hits': 0, 'peers': []}
+        entry['name'] = alert.params.name
+        entry['resume'] = base64.b64encode(lt.write_resume_data_buf(alert.params)).decode('ascii')
+        self._write(key, entry)
+        self.evict()
+
+    def remember_peers(self, magnet_link, handle):
+        """任务结束、移除种子之前调用：记录本次提供过负载的节点"""
+        key = info_hash(magnet_link) if self.enabled else None
+        if not key:
+            return
+        peers = [tuple(p.ip) for p in handle.get_peer_info() if p.total_download > 0]
+        if not peers:
+            return
+        entry = self._read(key) or {'created': time.time(), 'hits': 0, 'peers': []}
+        merged = peers + [tuple(peer) for peer in entry.get('peers', []) if tuple(peer) not in peers]
+        entry['peers'] = [list(peer) for peer in merged[:self.max_peers]]
+        self._write(key, entry)
+
+    def evict(self, now=None):
+        """删除过期条目，并按最近使用时间淘汰，使缓存总大小不超过上限"""
+        now = time.time() if now is None else now
+        entries = []
+        try:
+            with os.scandir(self.root) as it:
+                for item in it:
+                    if item.name.endswith('.json'):
+                        st = item.stat()
+                        entries.append((st.st_mtime, st.st_size, item.path))
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            logger.debug(f"已淘汰磁力链接缓存条目: {os.path.basename(path)}")
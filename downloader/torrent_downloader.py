@@ -1,11 +1,36 @@
 # -*- coding: utf-8 -*-
 
+import os
 import time
+import threading
 import libtorrent as lt
 import logging
 
+import config
+import profiling
+from .result import DownloadResult
+from .torrent_cache import TorrentCache
+from .torrent_storage import TorrentStorage
+
 logger = logging.getLogger(__name__)
 
+
+def _watch_pause(shared_state, handle, done):
+    """
+    阻塞等待暂停事件并立即暂停种子：主循环可能正阻塞在 wait_for_alert 中 (最长 TORRENT_UPDATE_INTERVAL)。
+    种子暂停后产生的 torrent_paused_alert 会唤醒主循环，恢复仍由主循环负责。
+    """
+    while not done.is_set():
+        if not shared_state.wait_until_paused(timeout=1.0) or done.is_set():
+            continue
+        try:
+            handle.pause()
+        except RuntimeError:
+            # 任务刚结束，种子已被移除
+            return
+        shared_state.wait_until_resumed()
+
+
 def download_torrent(magnet_link: str, shared_state, process_id: int):
     """
     执行单个磁力链接下载任务的函数，设计为在单独的进程中运行。
@@ -13,50 +38,106 @@ def download_torrent(magnet_link: str, shared_state, process_id: int):
     :param magnet_link: 要下载的磁力链接
     :param shared_state: multiprocessing.Manager创建的共享状态对象
     :param process_id: 当前进程的ID，用于日志记录
+    :return: DownloadResult
     """
     logger.info(f"[进程-{process_id}] 开始 Torrent 下载: {magnet_link[:30]}...")
 
-    ses = lt.session({'listen_interfaces': '0.0.0.0:6881'})
-    params = lt.parse_magnet_uri(magnet_link)
-    # 将文件“下载”到内存中，避免写入磁盘
-    params.save_path = '/dev/shm' 
+    storage = TorrentStorage()
+    cache = TorrentCache()
+    settings = {
+        'listen_interfaces': '0.0.0.0:6881',
+        'alert_mask': (lt.alert.category_t.error_notification
+                       | lt.alert.category_t.status_notification
+                       | lt.alert.category_t.storage_notification
+                       | lt.alert.category_t.piece_progress_notification),
+    }
+    settings.update(storage.session_settings())
+    ses = lt.session(settings)
+    rate_limit = shared_state.get_rate_limit()
+    if rate_limit > 0:
+        # 单个会话不超过全局上限；实际下载量再计入共享令牌桶，由 HTTP 流让出带宽
+        ses.apply_settings({'download_rate_limit': int(rate_limit)})
+    # 下载过的链接直接使用缓存的元数据和已知节点，不再等待 DHT 查找和元数据下载
+    params, cached = cache.params(lt, magnet_link)
+    shared_state.add_stat('torrent_cache_hit' if cached else 'torrent_cache_miss')
+    if cached:
+        logger.info(f"[进程-{process_id}] 命中磁力链接缓存: {params.name}，已知节点 {len(params.peers)} 个。")
+    # 每个任务使用 tmpfs 上的独立目录，校验通过的分片随即释放，任务结束后删除
+    save_path = storage.save_path(f"task-{os.getpid()}-{int(time.time() * 1000)}")
+    params.save_path = save_path
     handle = ses.add_torrent(params)
+    done = threading.Event()
+    threading.Thread(target=_watch_pause, args=(shared_state, handle, done),
+                     name="TorrentPauseWatch", daemon=True).start()
 
     start_time = time.time()
     last_payload_download = 0
-    is_paused_by_controller = False
+    ttfb = None
+    # 最近一次有下载进度的时间，长时间没有进度的种子 (例如死链) 视为失败
+    last_progress = time.monotonic()
 
     try:
-        while not handle.status().is_seeding:
-            s = handle.status()
-            
-            # 1. 检查是否需要暂停或恢复
-            if shared_state.is_paused() and not is_paused_by_controller:
+        finished = False
+        next_update = 0.0
+        while not finished:
+            # 1. 检查是否需要暂停，暂停期间阻塞等待恢复事件
+            if shared_state.is_paused():
                 handle.pause()
-                is_paused_by_controller = True
+                shared_state.update_speed(process_id, 0)
                 logger.info(f"[进程-{process_id}] 暂停 Torrent 下载。")
-            elif not shared_state.is_paused() and is_paused_by_controller:
+                shared_state.wait_until_resumed()
                 handle.resume()
-                is_paused_by_controller = False
+                last_progress = time.monotonic()
                 logger.info(f"[进程-{process_id}] 恢复 Torrent 下载。")
 
-            # 如果被控制器暂停，则在此处循环等待
-            if is_paused_by_controller:
-                time.sleep(1)
-                continue
+            # 2. 定期请求状态更新，并在一次等待中处理所有事件
+            now = time.monotonic()
+            if now >= next_update:
+                with profiling.stage('torrent.update'):
+                    ses.post_torrent_updates()
+                next_update = now + config.TORRENT_UPDATE_INTERVAL
+            ses.wait_for_alert(int(max(0.0, next_update - time.monotonic()) * 1000))
 
-            # 2. 更新共享的下载总量
-            current_download = s.total_done
-            if current_download > last_payload_download:
-                delta = current_download - last_payload_download
-                shared_state.add_bytes(delta)
-                last_payload_download = current_download
+            alerts_start = time.perf_counter()
+            for alert in ses.pop_alerts():
+                if isinstance(alert, lt.state_update_alert):
+                    for s in alert.status:
+                        # 3. 更新共享的下载总量，并汇报瞬时速度 (MB/s)
+                        payload = s.total_payload_download
+                        if payload > last_payload_download:
+                            delta = payload - last_payload_download
+                            if ttfb is None:
+                                ttfb = time.time() - start_time
+                                profiling.record('torrent.ttfb', ttfb)
+                            # libtorrent 无法按字节预留，只能事后计入配额；配额不足时控制器会立即暂停
+                            shared_state.acquire_quota(delta)
+                            shared_state.add_bytes(delta)
+                            shared_state.reserve_bandwidth(delta)
+                            last_payload_download = payload
+                            last_progress = time.monotonic()
+                        shared_state.update_speed(process_id, s.download_rate / (1024 * 1024))
+                elif isinstance(alert, lt.piece_finished_alert):
+                    # 释放已通过校验的分片占用的内存
+                    storage.discard_piece(handle, alert.piece_index, save_path)
+                elif isinstance(alert, lt.metadata_received_alert):
+                    # 元数据到达后保存续传数据，下次下载同一链接时跳过这一步
+                    cache.request_save(lt, handle)
+                elif isinstance(alert, lt.save_resume_data_alert):
+                    cache.store(lt, magnet_link, alert)
+                elif isinstance(alert, lt.torrent_finished_alert):
+                    payload = handle.status().total_payload_download
+                    if payload > last_payload_download:
+                        shared_state.acquire_quota(payload - last_payload_download)
+                        shared_state.add_bytes(payload - last_payload_download)
+                        last_payload_download = payload
+                    finished = True
+                elif isinstance(alert, lt.torrent_error_alert):
+                    raise RuntimeError(alert.message())
+            profiling.record('torrent.alerts', time.perf_counter() - alerts_start)
 
-            # 汇报瞬时速度 (MB/s)
-            speed_mbps = s.download_rate / (1024 * 1024)
-            shared_state.update_speed(process_id, speed_mbps)
-            
-            time.sleep(2) # 每2秒更新一次状态
+            stall_timeout = config.SCHEDULER_STALL_TIMEOUT
+            if stall_timeout > 0 and time.monotonic() - last_progress > stall_timeout:
+                raise RuntimeError(f"{stall_timeout:.0f} 秒内没有下载进度")
 
         # 下载结束，将自己的速度清零
         shared_state.update_speed(process_id, 0)
@@ -70,6 +151,16 @@ def download_torrent(magnet_link: str, shared_state, process_id: int):
                          f"平均速度: {speed_mbps:.2f} Mbps")
         else:
             logger.info(f"[进程-{process_id}] 瞬间完成 Torrent 下载: {handle.name()}。")
+        return DownloadResult(True, last_payload_download, duration, ttfb)
 
     except Exception as e:
         logger.error(f"[进程-{process_id}] Torrent 下载期间发生意外错误: {e}")
+    finally:
+        done.set()
+        try:
+            cache.remember_peers(magnet_link, handle)
+        except Exception as e:
+            logger.warning(f"[进程-{process_id}] 记录可用节点失败: {e}")
+        ses.remove_torrent(handle)
+        storage.remove(save_path)
+    return DownloadResult(False, last_payload_download, time.time() - start_time, ttfb)
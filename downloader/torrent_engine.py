@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import random
+import threading
+import logging
+import multiprocessing
+
+import config
+import profiling
+from .result import DownloadResult
+from .torrent_cache import TorrentCache
+from .torrent_storage import TorrentStorage
+
+logger = logging.getLogger(__name__)
+
+
+class TorrentEngine:
+    """
+    独立的 Torrent 引擎进程，持有一个长期存活的 libtorrent 会话并同时运行多个种子。
+
+    - 整个程序只监听一个端口，DHT 只引导一次，节点信息在任务之间保留。
+    - 工作进程或控制器通过 submit() 提交磁力链接；提交过的链接会被循环下载，
+      某个种子完成后将其移除并换上下一个链接。下一个链接由任务调度器按吞吐量选择，
+      出错或长时间没有进度的种子会被换下并退避。
+    - 每个活动种子占用一个固定的速度键 "T.<序号>"，下载量直接计入 SharedState。
+    - 进度基于 libtorrent 的事件流 (post_torrent_updates / state_update_alert /
+      torrent_finished_alert)，所有种子共用一次 wait_for_alert 等待，不再逐个轮询状态。
+    - 种子元数据、可用节点和续传数据保存在 TorrentCache 中，重新换上同一个链接 (包括重启后) 时立即开始传输。
+    """
+    def __init__(self, shared_state, max_active=None, scheduler=None):
+        self._shared_state = shared_state
+        self._scheduler = scheduler
+        self._max_active = max_active or config.TORRENT_MAX_ACTIVE
+        self._submit_queue = multiprocessing.Queue()
+        self._cache = TorrentCache()
+        self.process = None
+
+    def submit(self, magnet_link):
+        """提交一个磁力链接，可在任意进程中调用"""
+        self._submit_queue.put(magnet_link)
+
+    def start(self):
+        self.process = multiprocessing.Process(target=self._run, name="TorrentEngine")
+        self.process.start()
+        return self.process
+
+    # ---- 以下代码运行在引擎进程中 ----
+
+    def _run(self):
+        import libtorrent as lt
+
+        profiling.start()
+        shared_state = self._shared_state
+        storage = TorrentStorage()
+        settings = {
+            'listen_interfaces': f'0.0.0.0:{config.TORRENT_LISTEN_PORT}',
+            'enable_dht': True,
+            'alert_mask': (lt.alert.category_t.error_notification
+                           | lt.alert.category_t.status_notification
+                           | lt.alert.category_t.storage_notification
+                           | lt.alert.category_t.piece_progress_notification),
+        }
+        settings.update(storage.session_settings())
+        rate_limit = shared_state.get_rate_limit()
+        if rate_limit > 0:
+            # 会话整体不超过全局上限；实际下载量再计入共享令牌桶，由 HTTP 流让出带宽
+            settings['download_rate_limit'] = int(rate_limit)
+        ses = lt.session(settings)
+        logger.info(f"Torrent 引擎已启动，监听端口 {config.TORRENT_LISTEN_PORT}，最多同时运行 {self._max_active} 个种子，"
+                    f"存储模式: {storage.mode}。")
+
+        catalog = []          # 所有提交过的磁力链接
+        lanes = {}            # 序号 -> {'handle', 'magnet', 'source', 'save_path', 'last_payload',
+                              #          'start_time', 'first_payload_time', 'last_progress'}
+        is_paused_by_memory = False
+        session_rate = rate_limit
+        threading.Thread(target=self._watch_pause, args=(ses, lanes), daemon=True).start()
+        update_interval = config.TORRENT_UPDATE_INTERVAL
+        next_update = 0.0
+
+        while True:
+            # 1. 接收新提交的磁力链接
+            while True:
+                try:
+                    magnet = self._submit_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if magnet not in catalog:
+                    catalog.append(magnet)
+
+            # 2. 暂停期间会话已由监视线程暂停，主循环阻塞等待恢复，不产生任何唤醒
+            if shared_state.is_paused():
+                shared_state.wait_until_resumed()
+                # 暂停期间没有进度是正常的，不计入停滞时间
+                for entry in lanes.values():
+                    entry['last_progress'] = time.monotonic()
+                continue
+
+            try:
+                # 3. 补满空闲的序号
+                for lane in range(self._max_active):
+                    if lane not in lanes and catalog:
+                        self._add(ses, lt, storage, lanes, lane, catalog)
+
+                # 4. 定期请求一次所有种子的状态更新，结果以 state_update_alert 的形式送达
+                now = time.monotonic()
+                if now >= next_update:
+                    with profiling.stage('torrent.update'):
+                        ses.post_torrent_updates()
+                    next_update = now + update_interval
+
+                    # 控制器会按时间窗口和配额匀速模式调整全局速率，同步到会话
+                    rate_limit = shared_state.get_rate_limit()
+                    if rate_limit != session_rate:
+                        ses.apply_settings({'download_rate_limit': int(rate_limit)})
+                        session_rate = rate_limit
+
+                    # 在途分片内存超过上限时暂停所有种子，等待校验和释放跟上
+                    over_budget = storage.over_budget()
+                    if over_budget != is_paused_by_memory:
+                        for entry in lanes.values():
+                            if over_budget:
+                                entry['handle'].pause()
+                            else:
+                                entry['handle'].resume()
+                        is_paused_by_memory = over_budget
+                        logger.info(f"在途分片内存{'超过' if over_budget else '回落到'}上限，"
+                                    f"{'暂停' if over_budget else '恢复'}所有种子。")
+
+                    # 换下长时间没有进度的种子 (例如找不到节点的死链)，由调度器退避
+                    stall_timeout = config.SCHEDULER_STALL_TIMEOUT
+                    for lane, entry in list(lanes.items()):
+                        if is_paused_by_memory:
+                            entry['last_progress'] = now
+                        elif stall_timeout > 0 and now - entry['last_progress'] > stall_timeout:
+                            logger.warning(f"[T.{lane}] {stall_timeout:.0f} 秒内没有下载进度，换下该种子。")
+                            self._finish(ses, storage, lanes, lane, entry['magnet'][:30], ok=False)
+
+                # 5. 一次等待处理所有种子的事件
+                ses.wait_for_alert(int(max(0.0, next_update - time.monotonic()) * 1000))
+                with profiling.stage('torrent.alerts'):
+                    for alert in ses.pop_alerts():
+                        self._handle_alert(lt, ses, storage, lanes, alert)
+            except Exception as e:
+                logger.error(f"Torrent 引擎发生意外错误: {e}")
+                time.sleep(1)
+
+    def _watch_pause(self, ses, lanes):
+        """阻塞等待共享状态的暂停/恢复事件，并立即暂停或恢复整个会话"""
+        shared_state = self._shared_state
+        is_paused_by_controller = False
+        while True:
+            if shared_state.is_paused():
+                if not is_paused_by_controller:
+                    ses.pause()
+                    is_paused_by_controller = True
+                    for lane in list(lanes):
+                        shared_state.update_speed(f"T.{lane}", 0)
+                    logger.info("暂停 Torrent 引擎。")
+                shared_state.wait_until_resumed()
+            else:
+                if is_paused_by_controller:
+                    ses.resume()
+                    is_paused_by_controller = False
+                    logger.info("恢复 Torrent 引擎。")
+                shared_state.wait_until_paused()
+
+    def _find_lane(self, lanes, handle):
+        for lane, entry in lanes.items():
+            if entry['handle'] == handle:
+                return lane
+        return None
+
+    def _account(self, entry, payload):
+        """把种子自上次汇报以来新增的负载下载量计入共享状态"""
+        if payload > entry['last_payload']:
+            delta = payload - entry['last_payload']
+            if entry['first_payload_time'] is None:
+                entry['first_payload_time'] = time.time()
+            entry['last_progress'] = time.monotonic()
+            # libtorrent 无法按字节预留，只能事后计入配额；配额不足时控制器会立即暂停
+            self._shared_state.acquire_quota(delta)
+            self._shared_state.add_bytes(delta)
+            self._shared_state.reserve_bandwidth(delta)
+            entry['last_payload'] = payload
+
+    def _handle_alert(self, lt, ses, storage, lanes, alert):
+        shared_state = self._shared_state
+        if isinstance(alert, lt.state_update_alert):
+            # 只包含自上次更新以来状态有变化的种子，下载增量随到随报
+            for s in alert.status:
+                lane = self._find_lane(lanes, s.handle)
+                if lane is None:
+                    continue
+                self._account(lanes[lane], s.total_payload_download)
+                shared_state.update_speed(f"T.{lane}", s.download_rate / (1024 * 1024))
+        elif isinstance(alert, lt.piece_finished_alert):
+            # 释放已通过校验的分片占用的内存
+            lane = self._find_lane(lanes, alert.handle)
+            if lane is not None:
+                storage.discard_piece(alert.handle, alert.piece_index, lanes[lane]['save_path'])
+        elif isinstance(alert, lt.metadata_received_alert):
+            # 元数据到达后保存续传数据，下次运行同一链接时跳过这一步
+            if self._find_lane(lanes, alert.handle) is not None:
+                self._cache.request_save(lt, alert.handle)
+        elif isinstance(alert, lt.save_resume_data_alert):
+            lane = self._find_lane(lanes, alert.handle)
+            if lane is not None:
+                self._cache.store(lt, lanes[lane]['magnet'], alert)
+        elif isinstance(alert, lt.torrent_finished_alert):
+            lane = self._find_lane(lanes, alert.handle)
+            if lane is not None:
+                # 结算最后一次状态更新之后的下载量
+                s = alert.handle.status()
+                self._account(lanes[lane], s.total_payload_download)
+                self._finish(ses, storage, lanes, lane, s.name)
+        elif isinstance(alert, lt.torrent_error_alert):
+            lane = self._find_lane(lanes, alert.handle)
+            if lane is not None:
+                logger.error(f"[T.{lane}] Torrent 下载错误: {alert.message()}")
+                self._finish(ses, storage, lanes, lane, lanes[lane]['magnet'][:30], ok=False)
+
+    def _choose(self, lanes, catalog):
+        """选择下一个磁力链接，返回 (链接, 调度器序号)；暂无可选链接时返回 (None, None)"""
+        active = {entry['magnet'] for entry in lanes.values()}
+        scheduler = self._scheduler
+        if scheduler is None:
+            candidates = [m for m in catalog if m not in active] or catalog
+            return random.choice(candidates), None
+        # 优先选择尚未运行的链接，只有一个链接时允许多个序号同时运行它
+        indices = {scheduler.index_of(m) for m in catalog} - {None}
+        running = {scheduler.index_of(m) for m in active}
+        others = set(range(len(scheduler))) - indices
+        source = scheduler.choose(('torrent',), exclude=others | running)
+        if source is None:
+            source = scheduler.choose(('torrent',), exclude=others)
+        if source is None:
+            return None, None
+        return scheduler.source(source)[1], source
+
+    def _add(self, ses, lt, storage, lanes, lane, catalog):
+        magnet, source = self._choose(lanes, catalog)
+        if magnet is None:
+            return
+        # 下载过的链接直接使用缓存的元数据和已知节点，不再等待 DHT 查找和元数据下载
+        params, cached = self._cache.params(lt, magnet)
+        self._shared_state.add_stat('torrent_cache_hit' if cached else 'torrent_cache_miss')
+        # 每个种子使用 tmpfs 上的独立目录，校验通过的分片随即释放
+        save_path = storage.save_path(f"T{lane}-{int(time.time() * 1000)}")
+        params.save_path = save_path
+        handle = ses.add_torrent(params)
+        lanes[lane] = {'handle': handle, 'magnet': magnet, 'source': source, 'save_path': save_path,
+                       'last_payload': 0, 'start_time': time.time(), 'first_payload_time': None,
+                       'last_progress': time.monotonic()}
+        if cached:
+            logger.info(f"[T.{lane}] 开始 Torrent 下载 (命中磁力链接缓存: {params.name}，"
+                        f"已知节点 {len(params.peers)} 个)")
+        else:
+            logger.info(f"[T.{lane}] 开始 Torrent 下载: {magnet[:30]}...")
+
+    def _finish(self, ses, storage, lanes, lane, name, ok=True):
+        entry = lanes.pop(lane)
+        self._shared_state.update_speed(f"T.{lane}", 0)
+        duration = time.time() - entry['start_time']
+        total_downloaded_mb = entry['last_payload'] / (1024 * 1024)
+        if ok and duration > 0:
+            speed_mbps = (entry['last_payload'] * 8) / (duration * 1024 * 1024)
+            logger.info(f"[T.{lane}] 完成 Torrent 下载: {name}。"
+                         f"已下载 {total_downloaded_mb:.2f} MB，用时 {duration:.2f}秒。"
+                         f"平均速度: {speed_mbps:.2f} Mbps")
+        self._shared_state.record_task(ok)
+        if entry['source'] is not None:
+            ttfb = None
+            if entry['first_payload_time'] is not None:
+                ttfb = entry['first_payload_time'] - entry['start_time']
+            self._scheduler.finish(entry['source'], DownloadResult(ok, entry['last_payload'], duration, ttfb))
+        try:
+            self._cache.remember_peers(entry['magnet'], entry['handle'])
+        except Exception as e:
+            logger.warning(f"[T.{lane}] 记录可用节点失败: {e}")
+        # 删除目录，以便同一个链接下次能重新下载
+        ses.remove_torrent(entry['handle'])
+        storage.remove(entry['save_path'])
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import ctypes
+import ctypes.util
+import logging
+
+import config
+
+logger = logging.getLogger(__name__)
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# save_path() 创建的种子目录的名称前缀；cleanup_stale() 只删除带此前缀的子目录，
+# 因此 TORRENT_TMP_DIR 指向共享目录 (例如 /dev/shm) 时不会误删其他程序的文件
+DIR_PREFIX = 'tfc-'
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    return _libc
+
+
+def punch_hole(path, offset, length):
+    """释放文件中 [offset, offset+length) 的存储空间，文件大小不变 (该区间之后读出为 0)"""
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        if _get_libc().fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+    finally:
+        os.close(fd)
+
+
+class TorrentStorage:
+    """
+    管理种子负载在 tmpfs 上的存放方式，保证内存占用有上限。
+
+    - "discard" 模式：每个种子使用独立目录；分片通过哈希校验 (piece_finished_alert) 后，
+      立即在文件中打洞释放对应的内存，磁盘上只保留尚未校验的分片。
+      由于数据被丢弃，无法向其他节点提供上传，因此同时关闭上传。
+    - "tmpfs" 模式：保留完整文件，直到种子被移除时删除目录。
+    两种模式下，程序启动时和种子移除时都会清理残留目录 (只清理本工具创建的、以 DIR_PREFIX 开头的子目录)。
+    """
+    def __init__(self, mode=None, root=None, max_inflight_bytes=None):
+        self.mode = mode or config.TORRENT_STORAGE
+        self.root = root or config.TORRENT_TMP_DIR
+        self.max_inflight_bytes = max_inflight_bytes if max_inflight_bytes is not None else config.TORRENT_MAX_INFLIGHT_BYTES
+
+    def session_settings(self):
+        """需要合并进 libtorrent 会话的设置"""
+        settings = {}
+        if self.max_inflight_bytes > 0:
+            # 限制等待写入的分片数据量
+            settings['max_queued_disk_bytes'] = int(self.max_inflight_bytes)
+        if self.mode == 'discard':
+            settings['unchoke_slots_limit'] = 0
+        return settings
+
+    def cleanup_stale(self):
+        """删除上次运行遗留的种子目录；根目录本身和其中的其他文件保持不变"""
+        os.makedirs(self.root, exist_ok=True)
+        removed = 0
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.name.startswith(DIR_PREFIX) and entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+        if removed:
+            logger.info(f"已清理 {removed} 个残留的种子临时目录: {self.root}")
+
+    def save_path(self, name):
+        """为一个种子 (或一个任务) 分配独立目录，避免并发任务写同一批文件"""
+        path = os.path.join(self.root, DIR_PREFIX + name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def remove(self, path):
+        shutil.rmtree(path, ignore_errors=True)
+
+    def discard_piece(self, handle, piece, save_path):
+        """分片已通过校验，释放它在 tmpfs 中占用的内存"""
+        if self.mode != 'discard':
+            return
+        ti = handle.torrent_file() if hasattr(handle, 'torrent_file') else handle.get_torrent_info()
+        if ti is None:
+            return
+        files = ti.files()
+        for file_slice in ti.map_block(piece, 0, ti.piece_size(piece)):
+            path = os.path.join(save_path, files.file_path(file_slice.file_index))
+            try:
+                punch_hole(path, file_slice.offset, file_slice.size)
+            except OSError as e:
+                # 文件可能尚未创建或已被删除，不影响下载本身
+                logger.debug(f"释放分片 {piece} 失败 ({path}): {e}")
+
+    def usage_bytes(self):
+        """本工具的种子目录在 tmpfs 中实际占用的字节数 (按已分配块计算，打洞后的区间不计入)"""
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root:
+                dirnames[:] = [name for name in dirnames if name.startswith(DIR_PREFIX)]
+                continue
+            for filename in filenames:
+                try:
+                    total += os.stat(os.path.join(dirpath, filename)).st_blocks * 512
+                except OSError:
+                    pass
+        return total
+
+    def over_budget(self):
+        return self.max_inflight_bytes > 0 and self.usage_bytes() > self.max_inflight_bytes
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+下载量的持久化：追加写入的日志 (journal) 加定期的原子检查点，并按小时/按天保留各来源的用量历史。
+
+- 控制器每次汇报时追加一条记录 (本次新增的总下载量和各来源下载量)，写入后 fsync；
+  崩溃最多只会留下一行不完整的记录，恢复时跳过即可。
+- 每隔 JOURNAL_CHECKPOINT_INTERVAL 秒把完整状态写入 STATE_FILE (先写临时文件、fsync，再 os.replace)，
+  然后清空日志。启动时读取检查点，再重放序号更大的日志记录。
+- 这些写入只在控制器进程中进行，不持有共享状态的任何锁。
+
+查询历史：
+    python -m journal [--hourly] [--days 7] [--source URL] [--json]
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+import config
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 2
+HOUR_FORMAT = '%Y-%m-%dT%H'
+DAY_FORMAT = '%Y-%m-%d'
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write_text(path, text):
+    """先写临时文件并 fsync，再原子替换，任何时刻崩溃都不会留下损坏的文件"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path)
+
+
+def _add_usage(bucket, total, sources):
+    bucket['total'] = bucket.get('total', 0.0) + total
+    if sources:
+        bucket_sources = bucket.setdefault('sources', {})
+        for source, num_bytes in sources.items():
+            bucket_sources[source] = bucket_sources.get(source, 0.0) + num_bytes
+
+
+class StateJournal:
+    """
+    控制器独占的持久化对象：恢复下载量和上次重置时间，记录用量增量，并提供历史查询。
+    查询可能来自状态服务线程，历史数据由一个进程内的锁保护。
+    """
+    def __init__(self, checkpoint_path=None, journal_path=None, checkpoint_interval=None,
+                 hourly_days=None, daily_days=None):
+        self._checkpoint_path = checkpoint_path or config.STATE_FILE
+        self._journal_path = journal_path or config.JOURNAL_FILE
+        self._checkpoint_interval = (config.JOURNAL_CHECKPOINT_INTERVAL
+                                     if checkpoint_interval is None else checkpoint_interval)
+        self._hourly_days = config.HISTORY_HOURLY_DAYS if hourly_days is None else hourly_days
+        self._daily_days = config.HISTORY_DAILY_DAYS if daily_days is None else daily_days
+
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._bytes_downloaded = 0.0
+        self._last_reset_time = time.time()
+        self._hours = {}     # 'YYYY-MM-DDTHH' -> {'total', 'sources'}
+        self._days = {}      # 超出小时保留期后汇总到 'YYYY-MM-DD'
+        self._last_total = None
+        self._last_sources = None
+        self._last_checkpoint = time.monotonic()
+        self._fd = None
+
+    # ---- 恢复 ----
+
+    def recover(self):
+        """读取检查点并重放日志，返回 (本周期已下载字节数, 上次重置时间)"""
+        checkpoint = {}
+        if os.path.exists(self._checkpoint_path):
+            try:
+                with open(self._checkpoint_path, 'r') as f:
+                    checkpoint = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"无法读取状态检查点 {self._checkpoint_path}: {e}")
+        self._seq = checkpoint.get('seq', 0)
+        self._bytes_downloaded = checkpoint.get('bytes_downloaded', 0.0)
+        self._last_reset_time = checkpoint.get('last_reset_time', time.time())
+        self._hours = checkpoint.get('hours', {})
+        self._days = checkpoint.get('days', {})
+
+        replayed = skipped = 0
+        if os.path.exists(self._journal_path):
+            # 最后一条完整记录的结束位置；其后的残缺内容必须截掉，否则下一条追加的记录会接在残缺的字节后面
+            offset = complete_end = 0
+            with open(self._journal_path, 'rb') as f:
+                for line in f:
+                    offset += len(line)
+                    try:
+                        # 没有换行符的最后一行是崩溃时写了一半的记录
+                        if not line.endswith(b'\n'):
+                            raise ValueError("记录不完整")
+                        record = json.loads(line)
+                    except ValueError:
+                        skipped += 1
+                        continue
+                    complete_end = offset
+                    if record.get('seq', 0) <= self._seq:
+                        continue
+                    self._apply(record)
+                    replayed += 1
+            if complete_end < offset:
+                with open(self._journal_path, 'r+b') as f:
+                    f.truncate(complete_end)
+                    os.fsync(f.fileno())
+                logger.warning(f"已截掉用量日志末尾 {offset - complete_end} 字节的不完整记录。")
+        if replayed or skipped:
+            logger.info(f"已重放 {replayed} 条日志记录" + (f"，跳过 {skipped} 条不完整记录" if skipped else "") + "。")
+        logger.info(f"状态已加载：已下载 {self._bytes_downloaded / (1024**3):.2f} GB，"
+                    f"上次重置于 {datetime.fromtimestamp(self._last_reset_time)}")
+        return self._bytes_downloaded, self._last_reset_time
+
+    def _apply(self, record):
+        """把一条日志记录应用到内存状态 (写入和重放共用)"""
+        self._seq = record['seq']
+        if 'reset' in record:
+            self._bytes_downloaded = 0.0
+            self._last_reset_time = record['reset']
+            return
+        total = record.get('d', 0.0)
+        sources = record.get('s', {})
+        self._bytes_downloaded += total
+        hour = datetime.fromtimestamp(record['t']).strftime(HOUR_FORMAT)
+        with self._lock:
+            _add_usage(self._hours.setdefault(hour, {}), total, sources)
+
+    # ---- 写入 ----
+
+    def _append(self, record):
+        if self._fd is None:
+            self._fd = os.open(self._journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        record['seq'] = self._seq + 1
+        os.write(self._fd, (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8'))
+        os.fsync(self._fd)
+        self._apply(record)
+
+    def record(self, total_bytes, sources=None, now=None):
+        """
+        记录当前的周期下载量和各来源的累计下载量，只把与上次相比的增量写入日志。
+        启动后的第一次调用只建立基线。
+
+        :param total_bytes: SharedState.get_bytes() 的值
+        :param sources: {来源: 累计字节数}，例如由 TaskScheduler.snapshot() 得到
+        """
+        now = time.time() if now is None else now
+        sources = sources or {}
+        if self._last_total is None:
+            self._last_total = total_bytes
+            self._last_sources = dict(sources)
+            return
+        delta = max(0.0, total_bytes - self._last_total)
+        source_deltas = {}
+        for source, num_bytes in sources.items():
+            diff = num_bytes - self._last_sources.get(source, num_bytes)
+            if diff > 0:
+                source_deltas[source] = diff
+        self._last_total = total_bytes
+        self._last_sources = dict(sources)
+        if delta or source_deltas:
+            record = {'t': now, 'd': delta}
+            if source_deltas:
+                record['s'] = source_deltas
+            self._append(record)
+        if time.monotonic() - self._last_checkpoint >= self._checkpoint_interval:
+            self.checkpoint()
+
+    def record_reset(self, reset_time):
+        """每日重置：本周期下载量归零 (调用前应先 record() 结算重置前的增量)"""
+        self._append({'t': time.time(), 'reset': reset_time})
+        self._last_total = 0.0
+        self.checkpoint()
+
+    def checkpoint(self):
+        """原子地写入完整状态，然后清空已包含在检查点中的日志"""
+        self._compact()
+        with self._lock:
+            state = {
+                'version': CHECKPOINT_VERSION,
+                'seq': self._seq,
+                'bytes_downloaded': self._bytes_downloaded,
+                'last_reset_time': self._last_reset_time,
+                'hours': self._hours,
+                'days': self._days,
+            }
+            data = json.dumps(state)
+        atomic_write_text(self._checkpoint_path, data)
+        # 检查点已落盘；即使截断前崩溃，重放时也会按序号跳过这些记录
+        if self._fd is not None:
+            os.ftruncate(self._fd, 0)
+        self._last_checkpoint = time.monotonic()
+        logger.debug(f"状态检查点已保存: 序号 {self._seq}，已下载 {self._bytes_downloaded / (1024**3):.2f} GB")
+
+    def _compact(self):
+        """把超出小时保留期的记录汇总为按天记录，并删除超出按天保留期的记录"""
+        now = datetime.now()
+        hour_cutoff = (now - timedelta(days=self._hourly_days)).strftime(HOUR_FORMAT)
+        day_cutoff = (now - timedelta(days=self._daily_days)).strftime(DAY_FORMAT)
+        with self._lock:
+            for hour in [h for h in self._hours if h < hour_cutoff]:
+                bucket = self._hours.pop(hour)
+                _add_usage(self._days.setdefault(hour[:10], {}), bucket.get('total', 0.0), bucket.get('sources'))
+            for day in [d for d in self._days if d < day_cutoff]:
+                del self._days[day]
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    # ---- 查询 ----
+
+    def history(self, granularity='day', source=None, start=None, end=None):
+        """
+        返回按时间排序的 [(时间段, 字节数)]。
+
+        :param granularity: 'hour' 或 'day'；按天查询时合并仍按小时保存的近期记录
+        :param source: 只统计某个来源；None 表示总下载量
+        :param start: 起始时间段 (含)，格式与返回的时间段相同，例如 '2024-05-01' 或 '2024-05-01T08'
+        :param end: 结束时间段 (含)
+        """
+        with self._lock:
+            buckets = {}
+            if granularity == 'hour':
+                items = list(self._hours.items())
+            else:
+                items = list(self._days.items()) + [(hour[:10], bucket) for hour, bucket in self._hours.items()]
+            for period, bucket in items:
+                if source is None:
+                    value = bucket.get('total', 0.0)
+                else:
+                    value = bucket.get('sources', {}).get(source, 0.0)
+                buckets[period] = buckets.get(period, 0.0) + value
+        return [(period, value) for period, value in sorted(buckets.items())
+                if (start is None or period >= start) and (end is None or period <= end)]
+
+    def sources(self):
+        """历史记录中出现过的所有来源"""
+        with self._lock:
+            found = set()
+            for bucket in list(self._hours.values()) + list(self._days.values()):
+                found.update(bucket.get('sources', {}))
+        return sorted(found)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="查询下载量历史")
+    parser.add_argument('--hourly', action='store_true', help="按小时输出 (默认按天)")
+    parser.add_argument('--days', type=int, default=30, help="只输出最近 N 天")
+    parser.add_argument('--source', help="只统计某个来源")
+    parser.add_argument('--by-source', action='store_true', help="分别列出每个来源")
+    parser.add_argument('--json', action='store_true', help="以 JSON 输出")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    journal = StateJournal()
+    journal.recover()
+    granularity = 'hour' if args.hourly else 'day'
+    start = (datetime.now() - timedelta(days=args.days)).strftime(HOUR_FORMAT if args.hourly else DAY_FORMAT)
+
+    report = {}
+    if args.by_source:
+        for source in journal.sources():
+            report[source] = journal.history(granularity, source, start)
+    else:
+        report[args.source or 'total'] = journal.history(granularity, args.source, start)
+
+    if args.json:
+        print(json.dumps({name: dict(rows) for name, rows in report.items()}, indent=2, ensure_ascii=False))
+        return
+    for name, rows in report.items():
+        print(f"[{name}]")
+        for period, value in rows:
+            print(f"  {period:<16} {value / (1024**3):>10.3f} GB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,27 @@
 # -*- coding: utf-8 -*-
 
+import argparse
+import asyncio
 import multiprocessing
 import time
-import random
 import logging
-from datetime import datetime, time as dt_time, timedelta
+from datetime import datetime
 
 import config
-from downloader import download_http, download_torrent
-from shared_state import SharedState
-from time_utils import is_in_time_window, get_next_allowed_time_start
+import profiling
+from accounting import InterfaceAccounting
+from autoscaler import Autoscaler, WorkerPool
+from coordinator import CoordinatorClient
+from downloader import download_http, download_http_async, download_http_segmented, download_http_raw, download_torrent, TorrentEngine, TorrentStorage
+from journal import StateJournal
+from metrics import ControllerStatus, MetricsServer
+from scheduler import TaskScheduler
+from shared_state import create_shared_state
+from schedule_engine import get_schedule
+from time_utils import (
+    is_in_time_window, get_next_allowed_time_start, get_next_window_transition, get_next_reset_time,
+    get_previous_reset_time
+)
 
 # 在主模块中进行一次全局日志配置
 logging.basicConfig(
@@ -18,94 +30,317 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 状态报告间隔 (秒)
+SUMMARY_INTERVAL = 5
+# 定时器到期后多等一小段时间，确保醒来时已越过时间边界
+TIMER_SLACK = 0.05
+# 暂停期间检查工作进程存活状态的间隔 (秒)
+WORKER_CHECK_INTERVAL = 5
+
+
+def _all_tasks():
+    """所有下载来源，调度器按此顺序为每个来源分配统计槽位"""
+    return ([('http', url) for url in config.HTTP_URLS]
+            + [('torrent', link) for link in config.MAGNET_LINKS])
 
-def worker_process(process_id, shared_state):
+
+def worker_process(process_id, shared_state, scheduler, stop_event=None):
     """
-    工作进程的执行体。会不断随机选择任务并执行。
+    工作进程的执行体。会不断通过调度器选择任务并执行，直到 stop_event 被设置 (缩容排空)。
     """
     logger.info(f"工作进程-{process_id} 已启动。")
-    all_tasks = []
-    if config.HTTP_URLS:
-        all_tasks.extend([('http', url) for url in config.HTTP_URLS])
-    if config.MAGNET_LINKS:
-        all_tasks.extend([('torrent', link) for link in config.MAGNET_LINKS])
+    profiling.start()
+    # 共享引擎模式下磁力链接由 Torrent 引擎进程统一下载
+    task_types = ('http',) if config.TORRENT_ENGINE == 'shared' else ('http', 'torrent')
+    all_tasks = [task for task in _all_tasks() if task[0] in task_types]
 
     if not all_tasks:
-        logger.warning(f"工作进程-{process_id}：未配置下载链接。正在退出。")
+        if config.MAGNET_LINKS:
+            logger.info(f"工作进程-{process_id}：没有 HTTP 任务，磁力链接由 Torrent 引擎处理。正在退出。")
+        else:
+            logger.warning(f"工作进程-{process_id}：未配置下载链接。正在退出。")
+        return
+
+    if config.HTTP_ENGINE == 'asyncio':
+        asyncio.run(_run_streams(process_id, shared_state, scheduler, task_types, stop_event))
         return
 
-    while True:
-        task_type, link = random.choice(all_tasks)
+    # "raw" 引擎使用零拷贝的丢弃式接收路径，其余情况使用 requests (可按 Range 多连接分段下载)
+    if config.HTTP_ENGINE == 'raw':
+        http_download = download_http_raw
+    elif config.HTTP_SEGMENTS > 1:
+        http_download = download_http_segmented
+    else:
+        http_download = download_http
+
+    while stop_event is None or not stop_event.is_set():
+        # 所有来源都在退避或主机已满时，等到最早可用的时间再选
+        index = scheduler.choose(task_types)
+        if index is None:
+            time.sleep(scheduler.retry_delay(task_types))
+            continue
+        task_type, link = scheduler.source(index)
+        result = None
         try:
             if task_type == 'http':
-                download_http(link, shared_state, process_id)
+                result = http_download(link, shared_state, process_id)
             elif task_type == 'torrent':
-                download_torrent(link, shared_state, process_id)
+                result = download_torrent(link, shared_state, process_id)
         except Exception as e:
             logger.error(f"工作进程-{process_id} 捕获到异常：{e}")
-        
-        logger.info(f"工作进程-{process_id} 完成了一个任务。5秒后将使用新的随机任务重新启动。")
-        time.sleep(5)
+        # 失败的来源由调度器退避，不再对每个任务固定等待
+        scheduler.finish(index, result)
+        shared_state.record_task(result is not None and result.ok)
+
+        logger.debug(f"工作进程-{process_id} 完成了一个任务。")
+
+    logger.info(f"工作进程-{process_id} 已完成当前任务，正在退出。")
+
+
+async def _stream_loop(process_id, stream_index, shared_state, scheduler, task_types, stop_event):
+    """asyncio 引擎下的单个流：与 worker_process 相同的调度循环"""
+    stream_id = f"{process_id}.{stream_index}"
+    loop = asyncio.get_running_loop()
+    while stop_event is None or not stop_event.is_set():
+        index = scheduler.choose(task_types)
+        if index is None:
+            await asyncio.sleep(scheduler.retry_delay(task_types))
+            continue
+        task_type, link = scheduler.source(index)
+        result = None
+        try:
+            if task_type == 'http':
+                result = await download_http_async(link, shared_state, stream_id)
+            elif task_type == 'torrent':
+                # libtorrent 下载是阻塞的，放到线程池中执行
+                result = await loop.run_in_executor(None, download_torrent, link, shared_state, stream_id)
+        except Exception as e:
+            logger.error(f"流-{stream_id} 捕获到异常：{e}")
+        scheduler.finish(index, result)
+        shared_state.record_task(result is not None and result.ok)
+
+        logger.debug(f"流-{stream_id} 完成了一个任务。")
+
+
+async def _run_streams(process_id, shared_state, scheduler, task_types, stop_event=None):
+    """在一个工作进程内并发运行 STREAMS_PER_PROCESS 个下载流"""
+    logger.info(f"工作进程-{process_id} 使用 asyncio 引擎，并发流数量: {config.STREAMS_PER_PROCESS}")
+    await asyncio.gather(*(
+        _stream_loop(process_id, i, shared_state, scheduler, task_types, stop_event)
+        for i in range(max(1, config.STREAMS_PER_PROCESS))
+    ))
+    logger.info(f"工作进程-{process_id} 的所有流已完成当前任务，正在退出。")
+
+
+def _save_state(shared_state, scheduler, journal):
+    """把本次汇报周期的用量增量写入日志，并保存调度器统计 (均在控制器进程中进行，不持有共享状态的锁)"""
+    with profiling.stage('controller.save_state'):
+        journal.record(shared_state.get_bytes(), scheduler.source_bytes())
+        scheduler.save_state()
+
+
+def _wait_paused(shared_state, pool, seconds):
+    """暂停期间的等待：最长 seconds 秒，但按 WORKER_CHECK_INTERVAL 和进程池的重启/排空期限提前醒来"""
+    timeouts = [seconds, WORKER_CHECK_INTERVAL]
+    deadline = pool.next_deadline()
+    if deadline is not None:
+        timeouts.append(deadline - time.monotonic())
+    shared_state.wait_for_notification(max(0.0, min(timeouts)) + TIMER_SLACK)
+
+
+def _target_rate(remaining_bytes, now):
+    """
+    当前应使用的全局速率 (字节/秒，0 表示不限速)：取全局上限、当前时间窗口的速率目标
+    和配额匀速速率中最小的一个。
+    """
+    schedule = get_schedule()
+    targets = [rate for rate in (config.MAX_RATE_BYTES, schedule.rate_target(now)) if rate]
+    if config.SCHEDULE_PACING:
+        pacing = schedule.pacing_rate(remaining_bytes, now)
+        if pacing is not None:
+            # 速率 0 表示不限速，匀速速率至少保留 1 字节/秒
+            targets.append(max(1.0, pacing))
+    return min(targets) if targets else 0.0
 
 
 def main():
     # 设置多进程启动方式，这在某些平台上可以提高稳定性
     multiprocessing.set_start_method("fork", force=True)
     
-    manager = multiprocessing.Manager()
-    shared_state = SharedState(manager)
-    shared_state.load_state()
+    shared_state = create_shared_state()
+    if profiling.enabled:
+        # 在启动任何子进程之前替换共享状态的热路径方法，工作进程和 Torrent 引擎随 fork 继承
+        profiling.clear_dir()
+        profiling.instrument(shared_state)
+        profiling.start()
+        logger.info(f"已开启剖析模式，数据写入 {config.PROFILE_DIR}，退出时打印汇总报告。")
+    # 从检查点和用量日志恢复本周期的下载量
+    journal = StateJournal()
+    shared_state.restore_state(*journal.recover())
+    # 按已下载量初始化配额租约，工作进程只能在剩余配额内申领
+    local_limit = limit_bytes = config.DOWNLOAD_LIMIT_GB * (1024 ** 3)
+    # 多节点模式下，本节点的上限为 "已下载量 + 协调服务分配的剩余租约"
+    coordinator = None
+    if config.COORDINATOR_URL:
+        coordinator = CoordinatorClient(shared_state).start()
+        limit_bytes = coordinator.limit_bytes(local_limit)
+        logger.info(f"已连接协调服务 {config.COORDINATOR_URL}，节点名: {config.NODE_NAME}")
+    shared_state.set_quota(limit_bytes, shared_state.get_bytes())
+    # 各来源的吞吐量统计在所有工作进程间共享，并从上次运行的记录继续
+    scheduler = TaskScheduler(_all_tasks())
+    scheduler.load_state()
+    # 以当前的各来源累计量作为用量日志的基线
+    journal.record(shared_state.get_bytes(), scheduler.source_bytes())
+
+    # 接口计量模式下由控制器按网卡计数计入下载量；负载计量模式下设置了网卡时只采样，用于对比线路开销
+    accounting = None
+    if config.ACCOUNTING_MODE == 'interface' or config.ACCOUNTING_INTERFACE:
+        try:
+            accounting = InterfaceAccounting(shared_state, attribute=config.ACCOUNTING_MODE == 'interface')
+        except (OSError, ValueError) as e:
+            if config.ACCOUNTING_MODE == 'interface':
+                logger.error(f"无法启用接口计量模式: {e}")
+                return
+            logger.warning(f"无法采样网卡计数: {e}")
+        else:
+            accounting.reset(sum(scheduler.source_bytes().values()))
+            logger.info(f"{'已启用接口计量模式' if accounting.attribute else '已开启网卡采样'}，"
+                        f"网卡: {accounting.interface}")
+
+    # 控制器状态 (暂停原因、恢复时间) 由主循环写入，状态服务在后台线程中读取
+    status = ControllerStatus()
+    status.update(limit_bytes=limit_bytes)
+    if config.METRICS_PORT:
+        try:
+            MetricsServer(shared_state, scheduler, status, journal).start()
+        except OSError as e:
+            logger.error(f"状态服务启动失败 (端口 {config.METRICS_PORT}): {e}")
 
     # 在启动工作进程前，先强制进入暂停状态，等待主循环进行状态检查
     shared_state.pause()
     logger.info("正在进行初始状态检查，下载进程将等待所有状态检查完毕后启动。")
 
-    # 启动工作进程
-    processes = []
-    for i in range(config.CONCURRENT_DOWNLOADS):
-        p = multiprocessing.Process(
-            target=worker_process,
-            args=(i, shared_state),
-            name=f"Worker-{i}" # 为进程命名
-        )
-        processes.append(p)
-        p.start()
+    # 清理上次运行遗留在 tmpfs 中的种子数据
+    if config.MAGNET_LINKS:
+        TorrentStorage().cleanup_stale()
+
+    # 共享引擎模式下只有磁力链接时，不需要 HTTP 工作进程
+    use_torrent_engine = bool(config.MAGNET_LINKS) and config.TORRENT_ENGINE == 'shared'
+    num_workers = config.CONCURRENT_DOWNLOADS
+    if use_torrent_engine and not config.HTTP_URLS:
+        num_workers = 0
+    if not _all_tasks():
+        logger.warning("未配置下载链接。")
+        num_workers = 0
+
+    # 启动工作进程；开启自动伸缩时由控制器按吞吐量调整进程数
+    pool = WorkerPool(worker_process, (shared_state, scheduler), scheduler=scheduler)
+    autoscaler = None
+    if config.AUTOSCALE and num_workers:
+        autoscaler = Autoscaler()
+        num_workers = autoscaler.clamp(num_workers)
+        logger.info(f"已启用工作进程自动伸缩: {autoscaler.min_workers}-{autoscaler.max_workers} 个进程，"
+                    f"每 {config.AUTOSCALE_INTERVAL:.0f} 秒调整一次。")
+    pool.scale_to(num_workers)
+
+    logger.info(f"{num_workers} 个工作进程已启动。")
+
+    # 启动共享的 Torrent 引擎，由控制器提交所有磁力链接
+    engine_process = None
+    if use_torrent_engine:
+        torrent_engine = TorrentEngine(shared_state, scheduler=scheduler)
+        for link in config.MAGNET_LINKS:
+            torrent_engine.submit(link)
+        engine_process = torrent_engine.start()
 
-    logger.info(f"{config.CONCURRENT_DOWNLOADS} 个工作进程已启动。")
+    if config.MAX_RATE_MBPS > 0:
+        logger.info(f"全局速率上限: {config.MAX_RATE_MBPS:.1f} Mbps")
+    if config.SCHEDULE_PACING:
+        logger.info("已启用配额匀速模式：剩余配额将均匀分摊到下次重置前的允许下载时间内。")
 
     # 主控制循环
     last_summary_time = time.time()
+    announced_resume_time = None
     
     try:
         while True:
+            # 主循环每次被唤醒后的处理耗时 (不含等待)，在每次等待前记录
+            loop_start = time.perf_counter()
+            # 接口计量模式下先计入自上次采样以来的线路流量 (包括暂停后仍在途的数据)
+            if accounting is not None:
+                accounting.sample()
+
             # 1. 检查并执行每日重置
             now = datetime.now()
-            last_reset_dt = datetime.fromtimestamp(shared_state._last_reset_time.value)
-            reset_time_obj = dt_time.fromisoformat(config.RESET_TIME)
-            today_reset_dt = now.replace(hour=reset_time_obj.hour, minute=reset_time_obj.minute, second=0, microsecond=0)
+            last_reset_dt = datetime.fromtimestamp(shared_state.get_last_reset_time())
 
-            if now >= today_reset_dt and last_reset_dt < today_reset_dt:
+            if last_reset_dt < get_previous_reset_time(now):
                 logger.info("已到达每日重置时间。")
+                # 先结算重置前的增量，再在日志中记录重置
+                bytes_before_reset = shared_state.get_bytes()
+                journal.record(bytes_before_reset, scheduler.source_bytes())
                 shared_state.reset()
-                shared_state.save_state()
+                if coordinator is not None:
+                    coordinator.on_reset(bytes_before_reset)
+                    limit_bytes = coordinator.limit_bytes(local_limit)
+                shared_state.set_quota(limit_bytes, 0)
+                journal.record_reset(shared_state.get_last_reset_time())
+                if accounting is not None:
+                    accounting.reset(sum(scheduler.source_bytes().values()))
+
+            # 多节点模式：协调服务追加租约 (或进入降级模式) 后调整本节点的上限
+            if coordinator is not None:
+                node_limit = coordinator.limit_bytes(local_limit)
+                if node_limit < limit_bytes:
+                    # 租约被作废后上限降低：同时作废各进程手中尚未用完的本地租约
+                    limit_bytes = node_limit
+                    shared_state.set_quota(limit_bytes, shared_state.get_bytes())
+                elif node_limit != limit_bytes:
+                    limit_bytes = node_limit
+                    shared_state.set_quota_limit(limit_bytes)
+                status.update(limit_bytes=limit_bytes, coordinator=coordinator.info())
 
             # 2. 确定当前是否应该处于暂停状态
-            limit_bytes = config.DOWNLOAD_LIMIT_GB * (1024 ** 3)
+            # 配额租约已分配完、有进程申请被拒绝且其他进程的租约已用完，同样视为达到下载限制
             current_bytes = shared_state.get_bytes()
-            in_window = is_in_time_window()
-            should_be_paused = (current_bytes >= limit_bytes) or not in_window
+            limit_reached = current_bytes >= limit_bytes or shared_state.is_quota_exhausted()
+            in_window = is_in_time_window(now)
+            coordinator_paused = coordinator is not None and coordinator.is_paused()
+            should_be_paused = limit_reached or not in_window or coordinator_paused
+            status.update(pause_reasons=tuple(reason for reason, active in
+                                              (('window', not in_window), ('limit', limit_reached),
+                                               ('coordinator', coordinator_paused)) if active))
+            if limit_reached and coordinator is not None:
+                # 本地租约用完，立即向协调服务申请
+                coordinator.kick()
+            status.update(next_transition_time=get_next_window_transition(now))
+
+            # 检查工作进程存活状态 (暂停期间同样检查)：异常退出的工作进程由进程池重新拉起
+            pool.maintain()
+            if engine_process is not None and not engine_process.is_alive():
+                logger.error("Torrent 引擎进程已退出。请检查日志以获取错误信息。")
+                scheduler.release_process(engine_process.pid)
+                engine_process = None
+            if not pool.size and engine_process is None:
+                logger.error("所有工作进程均已终止。正在关闭。")
+                break
 
             # 3. 根据状态执行操作
             if should_be_paused:
-                # 如果应该暂停
+                # 如果应该暂停；暂停期间没有下载，不需要配额告警，也不测量吞吐量
+                shared_state.set_quota_alarm(None)
+                if autoscaler is not None:
+                    autoscaler.invalidate()
                 if not shared_state.is_paused():
                     shared_state.pause()
                     # 组合暂停原因
                     pause_reasons = []
                     if not in_window:
                         pause_reasons.append("不在允许的时间窗口内")
-                    if current_bytes >= limit_bytes:
-                        pause_reasons.append(f"已达到下载限制: {current_bytes / (1024**3):.2f}/{config.DOWNLOAD_LIMIT_GB} GB")
+                    if limit_reached:
+                        pause_reasons.append(f"已达到下载限制: {current_bytes / (1024**3):.2f}/{limit_bytes / (1024**3):.2f} GB")
+                    if coordinator_paused:
+                        pause_reasons.append("协调服务要求暂停")
                     logger.info(f"{' 且 '.join(pause_reasons)}。正在暂停。")
 
                 # 计算下一个可能的恢复时间
@@ -117,73 +352,139 @@ def main():
                     possible_resume_times.append(get_next_allowed_time_start())
 
                 # 如果是因为达到下载限制，计算下一个重置时间
-                if current_bytes >= limit_bytes:
-                    reset_time_obj = dt_time.fromisoformat(config.RESET_TIME)
-                    next_reset_dt = now_dt.replace(hour=reset_time_obj.hour, minute=reset_time_obj.minute, second=0, microsecond=0)
-                    if now_dt >= next_reset_dt:
-                        next_reset_dt += timedelta(days=1)
-                    possible_resume_times.append(next_reset_dt)
+                if limit_reached:
+                    possible_resume_times.append(get_next_reset_time(now_dt))
                 
-                # 如果没有可行的恢复时间（理论上不应发生），则短暂休眠后重试
+                # 只因协调服务的广播而暂停时，等待恢复广播唤醒控制器
+                if not possible_resume_times and coordinator_paused:
+                    status.update(next_resume_time=None)
+                    profiling.record('controller.loop', time.perf_counter() - loop_start)
+                    _wait_paused(shared_state, pool, 60)
+                    continue
+
+                # 如果没有可行的恢复时间（理论上不应发生），则短暂等待后重试
                 if not possible_resume_times:
                     logger.warning("无法确定恢复时间，将在60秒后重试。")
-                    time.sleep(60)
+                    profiling.record('controller.loop', time.perf_counter() - loop_start)
+                    _wait_paused(shared_state, pool, 60)
                     continue
 
                 # 选择最晚的时间点，以确保所有暂停条件都已解除
                 next_resume_time = max(possible_resume_times)
+                status.update(next_resume_time=next_resume_time)
                 sleep_duration = (next_resume_time - now_dt).total_seconds()
 
                 if sleep_duration > 0:
-                    total_downloaded_gb = shared_state.get_bytes() / (1024**3)
-                    logger.info(
-                        f"[暂停] 总下载量: {total_downloaded_gb:.2f} GB | "
-                        f"计划下次恢复时间: {next_resume_time.strftime('%Y-%m-%d %H:%M:%S')}"
-                    )
-                    shared_state.save_state()
-                    time.sleep(sleep_duration)
+                    # 同一次暂停期间可能被多次唤醒，恢复时间不变时不重复报告
+                    if next_resume_time != announced_resume_time:
+                        total_downloaded_gb = shared_state.get_bytes() / (1024**3)
+                        logger.info(
+                            f"[暂停] 总下载量: {total_downloaded_gb:.2f} GB | "
+                            f"计划下次恢复时间: {next_resume_time.strftime('%Y-%m-%d %H:%M:%S')}"
+                        )
+                        _save_state(shared_state, scheduler, journal)
+                        announced_resume_time = next_resume_time
+                    # 等待到恢复时间；期间若收到通知则提前醒来重新评估
+                    profiling.record('controller.loop', time.perf_counter() - loop_start)
+                    _wait_paused(shared_state, pool, sleep_duration)
                 
-                # 休眠结束后，重新开始循环以评估新状态
+                # 等待结束后，重新开始循环以评估新状态
                 continue
             
             else:
                 # 如果应该恢复
                 if shared_state.is_paused():
                     shared_state.resume()
+                announced_resume_time = None
+                status.update(next_resume_time=None)
+
 
-                # 检查工作进程存活状态
-                alive_processes = [p for p in processes if p.is_alive()]
-                if len(alive_processes) < len(processes):
-                    logger.warning("一个或多个工作进程已退出。请检查日志以获取错误信息。")
-                if not alive_processes:
-                    logger.error("所有工作进程均已终止。正在关闭。")
-                    break
+                # 按总吞吐量的边际增益调整工作进程数
+                if autoscaler is not None:
+                    target_workers = autoscaler.update(pool.size, shared_state.get_bytes(),
+                                                       shared_state.get_rate_limit())
+                    if target_workers != pool.size:
+                        logger.info(f"自动伸缩：工作进程数 {pool.size} -> {target_workers}")
+                        pool.scale_to(target_workers)
 
                 # 定期打印状态报告
                 current_time = time.time()
-                if current_time - last_summary_time >= 5:
+                if current_time - last_summary_time >= SUMMARY_INTERVAL:
                     total_speed = shared_state.get_total_speed_mbps()
                     total_downloaded_gb = shared_state.get_bytes() / (1024**3)
-                    active_downloads = len([s for s in shared_state._process_speeds.values() if s > 0])
+                    active_downloads = shared_state.get_active_count()
+                    total_streams = pool.size * (max(1, config.STREAMS_PER_PROCESS)
+                                                 if config.HTTP_ENGINE == 'asyncio' else 1)
+                    if engine_process is not None:
+                        total_streams += config.TORRENT_MAX_ACTIVE
                     
+                    stats = shared_state.get_stats()
+                    wire_text = ""
+                    if accounting is not None:
+                        usage = accounting.info(sum(scheduler.source_bytes().values()))
+                        status.update(accounting=usage)
+                        wire_text = (f" | 线路/负载: {usage['wire_bytes'] / (1024**3):.2f}/"
+                                     f"{usage['payload_bytes'] / (1024**3):.2f} GB")
                     logger.info(
                         f"[下载] 总速度: {total_speed:.2f} MB/s | "
-                        f"活动连接: {active_downloads}/{config.CONCURRENT_DOWNLOADS} | "
-                        f"总下载量: {total_downloaded_gb:.2f} GB"
+                        f"活动连接: {active_downloads}/{total_streams} | "
+                        f"总下载量: {total_downloaded_gb:.2f} GB | "
+                        f"连接 新建/复用: {stats.get('conn_created', 0):.0f}/{stats.get('conn_reused', 0):.0f}"
+                        f"{wire_text}"
                     )
                     last_summary_time = current_time
-                    shared_state.save_state()
+                    _save_state(shared_state, scheduler, journal)
+
+                # 按时间窗口的速率目标和配额匀速模式调整全局速率
+                remaining_bytes = limit_bytes - shared_state.get_bytes()
+                if coordinator is not None:
+                    # 匀速模式按本节点分摊的全局剩余配额计算，而不是按当前租约
+                    remaining_bytes = coordinator.pacing_remaining(local_limit - shared_state.get_bytes())
+                target_rate = _target_rate(remaining_bytes, now)
+                current_rate = shared_state.get_rate_limit()
+                if abs(target_rate - current_rate) > 0.01 * max(target_rate, current_rate):
+                    shared_state.set_rate_limit(target_rate)
+                    # 匀速速率每个周期都会小幅变化，只报告明显的调整
+                    if not current_rate or not target_rate or abs(target_rate / current_rate - 1) > 0.1:
+                        rate_text = f"{target_rate * 8 / (1024 * 1024):.1f} Mbps" if target_rate else "不限速"
+                        logger.info(f"全局速率调整为: {rate_text}")
+
+                # 下载量越过配额时由工作进程唤醒控制器，无需逐秒轮询 (接口计量模式下由网卡采样发现)
+                shared_state.set_quota_alarm(limit_bytes)
 
-            # 短暂休眠，避免CPU空转
-            time.sleep(1)
+                # 等待到下一个定时器：状态报告、时间窗口边界、每日重置、自动伸缩周期、
+                # 工作进程的重启/排空期限或网卡采样 (接近上限时更密)，以先到者为准
+                now = datetime.now()
+                timeouts = [
+                    SUMMARY_INTERVAL - (time.time() - last_summary_time),
+                    (get_next_window_transition(now) - now).total_seconds(),
+                    (get_next_reset_time(now) - now).total_seconds(),
+                ]
+                next_sample = accounting and accounting.next_sample(limit_bytes - shared_state.get_bytes())
+                for deadline in (pool.next_deadline(), autoscaler and autoscaler.next_update(), next_sample):
+                    if deadline is not None:
+                        timeouts.append(deadline - time.monotonic())
+                timeout = min(timeouts)
+                profiling.record('controller.loop', time.perf_counter() - loop_start)
+                shared_state.wait_for_notification(max(0.0, timeout) + TIMER_SLACK)
 
     except KeyboardInterrupt:
         logger.info("收到关闭信号。正在终止工作进程。")
-        for p in processes:
-            p.terminate()
-            p.join()
-        shared_state.save_state()
+        pool.stop()
+        if coordinator is not None:
+            coordinator.stop()
+        if engine_process is not None:
+            engine_process.terminate()
+            engine_process.join()
+        _save_state(shared_state, scheduler, journal)
+        journal.checkpoint()
+        journal.close()
+        profiling.report()
         logger.info("关闭完成。")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TideFlowControl 下载流量控制器")
+    parser.add_argument('--profile', action='store_true', help="开启热路径剖析模式 (等同于 PROFILE=1)")
+    if parser.parse_args().profile:
+        profiling.enable()
     main()
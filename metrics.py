@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import config
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'tideflow'
+
+
+class ControllerStatus:
+    """
+    控制器在主循环中写入的状态 (暂停原因、下次恢复时间等)，供状态服务读取。
+    只由控制器线程整体赋值各属性，读取端不需要加锁。
+    """
+    def __init__(self):
+        self.limit_bytes = 0.0
+        self.pause_reasons = ()          # 例如 ('window', 'limit')
+        self.next_resume_time = None     # datetime，仅暂停时有值
+        self.next_transition_time = None # 下一个时间窗口边界 (datetime)
+        self.coordinator = None          # 多节点模式下 CoordinatorClient.info() 的结果
+        self.accounting = None           # 采样网卡计数时 InterfaceAccounting.info() 的结果
+
+    def update(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+
+def _timestamp(dt):
+    return dt.timestamp() if isinstance(dt, datetime) else None
+
+
+def collect(shared_state, scheduler, status):
+    """
+    汇总一次完整的状态快照 (可直接序列化为 JSON)。
+    shm 后端的各项读取都是对共享内存的无锁读取，抓取不会阻塞下载进程。
+    """
+    now = time.time()
+    downloaded = shared_state.get_bytes()
+    quota = shared_state.get_quota_info()
+    stats = shared_state.get_stats()
+
+    workers = {}
+    for worker, num_bytes in shared_state.get_worker_bytes().items():
+        workers.setdefault(worker, {'bytes': 0.0, 'tasks_ok': 0, 'tasks_failed': 0})['bytes'] = num_bytes
+    for name, value in stats.items():
+        kind, _, worker = name.partition('.')
+        if kind in ('tasks_ok', 'tasks_failed') and worker:
+            workers.setdefault(worker, {'bytes': 0.0, 'tasks_ok': 0, 'tasks_failed': 0})[kind] = int(value)
+
+    sources = {}
+    for link, st in scheduler.snapshot().items():
+        sources[link] = {
+            'type': st['type'],
+            'bytes': st['bytes'],
+            'seconds': st['seconds'],
+            'successes': st['successes'],
+            'failures': st['failures'],
+            'active': st['active'],
+            'throughput': st['rate_ewma'],
+            'ttfb': st['ttfb_ewma'] or None,
+            'backoff_remaining': max(0.0, st['backoff_until'] - now),
+        }
+
+    limit_bytes = status.limit_bytes
+    return {
+        'time': now,
+        'paused': shared_state.is_paused(),
+        'pause_reasons': list(status.pause_reasons),
+        'next_resume_time': _timestamp(status.next_resume_time),
+        'next_transition_time': _timestamp(status.next_transition_time),
+        'last_reset_time': shared_state.get_last_reset_time(),
+        'downloaded_bytes': downloaded,
+        'limit_bytes': limit_bytes,
+        'remaining_bytes': max(0.0, limit_bytes - downloaded),
+        'quota_granted_bytes': quota['granted'],
+        'quota_exhausted': quota['exhausted'],
+        'rate_limit': shared_state.get_rate_limit(),
+        # 速度槽位以 MB/s 汇报，这里统一换算为字节/秒；Manager 后端的键混有整数和 'T.n'，统一转为字符串以便排序
+        'speeds': {str(key): mbps * 1024 * 1024 for key, mbps in shared_state.get_speeds().items()},
+        'connections': {'created': stats.get('conn_created', 0), 'reused': stats.get('conn_reused', 0)},
+        'torrent_cache': {'hit': stats.get('torrent_cache_hit', 0), 'miss': stats.get('torrent_cache_miss', 0)},
+        'workers': workers,
+        'sources': sources,
+        'coordinator': status.coordinator,
+        'accounting': status.accounting,
+    }
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Writer:
+    """按 Prometheus 文本格式输出，每个指标名只输出一次 HELP/TYPE"""
+    def __init__(self):
+        self._lines = []
+
+    def metric(self, name, kind, help_text, samples):
+        """samples: [(标签字典, 值)]；值为 None 的样本被跳过"""
+        samples = [(labels, value) for labels, value in samples if value is not None]
+        if not samples:
+            return
+        full_name = f"{PREFIX}_{name}"
+        self._lines.append(f"# HELP {full_name} {help_text}")
+        self._lines.append(f"# TYPE {full_name} {kind}")
+        for labels, value in samples:
+            label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            self._lines.append(f"{full_name}{{{label_text}}} {float(value)!r}" if label_text
+                               else f"{full_name} {float(value)!r}")
+
+    def text(self):
+        return '\n'.join(self._lines) + '\n'
+
+
+def render_prometheus(snapshot):
+    w = _Writer()
+    w.metric('paused', 'gauge', '1 表示下载已暂停', [({}, snapshot['paused'])])
+    w.metric('pause_reason', 'gauge', '当前生效的暂停原因',
+             [({'reason': reason}, 1 if reason in snapshot['pause_reasons'] else 0)
+              for reason in ('window', 'limit', 'coordinator')])
+    w.metric('next_resume_timestamp_seconds', 'gauge', '计划恢复下载的时间', [({}, snapshot['next_resume_time'])])
+    w.metric('next_transition_timestamp_seconds', 'gauge', '下一个时间窗口边界',
+             [({}, snapshot['next_transition_time'])])
+    w.metric('last_reset_timestamp_seconds', 'gauge', '上次每日重置的时间', [({}, snapshot['last_reset_time'])])
+    w.metric('downloaded_bytes', 'gauge', '本配额周期内的下载量 (每日重置)', [({}, snapshot['downloaded_bytes'])])
+    w.metric('quota_limit_bytes', 'gauge', '每日下载上限', [({}, snapshot['limit_bytes'])])
+    w.metric('quota_remaining_bytes', 'gauge', '剩余配额', [({}, snapshot['remaining_bytes'])])
+    w.metric('quota_granted_bytes', 'gauge', '已分配给工作进程的配额 (含未用完的租约)',
+             [({}, snapshot['quota_granted_bytes'])])
+    w.metric('quota_exhausted', 'gauge', '1 表示配额租约已分配完', [({}, snapshot['quota_exhausted'])])
+    w.metric('rate_limit_bytes_per_second', 'gauge', '全局速率上限，0 表示不限速', [({}, snapshot['rate_limit'])])
+    w.metric('speed_bytes_per_second', 'gauge', '各下载流的瞬时速度',
+             [({'stream': key}, value) for key, value in sorted(snapshot['speeds'].items())])
+    w.metric('active_streams', 'gauge', '速度大于 0 的下载流数量',
+             [({}, len([v for v in snapshot['speeds'].values() if v > 0]))])
+    w.metric('connections_total', 'counter', 'HTTP 连接建立/复用次数',
+             [({'kind': kind}, value) for kind, value in snapshot['connections'].items()])
+    w.metric('torrent_cache_lookups_total', 'counter', '磁力链接缓存的命中/未命中次数',
+             [({'result': result}, value) for result, value in snapshot['torrent_cache'].items()])
+
+    coordinator = snapshot.get('coordinator')
+    if coordinator:
+        w.metric('coordinator_connected', 'gauge', '1 表示与协调服务保持联系，0 表示处于降级模式',
+                 [({'node': coordinator['node']}, coordinator['connected'])])
+        w.metric('coordinator_lease_bytes', 'gauge', '最近一次同步时本节点剩余的租约',
+                 [({'node': coordinator['node']}, coordinator['lease_bytes'])])
+        w.metric('coordinator_global_remaining_bytes', 'gauge', '协调服务报告的全局剩余配额',
+                 [({}, coordinator['global_remaining_bytes'])])
+
+    accounting = snapshot.get('accounting')
+    if accounting:
+        w.metric('accounting_bytes', 'gauge', '自启动或最近一次重置以来的线路字节数 (网卡计数) 和负载字节数',
+                 [({'kind': kind, 'interface': accounting['interface']}, accounting[f'{kind}_bytes'])
+                  for kind in ('wire', 'payload')])
+
+    workers = sorted(snapshot['workers'].items())
+    w.metric('worker_downloaded_bytes_total', 'counter', '各工作进程累计下载字节数',
+             [({'worker': name}, st['bytes']) for name, st in workers])
+    w.metric('worker_tasks_total', 'counter', '各工作进程完成的任务数',
+             [({'worker': name, 'result': result}, st[f'tasks_{result}'])
+              for name, st in workers for result in ('ok', 'failed')])
+
+    sources = sorted(snapshot['sources'].items())
+    w.metric('source_downloaded_bytes_total', 'counter', '各来源累计下载字节数 (任务结束时计入)',
+             [({'source': link, 'type': st['type']}, st['bytes']) for link, st in sources])
+    w.metric('source_tasks_total', 'counter', '各来源的任务数',
+             [({'source': link, 'type': st['type'], 'result': result},
+               st['successes'] if result == 'ok' else st['failures'])
+              for link, st in sources for result in ('ok', 'failed')])
+    w.metric('source_throughput_bytes_per_second', 'gauge', '各来源单次任务吞吐量的滑动平均',
+             [({'source': link, 'type': st['type']}, st['throughput']) for link, st in sources])
+    w.metric('source_ttfb_seconds', 'gauge', '各来源首字节时间的滑动平均',
+             [({'source': link, 'type': st['type']}, st['ttfb']) for link, st in sources])
+    w.metric('source_active', 'gauge', '各来源正在运行的任务数',
+             [({'source': link, 'type': st['type']}, st['active']) for link, st in sources])
+    w.metric('source_backoff_seconds', 'gauge', '各来源剩余的退避时间',
+             [({'source': link, 'type': st['type']}, st['backoff_remaining']) for link, st in sources])
+    return w.text()
+
+
+class MetricsServer:
+    """
+    基于标准库 http.server 的状态服务，在控制器进程的后台线程中运行。
+
+    - GET /metrics  Prometheus 文本格式
+    - GET /status   JSON 格式的完整快照
+    - GET /history  用量历史，参数 granularity=day|hour、source、start、end (见 StateJournal.history)
+    """
+    def __init__(self, shared_state, scheduler, status, journal=None, port=None, host=None):
+        self._shared_state = shared_state
+        self._scheduler = scheduler
+        self._status = status
+        self._journal = journal
+        self._address = (host or config.METRICS_HOST, config.METRICS_PORT if port is None else port)
+        self._server = None
+
+    def snapshot(self):
+        return collect(self._shared_state, self._scheduler, self._status)
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                path = parts.path
+                try:
+                    if path == '/metrics':
+                        body = render_prometheus(server.snapshot()).encode('utf-8')
+                        content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                    elif path in ('/status', '/'):
+                        body = json.dumps(server.snapshot(), ensure_ascii=False).encode('utf-8')
+                        content_type = 'application/json; charset=utf-8'
+                    elif path == '/history' and server._journal is not None:
+                        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+                        rows = server._journal.history(query.get('granularity', 'day'), query.get('source'),
+                                                       query.get('start'), query.get('end'))
+                        body = json.dumps(dict(rows), ensure_ascii=False).encode('utf-8')
+                        content_type = 'application/json; charset=utf-8'
+                    else:
+                        self.send_error(404)
+                        return
+                except Exception as e:
+                    logger.error(f"生成状态数据时发生错误: {e}")
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"状态服务请求: {format % args}")
+
+        self._server = ThreadingHTTPServer(self._address, Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="MetricsServer", daemon=True).start()
+        logger.info(f"状态服务已启动: http://{self._address[0]}:{self._server.server_port}/metrics")
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
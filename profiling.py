@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+热路径剖析模式 (PROFILE=1 或 python main.py --profile)，用于定位吞吐量下降时时间花在了哪里。
+
+- stage(name) / record(name, seconds) / timed_iter(name, iterable) 记录一次阶段耗时到本进程的直方图：
+  建立连接、首字节时间、每块接收、配额和限速等待、保存状态、libtorrent 事件处理等。
+- instrument(shared_state) 把共享状态的热路径方法 (add_bytes、is_paused、update_speed 等) 替换为计时版本。
+- 直方图按 2^k 微秒对数分桶，定期和进程退出时写入 PROFILE_DIR/<进程名>-<pid>.json；
+  控制器退出时汇总所有进程的文件，按工作进程打印各阶段的延迟分布。
+- PROFILE_SAMPLE_INTERVAL > 0 时，每个进程按 CPU 时间 (setitimer ITIMER_PROF) 采样所有线程的调用栈，
+  以折叠栈格式写入 <进程名>-<pid>.stacks，可直接交给 flamegraph.pl 或 speedscope。
+
+未开启时 stage() 返回共享的空上下文，timed_iter() 原样返回迭代器，instrument() 不做任何替换，
+热路径上几乎没有额外开销。
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import threading
+import contextlib
+import multiprocessing
+import multiprocessing.util
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# 直方图的桶数：第 k 个桶为 [2^(k-1), 2^k) 微秒，最后一个桶收纳所有更长的耗时
+NUM_BUCKETS = 36
+# 各进程把直方图写入文件的间隔 (秒)，进程被强制终止时最多丢失这段时间的数据
+DUMP_INTERVAL = 30
+# instrument() 默认计时的共享状态方法
+SHARED_STATE_METHODS = ('add_bytes', 'is_paused', 'update_speed', 'wait_for_quota', 'acquire_quota',
+                        'release_quota', 'throttle', 'reserve_bandwidth')
+
+enabled = config.PROFILE
+
+_NULL_STAGE = contextlib.nullcontext()
+# 可重入：SIGTERM 处理函数可能在主线程持有锁时执行并写出数据
+_lock = threading.RLock()
+_histograms = {}     # 阶段名 -> _Histogram
+_samples = {}        # 折叠栈 -> 采样次数
+_started = False
+_DUMP_THREAD = "ProfileDump"
+
+
+class _Histogram:
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * NUM_BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(NUM_BUCKETS - 1, int(seconds * 1e6).bit_length())] += 1
+
+    def merge(self, data):
+        self.count += data['count']
+        self.total += data['total']
+        self.max = max(self.max, data['max'])
+        for i, n in enumerate(data['buckets'][:NUM_BUCKETS]):
+            self.buckets[i] += n
+
+    def quantile(self, q):
+        """按桶的上界估算分位数，不超过实际最大值"""
+        target = q * self.count
+        seen = 0
+        for k, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return min(self.max, (2 ** k) / 1e6)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max, 'buckets': list(self.buckets)}
+
+
+class _Stage:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def enable():
+    """开启剖析模式 (命令行参数 --profile)，需在创建共享状态和启动工作进程之前调用"""
+    global enabled
+    enabled = config.PROFILE = True
+
+
+def record(name, seconds):
+    """记录阶段 name 的一次耗时 (秒)"""
+    if not enabled or seconds is None:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = _Histogram()
+        histogram.add(seconds)
+
+
+def stage(name):
+    """计时上下文：with stage('http.connect'): ..."""
+    if not enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def timed_iter(name, iterable):
+    """逐项计时的迭代器包装，记录每次取下一项 (例如接收下一块数据) 的耗时；未开启时原样返回"""
+    if not enabled:
+        return iterable
+    return _timed_iter(name, iter(iterable))
+
+
+def _timed_iter(name, iterator):
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        record(name, time.perf_counter() - start)
+        yield item
+
+
+def _timed_method(name, method):
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+    return timed
+
+
+def instrument(shared_state, methods=SHARED_STATE_METHODS):
+    """在实例上用计时版本覆盖共享状态的热路径方法 (阶段名为 state.<方法名>)，之后 fork 的进程同样生效"""
+    if not enabled:
+        return shared_state
+    for name in methods:
+        method = getattr(shared_state, name, None)
+        if method is not None:
+            setattr(shared_state, name, _timed_method(f"state.{name}", method))
+    return shared_state
+
+
+# ---- 调用栈采样 ----
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def _sample(signum, frame):
+    # 在主线程中执行，只做字典更新，不加锁
+    names = {t.ident: t.name for t in threading.enumerate()}
+    for ident, top in sys._current_frames().items():
+        if names.get(ident) == _DUMP_THREAD:
+            continue
+        stack = []
+        while top is not None:
+            stack.append(_frame_label(top))
+            top = top.f_back
+        stack.append(names.get(ident, f"Thread-{ident}"))
+        key = ';'.join(reversed(stack))
+        _samples[key] = _samples.get(key, 0) + 1
+
+
+def _start_sampler(interval):
+    if interval <= 0 or not hasattr(signal, 'setitimer'):
+        return
+    if threading.current_thread() is not threading.main_thread():
+        return
+    signal.signal(signal.SIGPROF, _sample)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+
+def _stop_sampler():
+    if hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread():
+        signal.setitimer(signal.ITIMER_PROF, 0)
+
+
+# ---- 进程生命周期 ----
+
+def _file_prefix():
+    name = multiprocessing.current_process().name
+    return os.path.join(config.PROFILE_DIR, f"{name}-{os.getpid()}")
+
+
+def dump():
+    """把本进程的直方图 (和采样到的调用栈) 写入 PROFILE_DIR"""
+    if not enabled:
+        return
+    with _lock:
+        stages = {name: h.to_dict() for name, h in _histograms.items()}
+    samples = _samples.copy()
+    prefix = _file_prefix()
+    try:
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        data = {'process': multiprocessing.current_process().name, 'pid': os.getpid(), 'stages': stages}
+        with open(prefix + '.json.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(prefix + '.json.tmp', prefix + '.json')
+        if samples:
+            with open(prefix + '.stacks.tmp', 'w') as f:
+                for stack, count in sorted(samples.items()):
+                    f.write(f"{stack} {count}\n")
+            os.replace(prefix + '.stacks.tmp', prefix + '.stacks')
+    except OSError as e:
+        logger.error(f"写入剖析数据失败 ({prefix}): {e}")
+
+
+def _dump_loop():
+    while True:
+        time.sleep(DUMP_INTERVAL)
+        dump()
+
+
+def _on_sigterm(signum, frame):
+    # 被控制器终止前先写出数据，再按默认行为退出，退出码与未开启剖析时一致
+    _stop_sampler()
+    dump()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def start():
+    """
+    在每个进程 (控制器、工作进程、Torrent 引擎) 开始工作时调用：开启调用栈采样和定期写出，
+    子进程还会在正常退出或被终止 (SIGTERM) 时写出数据。
+    """
+    global _started
+    if not enabled or _started:
+        return
+    _started = True
+    _start_sampler(config.PROFILE_SAMPLE_INTERVAL)
+    threading.Thread(target=_dump_loop, name=_DUMP_THREAD, daemon=True).start()
+    if multiprocessing.parent_process() is not None:
+        multiprocessing.util.Finalize(None, dump, exitpriority=100)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, _on_sigterm)
+
+
+def clear_dir():
+    """删除上次运行留下的剖析文件 (控制器启动时调用)"""
+    if not enabled:
+        return
+    try:
+        names = os.listdir(config.PROFILE_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.endswith(('.json', '.stacks', '.txt')):
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(config.PROFILE_DIR, name))
+
+
+def _reset_after_fork():
+    # 子进程不继承父进程的数据和锁；计时器和写出线程不会跨 fork 保留，由子进程重新 start()
+    global _lock, _histograms, _samples, _started
+    _lock = threading.RLock()
+    _histograms = {}
+    _samples = {}
+    _started = False
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# ---- 汇总报告 ----
+
+def _format_duration(seconds):
+    if seconds >= 1:
+        return f"{seconds:.2f}s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f}ms"
+    return f"{seconds * 1e6:.1f}µs"
+
+
+def _load_all():
+    """读取 PROFILE_DIR 中所有进程的直方图，按进程名 (同一序号重启的进程合并) 汇总"""
+    by_process = {}
+    try:
+        names = sorted(os.listdir(config.PROFILE_DIR))
+    except FileNotFoundError:
+        return by_process
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(config.PROFILE_DIR, name)) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"无法读取剖析文件 {name}: {e}")
+            continue
+        stages = by_process.setdefault(data.get('process', name), {})
+        for stage_name, values in data.get('stages', {}).items():
+            stages.setdefault(stage_name, _Histogram()).merge(values)
+    return by_process
+
+
+def _table(title, stages):
+    lines = [f"== {title} ==",
+             f"{'阶段':<24}{'次数':>10}{'平均':>11}{'p50':>11}{'p90':>11}{'p99':>11}{'最大':>11}{'总耗时':>11}"]
+    for name, h in sorted(stages.items(), key=lambda item: -item[1].total):
+        if not h.count:
+            continue
+        lines.append(f"{name:<24}{h.count:>10}{_format_duration(h.total / h.count):>11}"
+                     f"{_format_duration(h.quantile(0.5)):>11}{_format_duration(h.quantile(0.9)):>11}"
+                     f"{_format_duration(h.quantile(0.99)):>11}{_format_duration(h.max):>11}"
+                     f"{_format_duration(h.total):>11}")
+    return lines
+
+
+def report():
+    """写出控制器自身的数据，汇总所有进程的直方图并打印报告 (控制器退出时调用)，同时保存为 report.txt"""
+    if not enabled:
+        return
+    _stop_sampler()
+    dump()
+    by_process = _load_all()
+    if not by_process:
+        logger.info("剖析模式：没有收集到数据。")
+        return
+    lines = []
+    workers = {}
+    for process, stages in sorted(by_process.items()):
+        lines += _table(process, stages)
+        if process.startswith('Worker-'):
+            for name, h in stages.items():
+                workers.setdefault(name, _Histogram()).merge(h.to_dict())
+    if workers:
+        lines += _table("全部工作进程", workers)
+    text = '\n'.join(lines)
+    logger.info(f"剖析报告 (数据位于 {config.PROFILE_DIR}):\n{text}")
+    try:
+        with open(os.path.join(config.PROFILE_DIR, 'report.txt'), 'w') as f:
+            f.write(text + '\n')
+    except OSError as e:
+        logger.error(f"写入剖析报告失败: {e}")
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import mmap
+import ctypes
+import threading
+import multiprocessing
+import weakref
+
+import config
+
+
+class _QuotaState(ctypes.Structure):
+    _fields_ = [
+        ('limit', ctypes.c_double),      # 当前配额周期内可分配的总字节数
+        ('granted', ctypes.c_double),    # 已分配出去的字节数 (含尚未用完的租约)
+        ('epoch', ctypes.c_int64),       # 每次重设配额时递增，旧租约随之作废
+        ('exhausted', ctypes.c_int64),   # 有进程申请配额被拒绝
+        ('leases', ctypes.c_double),     # 累计分配的租约数量
+        ('exhausted_since', ctypes.c_double),  # 首次拒绝的时间 (time.time())
+    ]
+
+
+class QuotaAllocator:
+    """
+    基于租约的配额分配器，保证每日下载上限不会被超出。
+
+    每个进程一次从共享配额中申领一块租约 (默认 64 MB)，之后在本地扣减，不需要任何 IPC；
+    本地租约用完时再去申领。剩余配额越少，租约越小，最后一点配额会被精确地分完。
+    某个进程申请被拒绝时设置 exhausted 标志，此时配额已全部分出，但其他进程手中可能还有租约；
+    控制器等这些租约用完 (已分配量与实际下载量之差不超过 drain_slack 字节) 或等待超过 drain_timeout 秒后才暂停，
+    否则这部分配额会被搁置，实际下载量达不到上限。
+    """
+    def __init__(self, consumers=1, lease_bytes=None, min_lease_bytes=None, drain_slack=None, drain_timeout=None):
+        self._buf = mmap.mmap(-1, ctypes.sizeof(_QuotaState))
+        self._state = _QuotaState.from_buffer(self._buf)
+        self._state.limit = float('inf')
+        self._lock = multiprocessing.Lock()
+        self._consumers = max(1, consumers)
+        self._lease_bytes = lease_bytes or config.QUOTA_LEASE_BYTES
+        self._min_lease_bytes = min_lease_bytes or config.QUOTA_MIN_LEASE_BYTES
+        self._drain_slack = config.CHUNK_SIZE if drain_slack is None else drain_slack
+        self._drain_timeout = config.QUOTA_DRAIN_TIMEOUT if drain_timeout is None else drain_timeout
+        self._local_lock = threading.Lock()
+        self._forget_local()
+
+        ref = weakref.ref(self)
+        def _after_fork():
+            allocator = ref()
+            if allocator is not None:
+                allocator._forget_local()
+        os.register_at_fork(after_in_child=_after_fork)
+
+    def _forget_local(self):
+        self._local = 0.0
+        self._local_epoch = -1
+
+    def set_quota(self, limit_bytes, used_bytes=0.0):
+        """开始新的配额周期 (启动或每日重置时)，作废所有进程手中尚未用完的租约"""
+        with self._lock:
+            st = self._state
+            st.limit = float('inf') if limit_bytes is None else limit_bytes
+            st.granted = used_bytes
+            st.epoch += 1
+            st.exhausted = 0
+
+    def set_limit(self, limit_bytes):
+        """在当前配额周期内调整总上限 (例如协调服务追加了租约)，已分配给各进程的租约继续有效"""
+        with self._lock:
+            st = self._state
+            st.limit = limit_bytes
+            if st.granted < limit_bytes:
+                st.exhausted = 0
+
+    def _lease_size(self, want):
+        """调用方必须持有 self._lock。剩余配额接近 0 时按消费者数量缩小租约"""
+        remaining = self._state.limit - self._state.granted
+        adaptive = max(self._min_lease_bytes, remaining / (2 * self._consumers))
+        return max(0.0, min(remaining, max(want, min(self._lease_bytes, adaptive))))
+
+    def acquire(self, num_bytes):
+        """
+        从本地租约中扣减最多 num_bytes 字节，返回实际获得的字节数。
+        返回值小于 num_bytes 表示配额已经用完。
+        """
+        with self._local_lock:
+            epoch = self._state.epoch
+            if self._local_epoch != epoch:
+                self._local = 0.0
+                self._local_epoch = epoch
+            if self._local < num_bytes:
+                with self._lock:
+                    if self._state.epoch == epoch:
+                        grant = self._lease_size(num_bytes - self._local)
+                        self._state.granted += grant
+                        self._state.leases += 1
+                        self._local += grant
+                        if self._local < num_bytes and not self._state.exhausted:
+                            self._state.exhausted = 1
+                            self._state.exhausted_since = time.time()
+            granted = min(self._local, num_bytes)
+            self._local -= granted
+            return int(granted)
+
+    def release(self, num_bytes):
+        """归还预留但未使用的字节到本地租约"""
+        if num_bytes > 0:
+            with self._local_lock:
+                self._local += num_bytes
+
+    def is_exhausted(self, used_bytes=None):
+        """
+        配额是否已经用完。给出本周期的实际下载量 used_bytes 时，还要求其他进程手中的租约已经用完，
+        或者距首次拒绝已超过 drain_timeout 秒
+        """
+        st = self._state
+        if not st.exhausted:
+            return False
+        if used_bytes is None:
+            return True
+        return st.granted - used_bytes <= self._drain_slack or time.time() - st.exhausted_since >= self._drain_timeout
+
+    def info(self):
+        st = self._state
+        return {'limit': st.limit, 'granted': st.granted, 'leases': st.leases, 'exhausted': bool(st.exhausted)}
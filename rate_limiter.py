@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import time
+import ctypes
+import multiprocessing
+import weakref
+
+
+class _BucketState(ctypes.Structure):
+    _fields_ = [
+        ('rate', ctypes.c_double),      # 字节/秒，0 表示不限速
+        ('tokens', ctypes.c_double),    # 当前令牌数，可以为负 (欠账)
+        ('last', ctypes.c_double),      # 上次补充令牌的 time.monotonic()
+    ]
+
+
+class TokenBucket:
+    """
+    所有工作进程共享的令牌桶，状态保存在匿名共享内存中 (通过 fork 继承)。
+
+    为避免每个数据块都去争用共享锁，每个进程一次从共享桶中批量预取
+    batch_seconds 秒的令牌到本地额度中，之后的数据块只扣减本地额度。
+    令牌不足时允许欠账，调用方按返回的延迟时间等待，从而把总速率压在上限附近。
+    """
+    def __init__(self, rate_bytes=0.0, burst_seconds=0.2, batch_seconds=0.02):
+        self._buf = mmap.mmap(-1, ctypes.sizeof(_BucketState))
+        self._state = _BucketState.from_buffer(self._buf)
+        self._lock = multiprocessing.Lock()
+        self._burst_seconds = burst_seconds
+        self._batch_seconds = batch_seconds
+        self._state.rate = rate_bytes
+        self._state.tokens = rate_bytes * burst_seconds
+        self._state.last = time.monotonic()
+        self._local = 0.0
+
+        ref = weakref.ref(self)
+        def _after_fork():
+            bucket = ref()
+            if bucket is not None:
+                bucket._local = 0.0
+        os.register_at_fork(after_in_child=_after_fork)
+
+    def _refill(self, now):
+        """调用方必须持有 self._lock"""
+        st = self._state
+        st.tokens = min(st.rate * self._burst_seconds, st.tokens + (now - st.last) * st.rate)
+        st.last = now
+
+    def get_rate(self):
+        return self._state.rate
+
+    def set_rate(self, rate_bytes):
+        """修改全局速率上限 (字节/秒)，0 表示不限速"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._state.rate = rate_bytes
+            self._state.tokens = min(self._state.tokens, rate_bytes * self._burst_seconds)
+
+    def reserve(self, num_bytes):
+        """
+        为 num_bytes 字节扣减令牌，返回调用方应等待的秒数 (不会阻塞)。
+        """
+        if self._local >= num_bytes:
+            self._local -= num_bytes
+            return 0.0
+        rate = self._state.rate
+        if rate <= 0:
+            self._local = 0.0
+            return 0.0
+
+        want = max(num_bytes - self._local, rate * self._batch_seconds)
+        with self._lock:
+            self._refill(time.monotonic())
+            self._state.tokens -= want
+            deficit = -self._state.tokens
+        self._local += want - num_bytes
+        return deficit / rate if deficit > 0 else 0.0
+
+    def throttle(self, num_bytes):
+        """阻塞版本的 reserve：令牌不足时在本进程内休眠"""
+        delay = self.reserve(num_bytes)
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+编译后的下载时间表。
+
+命名为 schedule_engine 而不是 schedule，以免与 requirements.txt 中的第三方 schedule 包冲突。
+
+ALLOWED_TIME_WINDOWS 中的每一项都会被展开到一周 (周一 00:00 起的秒数) 上，
+再切分成互不重叠、按起点排序的区段，每个区段记录"是否允许下载"和"速率目标"。
+查询当前状态和下一个边界只需一次二分查找 (O(log n))，不再在每次调用时解析字符串。
+"""
+
+import bisect
+import logging
+from datetime import datetime, time as dt_time, timedelta
+
+import config
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 3600
+WEEK = 7 * DAY
+
+
+def _seconds_of_day(time_str):
+    if time_str == '24:00':
+        return DAY
+    t = dt_time.fromisoformat(time_str)
+    return t.hour * 3600 + t.minute * 60 + t.second
+
+
+class Schedule:
+    """
+    一周内的允许下载区段表。
+
+    :param windows: [(开始, 结束, 星期集合, 速率目标 Mbps)]，与 config.parse_time_windows 的返回值相同；
+                    也接受旧的 (开始, 结束) 二元组，表示每天、不限速率
+    :param reset_time: 每日重置时间 "HH:MM"
+    """
+    def __init__(self, windows, reset_time='00:00'):
+        intervals = []
+        for window in windows:
+            start_str, end_str = window[0], window[1]
+            days = window[2] if len(window) > 2 and window[2] else range(7)
+            rate_mbps = window[3] if len(window) > 3 else None
+            start = _seconds_of_day(start_str)
+            end = _seconds_of_day(end_str)
+            # 历史配置用 "23:59" 表示到当天结束
+            if end_str == '23:59':
+                end = DAY
+            length = end - start if end > start else end + DAY - start
+            rate = rate_mbps * 1024 * 1024 / 8 if rate_mbps else None
+            for day in days:
+                begin = day * DAY + start
+                intervals.append((begin, begin + length, rate))
+
+        # 所有区间的端点 (折回一周之内) 把一周切成若干区段
+        boundaries = {0}
+        for begin, end, _ in intervals:
+            boundaries.add(begin % WEEK)
+            boundaries.add(end % WEEK)
+        starts = sorted(boundaries)
+
+        states = []
+        for i, seg_start in enumerate(starts):
+            covering = [rate for begin, end, rate in intervals
+                        if self._covers(begin, end, seg_start)]
+            if not covering:
+                states.append((False, None))
+            elif any(rate is None for rate in covering):
+                # 重叠的窗口中只要有一个不限速，该区段就不限速；否则取最大的速率目标
+                states.append((True, None))
+            else:
+                states.append((True, max(covering)))
+
+        # 合并状态相同的相邻区段
+        self._starts, self._states = [], []
+        for seg_start, state in zip(starts, states):
+            if self._states and self._states[-1] == state:
+                continue
+            self._starts.append(seg_start)
+            self._states.append(state)
+        # 跨越周日 24:00 的窗口：周末与周一开头的区段状态相同时合并，周一 00:00 不算状态变化。
+        # 此时第一个区段起点不为 0，周一开头的时刻按二分查找落在上一周的最后一个区段 (索引 -1)
+        if len(self._states) > 1 and self._states[0] == self._states[-1]:
+            del self._starts[0], self._states[0]
+        self._reset_seconds = _seconds_of_day(reset_time)
+
+    @staticmethod
+    def _covers(begin, end, point):
+        """区间 [begin, end) 在一周的环上是否覆盖 point"""
+        if end - begin >= WEEK:
+            return True
+        begin %= WEEK
+        end %= WEEK
+        if begin < end:
+            return begin <= point < end
+        return point >= begin or point < end
+
+    # ---- 查询 ----
+
+    @staticmethod
+    def _week_seconds(now):
+        return now.weekday() * DAY + now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1e6
+
+    def _index(self, now):
+        return bisect.bisect_right(self._starts, self._week_seconds(now)) - 1
+
+    def _segment_start(self, now, index):
+        """第 index 个区段 (可以超出一周，按周折算) 在 now 所在周中的起始时间"""
+        week_start = (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+        weeks, i = divmod(index, len(self._starts))
+        return week_start + timedelta(seconds=weeks * WEEK + self._starts[i])
+
+    def state(self, now=None):
+        """返回 (是否允许下载, 速率目标 字节/秒 或 None)"""
+        return self._states[self._index(now or datetime.now())]
+
+    def is_allowed(self, now=None):
+        return self.state(now)[0]
+
+    def rate_target(self, now=None):
+        return self.state(now)[1]
+
+    def next_transition(self, now=None):
+        """下一个状态变化的时间点；时间表全天不变时返回 None"""
+        now = now or datetime.now()
+        if len(self._starts) == 1:
+            return None
+        return self._segment_start(now, self._index(now) + 1)
+
+    def next_allowed_start(self, now=None):
+        """下一个允许下载区段的开始时间；当前已允许时返回下一个新区段的开始，完全不允许时返回 None"""
+        now = now or datetime.now()
+        index = self._index(now)
+        for offset in range(1, len(self._starts) + 1):
+            if self._states[(index + offset) % len(self._states)][0]:
+                return self._segment_start(now, index + offset)
+        return None
+
+    def allowed_seconds(self, start, end):
+        """[start, end) 之间允许下载的总秒数"""
+        total = 0.0
+        index = self._index(start)
+        seg_begin = start
+        while seg_begin < end:
+            seg_end = min(end, self._segment_start(start, index + 1))
+            if self._states[index % len(self._states)][0]:
+                total += (seg_end - seg_begin).total_seconds()
+            seg_begin = seg_end
+            index += 1
+        return total
+
+    def next_reset(self, now=None):
+        """下一次每日重置的时间点"""
+        now = now or datetime.now()
+        reset = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(seconds=self._reset_seconds)
+        if now >= reset:
+            reset += timedelta(days=1)
+        return reset
+
+    def previous_reset(self, now=None):
+        """最近一次已经到达的每日重置时间点"""
+        return self.next_reset(now) - timedelta(days=1)
+
+    def pacing_rate(self, remaining_bytes, now=None):
+        """
+        把剩余配额均匀分摊到下次重置前剩余的允许下载时间上，返回所需的速率 (字节/秒)。
+        剩余时间内不再允许下载时返回 None (不限制)。
+        """
+        now = now or datetime.now()
+        seconds = self.allowed_seconds(now, self.next_reset(now))
+        if seconds <= 0:
+            return None
+        return max(0.0, remaining_bytes) / seconds
+
+
+_schedule = None
+
+
+def get_schedule():
+    """按当前配置编译的时间表，每个进程只编译一次"""
+    global _schedule
+    if _schedule is None:
+        _schedule = Schedule(config.ALLOWED_TIME_WINDOWS, config.RESET_TIME)
+    return _schedule
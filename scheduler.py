@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import mmap
+import ctypes
+import random
+import logging
+import multiprocessing
+from urllib.parse import urlsplit
+
+import config
+from journal import atomic_write_text
+
+logger = logging.getLogger(__name__)
+
+# 吞吐量和首字节时间的指数滑动平均系数
+EWMA_ALPHA = 0.3
+# 没有可选来源时，调用方两次尝试之间的最短/最长等待 (秒)
+MIN_RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 5.0
+# 活动任务登记表在并发上限之外预留的余量 (例如进程重启期间新旧进程的登记短暂并存)
+CLAIM_HEADROOM = 8
+
+
+def _max_claims():
+    """同时登记的活动任务数上限 (所有进程合计)：每个工作进程的每个流一个，加上 Torrent 引擎的并发种子数"""
+    streams = config.MAX_WORKERS * max(1, config.STREAMS_PER_PROCESS)
+    return streams + max(0, config.TORRENT_MAX_ACTIVE) + CLAIM_HEADROOM
+
+
+class _SourceStats(ctypes.Structure):
+    _fields_ = [
+        ('bytes', ctypes.c_double),              # 累计下载字节数
+        ('seconds', ctypes.c_double),            # 累计下载用时
+        ('successes', ctypes.c_int64),
+        ('failures', ctypes.c_int64),
+        ('consecutive_failures', ctypes.c_int64),
+        ('rate_ewma', ctypes.c_double),          # 单次任务平均吞吐量 (字节/秒) 的滑动平均
+        ('ttfb_ewma', ctypes.c_double),          # 首字节时间 (秒) 的滑动平均，0 表示尚无数据
+        ('backoff_until', ctypes.c_double),      # 退避结束的时间戳 (time.time())
+        ('active', ctypes.c_int64),              # 正在执行该来源的任务数
+        ('_pad', ctypes.c_char * 56),            # 补齐到 128 字节，避免相邻来源共享缓存行
+    ]
+
+
+class _Claim(ctypes.Structure):
+    """一个正在执行的任务：执行它的进程和来源序号，pid 为 0 表示空闲"""
+    _fields_ = [
+        ('pid', ctypes.c_int64),
+        ('index', ctypes.c_int64),
+    ]
+
+
+# 持久化的字段；active 只在本次运行内有意义
+_PERSISTED_FIELDS = ('bytes', 'seconds', 'successes', 'failures', 'consecutive_failures',
+                     'rate_ewma', 'ttfb_ewma', 'backoff_until')
+
+
+class TaskScheduler:
+    """
+    按吞吐量加权的任务调度器，取代 random.choice。
+
+    - 每个来源 (URL 或磁力链接) 的统计保存在 fork 继承的共享内存中，所有工作进程共用。
+    - 选择权重 = 吞吐量滑动平均 × 成功率 (拉普拉斯平滑)，尚未尝试过的来源按当前最高权重乐观对待；
+      另有 SCHEDULER_EXPLORE 的概率均匀随机选择，以便发现变快的来源。
+    - 失败 (异常、返回失败或 0 字节) 的来源按 base × 2^(连续失败次数-1) 指数退避，成功一次即清零。
+    - 同一主机上同时运行的任务数不超过 SCHEDULER_MAX_PER_HOST (0 表示不限制)。
+    - 统计由控制器定期写入 SCHEDULER_STATE_FILE，重启后继续使用。
+    - 每个活动任务登记了执行它的进程，进程异常退出时由控制器调用 release_process() 释放。
+    """
+    def __init__(self, tasks, max_per_host=None, backoff_base=None, backoff_max=None, explore=None):
+        self._tasks = list(tasks)
+        self._hosts = [urlsplit(link).hostname if task_type == 'http' else None
+                       for task_type, link in self._tasks]
+        self._max_per_host = config.SCHEDULER_MAX_PER_HOST if max_per_host is None else max_per_host
+        self._backoff_base = config.SCHEDULER_BACKOFF_BASE if backoff_base is None else backoff_base
+        self._backoff_max = config.SCHEDULER_BACKOFF_MAX if backoff_max is None else backoff_max
+        self._explore = config.SCHEDULER_EXPLORE if explore is None else explore
+
+        stats_size = max(1, len(self._tasks)) * ctypes.sizeof(_SourceStats)
+        num_claims = _max_claims()
+        self._buf = mmap.mmap(-1, stats_size + num_claims * ctypes.sizeof(_Claim))
+        self._stats = (_SourceStats * max(1, len(self._tasks))).from_buffer(self._buf)
+        self._claims = (_Claim * num_claims).from_buffer(self._buf, stats_size)
+        self._lock = multiprocessing.Lock()
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def source(self, index):
+        """返回 (任务类型, 链接)"""
+        return self._tasks[index]
+
+    def index_of(self, link):
+        for i, (_, task_link) in enumerate(self._tasks):
+            if task_link == link:
+                return i
+        return None
+
+    # ---- 选择 ----
+
+    def _score(self, st):
+        attempts = st.successes + st.failures
+        return st.rate_ewma * (st.successes + 1) / (attempts + 2)
+
+    def _eligible(self, task_types, exclude, now):
+        """调用方必须持有 self._lock。返回当前可以选择的来源序号"""
+        host_active = {}
+        if self._max_per_host > 0:
+            for i, host in enumerate(self._hosts):
+                if host is not None:
+                    host_active[host] = host_active.get(host, 0) + self._stats[i].active
+        eligible = []
+        for i, (task_type, _) in enumerate(self._tasks):
+            if task_types is not None and task_type not in task_types:
+                continue
+            if i in exclude or self._stats[i].backoff_until > now:
+                continue
+            host = self._hosts[i]
+            if host is not None and host_active.get(host, 0) >= self._max_per_host > 0:
+                continue
+            eligible.append(i)
+        return eligible
+
+    def choose(self, task_types=None, exclude=()):
+        """
+        选择下一个要执行的来源并登记为活动，返回其序号；没有可选来源时返回 None。
+        调用方在任务结束后必须调用 finish()。
+
+        :param task_types: 允许的任务类型，例如 ('http',)；None 表示不限
+        :param exclude: 不参与本次选择的来源序号
+        """
+        now = time.time()
+        with self._lock:
+            eligible = self._eligible(task_types, exclude, now)
+            if not eligible:
+                return None
+            if random.random() < self._explore:
+                index = random.choice(eligible)
+            else:
+                scores = [self._score(self._stats[i]) for i in eligible]
+                # 尚无成功记录的来源按当前最高权重乐观对待，保证每个来源都会被尝试
+                optimistic = max(scores) or 1.0
+                weights = [s if self._stats[i].successes else max(s, optimistic)
+                           for i, s in zip(eligible, scores)]
+                index = random.choices(eligible, weights=weights)[0]
+            self._stats[index].active += 1
+            self._claim(index)
+            return index
+
+    def _claim(self, index):
+        """调用方必须持有 self._lock。登记表已满时只计数，不登记"""
+        for claim in self._claims:
+            if claim.pid == 0:
+                claim.pid = os.getpid()
+                claim.index = index
+                return
+        logger.warning(f"活动任务登记表已满 ({len(self._claims)})，来源 {index} 的任务未登记，"
+                       f"执行它的进程异常退出时其活动计数不会被释放。")
+
+    def _unclaim(self, index):
+        """调用方必须持有 self._lock"""
+        pid = os.getpid()
+        for claim in self._claims:
+            if claim.pid == pid and claim.index == index:
+                claim.pid = 0
+                return
+
+    def retry_delay(self, task_types=None):
+        """choose() 返回 None 时建议的等待时间：到最早一个退避结束为止，限制在合理范围内"""
+        now = time.time()
+        with self._lock:
+            waits = [self._stats[i].backoff_until - now
+                     for i, (task_type, _) in enumerate(self._tasks)
+                     if task_types is None or task_type in task_types]
+        if not waits:
+            return MAX_RETRY_DELAY
+        return min(MAX_RETRY_DELAY, max(MIN_RETRY_DELAY, min(waits)))
+
+    # ---- 结果反馈 ----
+
+    def finish(self, index, result):
+        """
+        记录一次任务的结果并释放活动计数。
+
+        :param result: 下载函数返回的 DownloadResult；None 表示任务抛出了异常
+        """
+        now = time.time()
+        with self._lock:
+            st = self._stats[index]
+            st.active = max(0, st.active - 1)
+            self._unclaim(index)
+            num_bytes = result.bytes if result is not None else 0
+            duration = result.duration if result is not None else 0.0
+            st.bytes += num_bytes
+            st.seconds += duration
+            if num_bytes > 0 and duration > 0:
+                rate = num_bytes / duration
+                st.rate_ewma = rate if st.rate_ewma == 0 else (1 - EWMA_ALPHA) * st.rate_ewma + EWMA_ALPHA * rate
+            if result is not None and result.ttfb is not None:
+                st.ttfb_ewma = (result.ttfb if st.ttfb_ewma == 0
+                                else (1 - EWMA_ALPHA) * st.ttfb_ewma + EWMA_ALPHA * result.ttfb)
+
+            if result is not None and result.ok and num_bytes > 0:
+                st.successes += 1
+                st.consecutive_failures = 0
+                st.backoff_until = 0.0
+                return
+            st.failures += 1
+            st.consecutive_failures += 1
+            backoff = min(self._backoff_max, self._backoff_base * 2 ** (st.consecutive_failures - 1))
+            st.backoff_until = now + backoff
+            consecutive_failures = st.consecutive_failures
+        logger.info(f"来源连续失败 {consecutive_failures} 次，退避 {backoff:.0f} 秒: {self._tasks[index][1][:60]}")
+
+    def release_process(self, pid):
+        """
+        释放已退出进程登记的所有活动任务 (不计入成功或失败)，返回释放的数量。
+        进程被终止或崩溃时来不及调用 finish()，否则这些来源的活动计数会一直占用主机并发上限。
+        """
+        released = 0
+        with self._lock:
+            for claim in self._claims:
+                if claim.pid == pid:
+                    st = self._stats[claim.index]
+                    st.active = max(0, st.active - 1)
+                    claim.pid = 0
+                    released += 1
+        return released
+
+    # ---- 统计与持久化 ----
+
+    def snapshot(self):
+        """
+        返回 {链接: 统计字典} 的快照。
+        不加锁：每个字段都是 8 字节对齐的单次读取，状态服务频繁抓取时不会阻塞工作进程。
+        """
+        result = {}
+        for i, (task_type, link) in enumerate(self._tasks):
+            st = self._stats[i]
+            entry = {name: getattr(st, name) for name in _PERSISTED_FIELDS}
+            entry['type'] = task_type
+            entry['active'] = st.active
+            result[link] = entry
+        return result
+
+    def source_bytes(self):
+        """返回 {链接: 累计下载字节数}，不加锁"""
+        return {link: self._stats[i].bytes for i, (_, link) in enumerate(self._tasks)}
+
+    def save_state(self, path=None):
+        path = path or config.SCHEDULER_STATE_FILE
+        sources = self.snapshot()
+        for entry in sources.values():
+            del entry['active']
+        atomic_write_text(path, json.dumps({'sources': sources}))
+        logger.debug(f"调度器统计已保存: {len(sources)} 个来源")
+
+    def load_state(self, path=None):
+        path = path or config.SCHEDULER_STATE_FILE
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as f:
+                sources = json.load(f).get('sources', {})
+        except (OSError, ValueError) as e:
+            logger.warning(f"无法读取调度器统计文件 {path}: {e}")
+            return
+        loaded = 0
+        with self._lock:
+            for i, (_, link) in enumerate(self._tasks):
+                entry = sources.get(link)
+                if entry is None:
+                    continue
+                for name in _PERSISTED_FIELDS:
+                    if name in entry:
+                        setattr(self._stats[i], name, type(getattr(self._stats[i], name))(entry[name]))
+                loaded += 1
+        logger.info(f"调度器统计已加载：{loaded}/{len(self._tasks)} 个来源有历史记录。")
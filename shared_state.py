@@ -1,18 +1,157 @@
 # -*- coding: utf-8 -*-
 
 import time
-import json
 import os
+import mmap
+import ctypes
 import logging
-from datetime import datetime
+import threading
+import multiprocessing
+import weakref
 
 import config
+from rate_limiter import TokenBucket
+from quota import QuotaAllocator
 
 logger = logging.getLogger(__name__)
 
-class SharedState:
+# 工作进程每累计下载这么多字节，检查一次是否越过了控制器设置的配额告警线
+ALARM_CHECK_BYTES = 8 * 1024 * 1024
+
+
+def _quota_consumers():
+    """同时申领配额租约的消费者数量：每个 HTTP 流一个，Torrent 引擎一个"""
+    streams = config.MAX_WORKERS
+    if config.HTTP_ENGINE == 'asyncio':
+        streams *= max(1, config.STREAMS_PER_PROCESS)
+    return streams + 1
+
+
+class _ControlPlane:
+    """
+    两种共享状态后端共用的控制面：全局令牌桶，以及基于事件的暂停/恢复和控制器唤醒。
+
+    - 暂停状态同时体现为两个 multiprocessing.Event，工作进程阻塞等待，而不是轮询 + sleep。
+    - 控制器在定时器到期或收到通知 (例如下载量越过配额告警线) 时才被唤醒。
+    - 每日配额通过租约分配 (见 quota.QuotaAllocator)，保证总下载量不会超出上限。
+    - 接口计量模式 (ACCOUNTING_MODE=interface) 下由控制器按网卡计数调用 add_wire_bytes 计入下载量，
+      工作进程的 add_bytes 和配额租约都直接返回，热路径上没有任何计量相关的写入。
+    事件对象通过 fork 继承，不经过 Manager 进程。
+    """
+    def _init_control_plane(self):
+        self._rate_limiter = TokenBucket(config.MAX_RATE_BYTES)
+        self._quota = QuotaAllocator(_quota_consumers())
+        self._running = multiprocessing.Event()
+        self._running.set()
+        self._paused_event = multiprocessing.Event()
+        self._wake = multiprocessing.Event()
+        self._quota_alarm = multiprocessing.RawValue(ctypes.c_double, float('inf'))
+        self._since_alarm_check = 0
+        self._count_payload = config.ACCOUNTING_MODE != 'interface'
+
+    def _set_paused_events(self, paused):
+        if paused:
+            self._running.clear()
+            self._paused_event.set()
+        else:
+            self._paused_event.clear()
+            self._running.set()
+
+    def _check_alarm(self, num_bytes):
+        """由 add_bytes 调用：按批检查总下载量是否越过告警线，越过则唤醒控制器"""
+        self._since_alarm_check += num_bytes
+        if self._since_alarm_check >= ALARM_CHECK_BYTES:
+            self._since_alarm_check = 0
+            if self.get_bytes() >= self._quota_alarm.value:
+                self._wake.set()
+
+    def wait_until_resumed(self, timeout=None):
+        """阻塞直到执行恢复 (或超时)，返回是否处于运行状态"""
+        return self._running.wait(timeout)
+
+    def wait_until_paused(self, timeout=None):
+        """阻塞直到执行被暂停 (或超时)，返回是否处于暂停状态"""
+        return self._paused_event.wait(timeout)
+
+    def set_quota_alarm(self, num_bytes):
+        """设置配额告警线 (字节)，总下载量越过后唤醒控制器；None 表示取消"""
+        self._quota_alarm.value = float('inf') if num_bytes is None else num_bytes
+
+    def notify_controller(self):
+        self._wake.set()
+
+    def wait_for_notification(self, timeout=None):
+        """控制器在此等待，直到超时或被通知，返回是否被通知唤醒"""
+        notified = self._wake.wait(timeout)
+        self._wake.clear()
+        return notified
+
+    def set_quota(self, limit_bytes, used_bytes=0.0):
+        """开始新的配额周期：总上限 limit_bytes，其中 used_bytes 已被使用"""
+        self._quota.set_quota(limit_bytes, used_bytes)
+
+    def set_quota_limit(self, limit_bytes):
+        """调整当前配额周期的上限，不作废各进程手中的租约"""
+        self._quota.set_limit(limit_bytes)
+
+    def acquire_quota(self, num_bytes):
+        """从本进程的配额租约中扣减最多 num_bytes 字节，返回实际获得的字节数 (不阻塞)"""
+        if not self._count_payload:
+            return num_bytes
+        granted = self._quota.acquire(num_bytes)
+        if granted < num_bytes and not self.is_paused():
+            self._wake.set()
+        return granted
+
+    def release_quota(self, num_bytes):
+        """归还预留但未使用的配额"""
+        if not self._count_payload:
+            return
+        self._quota.release(num_bytes)
+
+    def wait_for_quota(self, num_bytes):
+        """
+        申请最多 num_bytes 字节的配额，返回值始终大于 0。
+        配额用完时唤醒控制器并阻塞，直到控制器暂停后再恢复 (例如每日重置) 后重试。
+        """
+        while True:
+            granted = self.acquire_quota(num_bytes)
+            if granted:
+                return granted
+            self.wait_until_paused(timeout=1)
+            self.wait_until_resumed()
+
+    def is_quota_exhausted(self):
+        """配额租约已分完、有进程申请被拒绝，并且其他进程手中的租约也已用完 (见 QuotaAllocator)"""
+        return self._quota.is_exhausted(self.get_bytes())
+
+    def get_quota_info(self):
+        return self._quota.info()
+
+    def throttle(self, num_bytes):
+        """按全局速率上限为 num_bytes 字节扣减令牌，必要时阻塞等待"""
+        self._rate_limiter.throttle(num_bytes)
+
+    def reserve_bandwidth(self, num_bytes):
+        """非阻塞版本的 throttle，返回调用方应等待的秒数 (供 asyncio 引擎使用)"""
+        return self._rate_limiter.reserve(num_bytes)
+
+    def get_rate_limit(self):
+        """当前全局速率上限 (字节/秒)，0 表示不限速"""
+        return self._rate_limiter.get_rate()
+
+    def set_rate_limit(self, rate_bytes):
+        self._rate_limiter.set_rate(rate_bytes)
+
+    def record_task(self, ok):
+        """按进程记录一次任务结果，供状态服务输出各工作进程的成功/失败次数"""
+        self.add_stat(f"{'tasks_ok' if ok else 'tasks_failed'}.{multiprocessing.current_process().name}")
+
+
+class SharedState(_ControlPlane):
     """
     一个用于管理所有进程共享状态的类，确保线程安全。
+    基于 multiprocessing.Manager 代理实现，每次调用都是一次到管理进程的往返。
     """
     def __init__(self, manager):
         self._manager = manager
@@ -22,8 +161,19 @@ class SharedState:
         self._last_reset_time = manager.Value('d', time.time())
         # 新增：用于存储每个进程的瞬时速度 (MB/s)
         self._process_speeds = manager.dict()
+        # 连接建立/复用等运行统计计数
+        self._stats = manager.dict()
+        self._init_control_plane()
 
     def add_bytes(self, num_bytes):
+        if not self._count_payload:
+            return
+        with self._lock:
+            self._bytes_downloaded.value += num_bytes
+        self._check_alarm(num_bytes)
+
+    def add_wire_bytes(self, num_bytes):
+        """由控制器调用：把网卡计数的增量计入下载量 (接口计量模式)"""
         with self._lock:
             self._bytes_downloaded.value += num_bytes
 
@@ -32,19 +182,21 @@ class SharedState:
             return self._bytes_downloaded.value
 
     def is_paused(self):
-        with self._lock:
-            return self._is_paused.value
+        # 读取本地事件状态，无需到 Manager 进程往返
+        return not self._running.is_set()
 
     def pause(self):
         with self._lock:
             if not self._is_paused.value:
                 self._is_paused.value = True
+                self._set_paused_events(True)
                 logger.info("执行已暂停。")
 
     def resume(self):
         with self._lock:
             if self._is_paused.value:
                 self._is_paused.value = False
+                self._set_paused_events(False)
                 logger.info("执行已恢复。")
 
     def reset(self):
@@ -54,24 +206,15 @@ class SharedState:
             self._process_speeds.clear() # 重置时也清空速度字典
             logger.info("下载量已重置。")
 
-    def save_state(self):
-        with self._lock:
-            state = {
-                'bytes_downloaded': self._bytes_downloaded.value,
-                'last_reset_time': self._last_reset_time.value
-            }
-            with open(config.STATE_FILE, 'w') as f:
-                json.dump(state, f)
-            logger.debug(f"状态已保存: {state}")
-
-    def load_state(self):
-        if os.path.exists(config.STATE_FILE):
-            with self._lock:
-                with open(config.STATE_FILE, 'r') as f:
-                    state = json.load(f)
-                    self._bytes_downloaded.value = state.get('bytes_downloaded', 0.0)
-                    self._last_reset_time.value = state.get('last_reset_time', time.time())
-                logger.info(f"状态已加载：已下载 {self._bytes_downloaded.value / (1024**3):.2f} GB，上次重置于 {datetime.fromtimestamp(self._last_reset_time.value)}")
+    def restore_state(self, bytes_downloaded, last_reset_time):
+        """用持久化层 (journal.StateJournal) 恢复的下载量和上次重置时间初始化计数"""
+        with self._lock:
+            self._bytes_downloaded.value = bytes_downloaded
+            self._last_reset_time.value = last_reset_time
+
+    def get_last_reset_time(self):
+        with self._lock:
+            return self._last_reset_time.value
 
     def update_speed(self, process_id, speed_mbps):
         with self._lock:
@@ -80,3 +223,296 @@ class SharedState:
     def get_total_speed_mbps(self):
         with self._lock:
             return sum(self._process_speeds.values())
+
+    def get_speeds(self):
+        """返回 {速度键: MB/s} 的快照"""
+        with self._lock:
+            return dict(self._process_speeds)
+
+    def get_active_count(self):
+        return len([s for s in self.get_speeds().values() if s > 0])
+
+    def get_worker_bytes(self):
+        """旧后端只维护一个总计数，不按进程统计下载量"""
+        return {}
+
+    def add_stat(self, name, value=1):
+        """累加一个运行统计计数 (例如新建连接数、连接复用数)"""
+        with self._lock:
+            self._stats[name] = self._stats.get(name, 0) + value
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+# ---- 共享内存后端 ----
+
+CACHE_LINE = 64
+SLOT_KEY_SIZE = 48
+# 每个进程平均可使用的统计计数槽数量
+STAT_SLOTS_PER_PROCESS = 8
+
+
+class _Slot(ctypes.Structure):
+    """
+    一个缓存行大小的计数槽。每个槽只由一个进程写入，写入端不需要跨进程的锁；
+    同一进程内的多个线程 (分段下载线程、连接池) 用进程内的线程锁串行化累加。
+    8 字节对齐的 double 读写在 x86-64/arm64 上是原子的，汇总端直接读取即可。
+    """
+    _fields_ = [
+        ('value', ctypes.c_double),
+        ('pid', ctypes.c_int64),
+        ('key', ctypes.c_char * SLOT_KEY_SIZE),
+    ]
+
+
+class _Header(ctypes.Structure):
+    """控制器写入的全局字段，用序列锁 (seqlock) 保证读取端拿到一致的快照。"""
+    _fields_ = [
+        ('seq', ctypes.c_uint64),
+        ('paused', ctypes.c_int64),
+        ('offset', ctypes.c_double),       # 从状态文件加载的历史下载量
+        ('base', ctypes.c_double),         # 上次重置时各槽位的总和
+        ('last_reset_time', ctypes.c_double),
+        ('_pad', ctypes.c_char * (CACHE_LINE - 40)),
+    ]
+
+
+assert ctypes.sizeof(_Slot) == CACHE_LINE
+assert ctypes.sizeof(_Header) == CACHE_LINE
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class _SlotTable:
+    """
+    匿名共享内存中的一组按键分配的槽位。
+    进程第一次使用某个键时在锁内认领槽位，之后的读写都是纯内存操作。
+    匿名映射通过 fork 继承，因此要求使用 fork 启动方式。
+    """
+    def __init__(self, buf, offset, size, lock):
+        self._slots = (_Slot * size).from_buffer(buf, offset)
+        # 以 double 数组视角访问同一块内存，汇总时按步长切片即可跳过 pid/key 字段
+        self._values = (ctypes.c_double * (size * CACHE_LINE // 8)).from_buffer(buf, offset)
+        self._size = size
+        self._lock = lock
+        self._cache = {}
+
+    def forget_local(self):
+        """fork 之后子进程需要重新认领自己的槽位"""
+        self._cache = {}
+
+    def slot(self, key):
+        """返回当前进程用于 key 的槽位，必要时认领一个。槽位耗尽时返回 None。"""
+        slot = self._cache.get(key)
+        if slot is None:
+            slot = self._claim(key)
+            if slot is not None:
+                self._cache[key] = slot
+        return slot
+
+    def _claim(self, key):
+        raw_key = str(key).encode('utf-8')[:SLOT_KEY_SIZE]
+        pid = os.getpid()
+        with self._lock:
+            free = None
+            for slot in self._slots:
+                if slot.pid == 0:
+                    if free is None:
+                        free = slot
+                elif slot.key == raw_key and (slot.pid == pid or not _pid_alive(slot.pid)):
+                    # 同名槽位的原进程已退出 (例如重启的工作进程)，继续累加即可
+                    slot.pid = pid
+                    return slot
+            if free is None:
+                logger.warning(f"共享状态槽位已用尽 ({self._size})，键 {key} 的数据将被丢弃。")
+                return None
+            free.key = raw_key
+            free.value = 0.0
+            free.pid = pid
+            return free
+
+    def total(self):
+        # 未认领槽位的值恒为 0，可以直接求和
+        return sum(self._values[::CACHE_LINE // 8])
+
+    def items(self):
+        """按键汇总各槽位的值 (不同进程可能各自持有同名键的槽位)"""
+        result = {}
+        for slot in self._slots:
+            if slot.pid:
+                key = slot.key.decode('utf-8', 'replace')
+                result[key] = result.get(key, 0.0) + slot.value
+        return result
+
+    def clear_values(self):
+        for slot in self._slots:
+            slot.value = 0.0
+
+
+class ShmSharedState(_ControlPlane):
+    """
+    基于匿名共享内存的 SharedState 后端，公开方法与 SharedState 完全一致。
+
+    - 每个工作进程拥有一个缓存行对齐的字节计数槽，add_bytes 只写自己的槽，不经过任何 IPC 或跨进程锁。
+    - 每个速度键 (process_id) 拥有一个速度槽，update_speed 同样是单写者的内存写入。
+    - 暂停标志、重置基线等控制字段由控制器在锁内写入，读取端通过序列锁获取一致快照。
+    """
+    def __init__(self, num_slots=None):
+        num_slots = num_slots or config.STATE_SLOTS
+        self._num_slots = num_slots
+        num_stat_slots = num_slots * STAT_SLOTS_PER_PROCESS
+        size = CACHE_LINE * (1 + 2 * num_slots + num_stat_slots)
+        self._buf = mmap.mmap(-1, size)
+        self._lock = multiprocessing.Lock()
+        self._header = _Header.from_buffer(self._buf, 0)
+        self._header.last_reset_time = time.time()
+        self._byte_slots = _SlotTable(self._buf, CACHE_LINE, num_slots, self._lock)
+        self._speed_slots = _SlotTable(self._buf, CACHE_LINE * (1 + num_slots), num_slots, self._lock)
+        self._stat_slots = _SlotTable(self._buf, CACHE_LINE * (1 + 2 * num_slots), num_stat_slots, self._lock)
+        self._byte_slot = None
+        # 保护本进程槽位的 "读-改-写" 累加，不跨进程
+        self._local_lock = threading.Lock()
+        self._init_control_plane()
+
+        ref = weakref.ref(self)
+        def _after_fork():
+            state = ref()
+            if state is not None:
+                state._forget_local()
+        os.register_at_fork(after_in_child=_after_fork)
+
+    def _forget_local(self):
+        self._byte_slot = None
+        self._local_lock = threading.Lock()
+        self._byte_slots.forget_local()
+        self._speed_slots.forget_local()
+        self._stat_slots.forget_local()
+
+    # -- 序列锁 --
+
+    def _write_header(self, **fields):
+        """调用方必须持有 self._lock"""
+        h = self._header
+        h.seq += 1
+        for name, value in fields.items():
+            setattr(h, name, value)
+        h.seq += 1
+
+    def _read_header(self):
+        h = self._header
+        while True:
+            seq = h.seq
+            if seq & 1:
+                continue
+            snapshot = (h.offset, h.base, h.last_reset_time)
+            if h.seq == seq:
+                return snapshot
+
+    # -- 热路径 --
+
+    def add_bytes(self, num_bytes):
+        if not self._count_payload:
+            return
+        slot = self._byte_slot
+        if slot is None:
+            slot = self._byte_slot = self._byte_slots.slot(multiprocessing.current_process().name)
+            if slot is None:
+                return
+        with self._local_lock:
+            slot.value += num_bytes
+        self._check_alarm(num_bytes)
+
+    def is_paused(self):
+        return bool(self._header.paused)
+
+    def update_speed(self, process_id, speed_mbps):
+        slot = self._speed_slots.slot(process_id)
+        if slot is not None:
+            slot.value = speed_mbps
+
+    # -- 控制器 --
+
+    def get_bytes(self):
+        offset, base, _ = self._read_header()
+        return offset + self._byte_slots.total() - base
+
+    def add_wire_bytes(self, num_bytes):
+        """由控制器调用：把网卡计数的增量计入下载量 (接口计量模式)，不占用工作进程的计数槽"""
+        with self._lock:
+            offset, _, _ = self._read_header()
+            self._write_header(offset=offset + num_bytes)
+
+    def pause(self):
+        with self._lock:
+            if not self._header.paused:
+                self._write_header(paused=1)
+                self._set_paused_events(True)
+                logger.info("执行已暂停。")
+
+    def resume(self):
+        with self._lock:
+            if self._header.paused:
+                self._write_header(paused=0)
+                self._set_paused_events(False)
+                logger.info("执行已恢复。")
+
+    def reset(self):
+        with self._lock:
+            self._write_header(offset=0.0, base=self._byte_slots.total(), last_reset_time=time.time())
+            self._speed_slots.clear_values() # 重置时也清空速度
+            logger.info("下载量已重置。")
+
+    def restore_state(self, bytes_downloaded, last_reset_time):
+        """用持久化层 (journal.StateJournal) 恢复的下载量和上次重置时间初始化计数"""
+        with self._lock:
+            self._write_header(
+                offset=bytes_downloaded,
+                base=self._byte_slots.total(),
+                last_reset_time=last_reset_time,
+            )
+
+    def get_last_reset_time(self):
+        return self._read_header()[2]
+
+    def get_total_speed_mbps(self):
+        return self._speed_slots.total()
+
+    def get_speeds(self):
+        """返回 {速度键: MB/s} 的快照"""
+        return self._speed_slots.items()
+
+    def get_active_count(self):
+        return len([s for s in self.get_speeds().values() if s > 0])
+
+    def get_worker_bytes(self):
+        """返回 {进程名: 累计下载字节数}，计数从程序启动起单调递增，不随每日重置清零"""
+        return self._byte_slots.items()
+
+    def add_stat(self, name, value=1):
+        """累加一个运行统计计数 (例如新建连接数、连接复用数)"""
+        slot = self._stat_slots.slot(name)
+        if slot is not None:
+            with self._local_lock:
+                slot.value += value
+
+    def get_stats(self):
+        return self._stat_slots.items()
+
+
+def create_shared_state():
+    """根据 config.SHARED_STATE_BACKEND 创建共享状态对象"""
+    if config.SHARED_STATE_BACKEND == 'manager':
+        return SharedState(multiprocessing.Manager())
+    # asyncio 引擎下每个流都有自己的速度键，保证槽位足够
+    streams = config.MAX_WORKERS * max(1, config.STREAMS_PER_PROCESS)
+    return ShmSharedState(max(config.STATE_SLOTS, streams + 8))
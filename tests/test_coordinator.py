@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import coordinator
+from coordinator import CoordinatorServer, CoordinatorClient
+
+MB = 1024 * 1024
+
+
+class _Clock:
+    """同时替代协调服务的 time.time() 和节点端的 time.monotonic()"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+class _Node:
+    """节点端用到的 SharedState 方法"""
+    def __init__(self):
+        self.used = 0.0
+        self.notified = 0
+
+    def get_bytes(self):
+        return self.used
+
+    def get_last_reset_time(self):
+        return 0.0
+
+    def notify_controller(self):
+        self.notified += 1
+
+
+class PartitionTest(unittest.TestCase):
+    LIMIT = 1000 * MB
+    LEASE = 400 * MB
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.clock = _Clock()
+        patcher = mock.patch.object(coordinator, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        request = mock.patch.object(coordinator, '_request', self._request)
+        request.start()
+        self.addCleanup(request.stop)
+
+        self.server = CoordinatorServer(self.LIMIT, state_file=os.path.join(self._dir.name, 'state.json'),
+                                        node_timeout=60)
+        self.partitioned = set()
+        self.nodes = {name: _Node() for name in ('a', 'b')}
+        self.clients = {name: CoordinatorClient(state, url='http://coordinator', node=name,
+                                                lease_bytes=self.LEASE, sync_interval=5, timeout=30,
+                                                fallback_bytes=0)
+                        for name, state in self.nodes.items()}
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _request(self, url, path, body=None, timeout=None):
+        if body['node'] in self.partitioned:
+            raise OSError("网络不可达")
+        return self.server.sync(body['node'], body['used'], body['reset'], body['want'])
+
+    def _limits(self):
+        return {name: client.limit_bytes(float('inf')) for name, client in self.clients.items()}
+
+    def _spend(self, name):
+        """节点把当前上限内的配额全部用完"""
+        self.nodes[name].used = max(self.nodes[name].used, self._limits()[name])
+
+    def test_partitioned_lease_is_not_spent_twice(self):
+        for client in self.clients.values():
+            self.assertTrue(client._sync())
+        self.assertEqual(self._limits(), {'a': self.LEASE, 'b': self.LEASE})
+
+        # 节点 a 失联后继续用掉部分租约，这部分用量协调服务并不知道
+        self.partitioned.add('a')
+        self.nodes['a'].used = 300 * MB
+        for _ in range(20):
+            self.clock.now += 5
+            self.clients['a']._step()
+            self._spend('b')
+            self.clients['b']._step()
+            limits = self._limits()
+            self.assertLessEqual(sum(limits.values()), self.LIMIT)
+            self.assertLessEqual(self.nodes['a'].used + self.nodes['b'].used, self.LIMIT)
+
+        # 超过节点超时后，失联节点只保留最后一次同步时的用量
+        self.assertTrue(self.clients['a'].is_degraded())
+        self.assertEqual(self._limits()['a'], 0.0)
+        self.assertEqual(self._limits()['b'], self.LIMIT - self.LEASE)
+
+        # 恢复联系后按实际用量结算，全局总量仍不超过上限
+        self.partitioned.clear()
+        self.assertTrue(self.clients['a']._sync())
+        self.assertFalse(self.clients['a'].is_degraded())
+        self.assertEqual(self._limits()['a'], self.LEASE)
+        self._spend('a')
+        self._spend('b')
+        self.assertLessEqual(self.nodes['a'].used + self.nodes['b'].used, self.LIMIT)
+
+    def test_lease_expires_before_server_timeout(self):
+        client = self.clients['a']
+        self.assertTrue(client._sync())
+        self.partitioned.add('a')
+        self.clock.now += 60 - coordinator.LEASE_EXPIRY_MARGIN - 0.1
+        client._step()
+        self.assertEqual(client.limit_bytes(float('inf')), self.LEASE)
+        self.clock.now += 0.1
+        self.assertEqual(client.limit_bytes(float('inf')), 0.0)
+        client._step()
+        self.assertTrue(client.is_degraded())
+
+    def test_fallback_is_added_to_last_synced_usage(self):
+        client = CoordinatorClient(self.nodes['a'], url='http://coordinator', node='a', lease_bytes=self.LEASE,
+                                   sync_interval=5, timeout=30, fallback_bytes=50 * MB)
+        self.nodes['a'].used = 100 * MB
+        self.assertTrue(client._sync())
+        self.partitioned.add('a')
+        self.clock.now += 31
+        client._step()
+        self.assertEqual(client.limit_bytes(float('inf')), 100 * MB + self.LEASE + 50 * MB)
+        self.clock.now += 60
+        client._step()
+        self.assertEqual(client.limit_bytes(float('inf')), 100 * MB + 50 * MB)
+
+
+if __name__ == '__main__':
+    unittest.main()
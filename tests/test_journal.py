@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from journal import StateJournal
+
+
+class TornTailTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.checkpoint_path = os.path.join(self._dir.name, 'state.json')
+        self.journal_path = os.path.join(self._dir.name, 'state.journal')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _journal(self):
+        return StateJournal(self.checkpoint_path, self.journal_path, checkpoint_interval=3600)
+
+    def test_append_after_torn_tail_survives_recovery(self):
+        journal = self._journal()
+        journal.recover()
+        journal.record(0)
+        journal.record(100)
+        journal.record(300)
+        journal.close()
+        # 崩溃时写了一半的记录
+        with open(self.journal_path, 'ab') as f:
+            f.write(b'{"t":1700000000.0,"d":5')
+
+        journal = self._journal()
+        total, _ = journal.recover()
+        self.assertEqual(total, 300)
+        journal.record(0)
+        journal.record(1000)
+        journal.close()
+
+        total, _ = self._journal().recover()
+        self.assertEqual(total, 1300)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+import multiprocessing
+
+from quota import QuotaAllocator
+
+MB = 1024 * 1024
+CHUNK = MB
+
+_fork = multiprocessing.get_context('fork')
+
+
+def _consume(quota, used, start):
+    """
+    模拟工作进程：每次预留一块配额再 "下载"；被拒绝时等待后重试 (同 wait_for_quota)，
+    直到控制器按 is_exhausted() 暂停下载
+    """
+    start.wait()
+    while not quota.is_exhausted(used.value):
+        granted = quota.acquire(CHUNK)
+        if not granted:
+            time.sleep(0.01)
+            continue
+        with used.get_lock():
+            used.value += granted
+        time.sleep(0.001)
+
+
+class LeaseTest(unittest.TestCase):
+    def test_leases_shrink_near_the_limit(self):
+        quota = QuotaAllocator(consumers=4, lease_bytes=8 * MB, min_lease_bytes=64 * 1024)
+        quota.set_quota(100 * MB)
+        self.assertEqual(quota.acquire(CHUNK), CHUNK)
+        # 第一块租约为完整大小，本地还剩 7 MB
+        self.assertEqual(quota.info()['granted'], 8 * MB)
+        quota.set_quota(100 * MB, used_bytes=99 * MB)
+        self.assertEqual(quota.acquire(CHUNK), CHUNK)
+        self.assertEqual(quota.info()['granted'], 100 * MB)
+        self.assertEqual(quota.acquire(CHUNK), 0)
+
+    def test_set_quota_voids_local_leases(self):
+        quota = QuotaAllocator(consumers=1, lease_bytes=8 * MB, min_lease_bytes=64 * 1024)
+        quota.set_quota(100 * MB)
+        quota.acquire(CHUNK)
+        quota.set_quota(CHUNK // 2)
+        self.assertEqual(quota.acquire(CHUNK), CHUNK // 2)
+        self.assertTrue(quota.is_exhausted())
+
+    def test_release_returns_bytes_to_the_local_lease(self):
+        quota = QuotaAllocator(consumers=1, lease_bytes=2 * MB, min_lease_bytes=64 * 1024)
+        quota.set_quota(2 * MB)
+        self.assertEqual(quota.acquire(2 * MB), 2 * MB)
+        quota.release(MB)
+        self.assertEqual(quota.acquire(2 * MB), MB)
+        self.assertEqual(quota.info()['granted'], 2 * MB)
+
+
+class DrainTest(unittest.TestCase):
+    def test_not_exhausted_while_other_leases_are_unspent(self):
+        quota = QuotaAllocator(consumers=2, lease_bytes=8 * MB, min_lease_bytes=64 * 1024,
+                               drain_slack=CHUNK, drain_timeout=60)
+        quota.set_quota(10 * MB)
+        holder_ready, spend = _fork.Event(), _fork.Event()
+
+        def hold():
+            quota.acquire(CHUNK)       # 申领一块租约 (2.5 MB)，只用掉 1 MB
+            holder_ready.set()
+            spend.wait()
+
+        holder = _fork.Process(target=hold)
+        holder.start()
+        self.addCleanup(holder.join)
+        self.addCleanup(spend.set)
+        self.assertTrue(holder_ready.wait(10))
+
+        used = CHUNK
+        while True:
+            granted = quota.acquire(CHUNK)
+            if not granted:
+                break
+            used += granted
+        # 配额已分完，但另一个进程还有 1.5 MB 没用
+        self.assertEqual(quota.info()['granted'], 10 * MB)
+        self.assertEqual(used, 10 * MB - 1.5 * MB)
+        self.assertTrue(quota.is_exhausted())
+        self.assertFalse(quota.is_exhausted(used))
+        self.assertTrue(quota.is_exhausted(used + 0.5 * MB))
+
+    def test_drain_timeout(self):
+        quota = QuotaAllocator(consumers=2, lease_bytes=8 * MB, min_lease_bytes=64 * 1024,
+                               drain_slack=CHUNK, drain_timeout=0.05)
+        quota.set_quota(4 * MB)
+        quota.acquire(8 * MB)
+        self.assertFalse(quota.is_exhausted(0))
+        time.sleep(0.1)
+        self.assertTrue(quota.is_exhausted(0))
+
+    def test_processes_spend_the_whole_limit(self):
+        limit = 50 * MB + 12345
+        consumers = 4
+        quota = QuotaAllocator(consumers=consumers, lease_bytes=4 * MB, min_lease_bytes=64 * 1024,
+                               drain_slack=CHUNK, drain_timeout=60)
+        quota.set_quota(limit)
+        used = _fork.Value('d', 0.0)
+        start = _fork.Event()
+        workers = [_fork.Process(target=_consume, args=(quota, used, start)) for _ in range(consumers)]
+        for worker in workers:
+            worker.start()
+        start.set()
+        for worker in workers:
+            worker.join(30)
+            self.assertEqual(worker.exitcode, 0)
+
+        self.assertLessEqual(used.value, limit)
+        self.assertGreaterEqual(used.value, limit - CHUNK)
+        self.assertTrue(quota.is_exhausted(used.value))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import threading
+import unittest
+from unittest import mock
+
+from bench import mock_libtorrent
+mock_libtorrent.install()
+
+from downloader import raw_http_downloader
+from downloader.raw_http_downloader import _DiscardConnection, RawHTTPError
+from downloader.connection_pool import ConnectionPool
+
+
+class _Stats:
+    """_request 用到的 SharedState 方法"""
+    def __init__(self):
+        self.stats = {}
+
+    def add_stat(self, name, value=1):
+        self.stats[name] = self.stats.get(name, 0) + value
+
+
+def _connection(payload, buffer_size):
+    """返回一条对端已写入 payload 并关闭写端的连接"""
+    ours, theirs = socket.socketpair()
+    theirs.sendall(payload)
+    theirs.shutdown(socket.SHUT_WR)
+    conn = _DiscardConnection(ours, buffer_size=buffer_size)
+    # 缩小缓冲区，让响应体跨越多次接收
+    conn.buf = bytearray(buffer_size)
+    conn.view = memoryview(conn.buf)
+    return conn, theirs
+
+
+class BodyParserTest(unittest.TestCase):
+    def _read(self, payload, buffer_size=64):
+        conn, peer = _connection(payload, buffer_size)
+        self.addCleanup(peer.close)
+        self.addCleanup(conn.close)
+        status, headers = conn.read_head()
+        body = sum(conn.iter_body(headers))
+        return status, headers, body, conn
+
+    def test_content_length(self):
+        status, headers, body, conn = self._read(
+            b'HTTP/1.1 200 OK\r\nContent-Length: 300\r\n\r\n' + b'x' * 300 + b'HTTP/1.1 204')
+        self.assertEqual((status, body), (200, 300))
+        # 不多读下一个响应的数据
+        self.assertEqual(conn._read_until(b'204'), b'HTTP/1.1 204')
+
+    def test_chunked_with_extensions_and_trailer(self):
+        payload = (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                   b'a;name=value\r\n' + b'x' * 10 + b'\r\n'
+                   b'64\r\n' + b'y' * 100 + b'\r\n'
+                   b'0\r\nX-Checksum: abc\r\n\r\n'
+                   b'NEXT')
+        _, _, body, conn = self._read(payload)
+        self.assertEqual(body, 110)
+        self.assertEqual(conn._read_until(b'NEXT'), b'NEXT')
+
+    def test_read_until_close(self):
+        _, _, body, _ = self._read(b'HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n' + b'z' * 1000)
+        self.assertEqual(body, 1000)
+
+    def test_truncated_content_length(self):
+        with self.assertRaises(RawHTTPError):
+            self._read(b'HTTP/1.1 200 OK\r\nContent-Length: 300\r\n\r\n' + b'x' * 299)
+
+    def test_invalid_chunk_size(self):
+        with self.assertRaises(RawHTTPError):
+            self._read(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n')
+
+
+class _Server:
+    """
+    本地 HTTP 服务：每条连接上按顺序处理 responses 中的动作，
+    None 表示读到请求后不回复直接关闭 (模拟服务器悄悄关闭的长连接)
+    """
+    RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello'
+
+    def __init__(self, plans):
+        self._plans = list(plans)
+        self._listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self._listener.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        for plan in self._plans:
+            sock, _ = self._listener.accept()
+            with sock:
+                for response in plan:
+                    request = b''
+                    while not request.endswith(b'\r\n\r\n'):
+                        data = sock.recv(4096)
+                        if not data:
+                            return
+                        request += data
+                    if response is None:
+                        break
+                    sock.sendall(response)
+
+    def close(self):
+        self._listener.close()
+
+
+class ConnectionReuseTest(unittest.TestCase):
+    def setUp(self):
+        pool = ConnectionPool(max_per_host=4, idle_timeout=60, dns_ttl=60, tls_resumption=False)
+        patcher = mock.patch.object(raw_http_downloader, 'get_pool', lambda: pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(pool.clear)
+        self.state = _Stats()
+
+    def _fetch(self, url):
+        conn, key, status, headers = raw_http_downloader._request(url, self.state)
+        self.assertEqual((status, sum(conn.iter_body(headers))), (200, 5))
+        raw_http_downloader.get_pool().release(key, conn)
+
+    def test_reuse_counted_after_response(self):
+        server = _Server([[_Server.RESPONSE, _Server.RESPONSE]])
+        self.addCleanup(server.close)
+        url = f'http://127.0.0.1:{server.port}/file'
+        self._fetch(url)
+        self._fetch(url)
+        self.assertEqual(self.state.stats, {'dns_lookups': 1, 'conn_created': 1, 'conn_reused': 1})
+
+    def test_stale_connection_is_not_counted_as_reused(self):
+        # 第一条连接在第二个请求到达时被服务器关闭，换新连接重试
+        server = _Server([[_Server.RESPONSE, None], [_Server.RESPONSE]])
+        self.addCleanup(server.close)
+        url = f'http://127.0.0.1:{server.port}/file'
+        self._fetch(url)
+        self._fetch(url)
+        self.assertEqual(self.state.stats.get('conn_reused', 0), 0)
+        self.assertEqual(self.state.stats['conn_created'], 2)
+        self.assertEqual(self.state.stats['conn_expired'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
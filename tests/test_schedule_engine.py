@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from datetime import datetime
+
+import config
+from schedule_engine import Schedule
+
+MBPS = 1024 * 1024 / 8
+
+
+def _at(day, hour, minute=0):
+    """2024-01-08 是周一；day 为相对该周一的天数"""
+    return datetime(2024, 1, 8 + day, hour, minute)
+
+
+class MidnightWrapTest(unittest.TestCase):
+    def setUp(self):
+        self.schedule = Schedule(config.parse_time_windows("22:00-02:00"))
+
+    def test_window_spans_midnight(self):
+        self.assertFalse(self.schedule.is_allowed(_at(0, 21, 59)))
+        self.assertTrue(self.schedule.is_allowed(_at(0, 22)))
+        self.assertTrue(self.schedule.is_allowed(_at(1, 0)))
+        self.assertTrue(self.schedule.is_allowed(_at(1, 1, 59)))
+        self.assertFalse(self.schedule.is_allowed(_at(1, 2)))
+
+    def test_transitions_cross_midnight(self):
+        self.assertEqual(self.schedule.next_transition(_at(0, 23)), _at(1, 2))
+        self.assertEqual(self.schedule.next_allowed_start(_at(1, 3)), _at(1, 22))
+        self.assertEqual(self.schedule.allowed_seconds(_at(0, 21), _at(1, 3)), 4 * 3600)
+
+    def test_pacing_spreads_over_window_across_reset(self):
+        # 每日 00:00 重置：22:00 时距离重置只剩 2 小时的允许时间
+        self.assertAlmostEqual(self.schedule.pacing_rate(7200, _at(0, 22)), 1.0)
+        self.assertAlmostEqual(self.schedule.pacing_rate(7200, _at(0, 23)), 2.0)
+        # 01:00 时下次重置前还有 01:00-02:00 和当天 22:00-24:00 共三小时
+        self.assertAlmostEqual(self.schedule.pacing_rate(10800, _at(1, 1)), 1.0)
+
+
+class WeekWrapTest(unittest.TestCase):
+    def setUp(self):
+        self.schedule = Schedule(config.parse_time_windows("sun 22:00-02:00@100,mon-fri 08:00-09:00"))
+
+    def test_sunday_window_continues_into_monday(self):
+        self.assertTrue(self.schedule.is_allowed(_at(6, 23)))
+        self.assertTrue(self.schedule.is_allowed(_at(0, 1)))
+        self.assertTrue(self.schedule.is_allowed(_at(7, 1)))
+        self.assertFalse(self.schedule.is_allowed(_at(0, 2)))
+        self.assertFalse(self.schedule.is_allowed(_at(5, 23)))
+        self.assertEqual(self.schedule.rate_target(_at(0, 1)), 100 * MBPS)
+        self.assertIsNone(self.schedule.rate_target(_at(0, 8, 30)))
+
+    def test_next_boundaries_cross_the_week(self):
+        self.assertEqual(self.schedule.next_transition(_at(6, 23)), _at(7, 2))
+        self.assertEqual(self.schedule.next_allowed_start(_at(4, 10)), _at(6, 22))
+        self.assertEqual(self.schedule.next_allowed_start(_at(6, 21)), _at(6, 22))
+        self.assertEqual(self.schedule.allowed_seconds(_at(6, 20), _at(7, 10)), 5 * 3600)
+
+
+class OverlapTest(unittest.TestCase):
+    def test_unlimited_window_wins_over_rate_target(self):
+        schedule = Schedule(config.parse_time_windows("23:00-01:00@50,00:00-00:30"))
+        self.assertEqual(schedule.rate_target(_at(0, 23, 30)), 50 * MBPS)
+        self.assertEqual(schedule.state(_at(1, 0, 15)), (True, None))
+        self.assertEqual(schedule.rate_target(_at(1, 0, 45)), 50 * MBPS)
+        self.assertFalse(schedule.is_allowed(_at(1, 1)))
+
+    def test_all_day_schedule_has_no_transitions(self):
+        schedule = Schedule(config.parse_time_windows(""))
+        self.assertTrue(schedule.is_allowed(_at(3, 12)))
+        self.assertIsNone(schedule.next_transition(_at(3, 12)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+import multiprocessing
+from unittest import mock
+
+from bench import mock_libtorrent
+mock_libtorrent.install()
+
+import scheduler
+from scheduler import TaskScheduler
+from downloader import DownloadResult
+
+_fork = multiprocessing.get_context('fork')
+
+TASKS = [('http', 'http://a.example/1'), ('http', 'http://a.example/2'), ('http', 'http://b.example/1')]
+FAILED = DownloadResult(False, 0, 1.0)
+OK = DownloadResult(True, 1000, 1.0)
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def _choose_and_exit(sched, chosen):
+    """模拟任务执行中崩溃的工作进程：登记任务后不调用 finish() 就退出"""
+    chosen.value = sched.choose()
+    os._exit(0)
+
+
+class ClaimTest(unittest.TestCase):
+    def test_release_process_frees_a_crashed_workers_claims(self):
+        sched = TaskScheduler(TASKS, max_per_host=1, explore=0)
+        chosen = _fork.Value('i', -1)
+        worker = _fork.Process(target=_choose_and_exit, args=(sched, chosen))
+        worker.start()
+        worker.join(10)
+        index = chosen.value
+        self.assertEqual(sched.snapshot()[TASKS[index][1]]['active'], 1)
+
+        self.assertEqual(sched.release_process(worker.pid), 1)
+        self.assertEqual(sched.snapshot()[TASKS[index][1]]['active'], 0)
+        self.assertEqual(sched.release_process(worker.pid), 0)
+
+    def test_finish_releases_only_its_own_claim(self):
+        sched = TaskScheduler(TASKS, max_per_host=0, explore=0)
+        first = sched.choose(exclude={1, 2})
+        second = sched.choose(exclude={1, 2})
+        self.assertEqual((first, second), (0, 0))
+        sched.finish(first, OK)
+        self.assertEqual(sched.snapshot()[TASKS[0][1]]['active'], 1)
+        self.assertEqual(sched.release_process(os.getpid()), 1)
+        self.assertEqual(sched.snapshot()[TASKS[0][1]]['active'], 0)
+
+    def test_per_host_limit(self):
+        sched = TaskScheduler(TASKS, max_per_host=1, explore=0)
+        chosen = {sched.choose(), sched.choose()}
+        self.assertEqual({TASKS[i][1].split('/')[2] for i in chosen}, {'a.example', 'b.example'})
+        self.assertIsNone(sched.choose())
+
+    def test_claims_table_sized_from_concurrency(self):
+        with mock.patch.object(scheduler.config, 'MAX_WORKERS', 2), \
+             mock.patch.object(scheduler.config, 'STREAMS_PER_PROCESS', 3), \
+             mock.patch.object(scheduler.config, 'TORRENT_MAX_ACTIVE', 4):
+            sched = TaskScheduler(TASKS, max_per_host=0)
+        self.assertEqual(len(sched._claims), 2 * 3 + 4 + scheduler.CLAIM_HEADROOM)
+
+    def test_full_claims_table_still_counts_active(self):
+        with mock.patch.object(scheduler, '_max_claims', lambda: 1):
+            sched = TaskScheduler(TASKS, max_per_host=0, explore=0)
+        with self.assertLogs(scheduler.logger, 'WARNING'):
+            for _ in range(2):
+                sched.choose(exclude={1, 2})
+        self.assertEqual(sched.snapshot()[TASKS[0][1]]['active'], 2)
+        # 只有登记过的那一个能在进程退出时释放
+        self.assertEqual(sched.release_process(os.getpid()), 1)
+
+
+class BackoffTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        patcher = mock.patch.object(scheduler, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sched = TaskScheduler(TASKS[:1], max_per_host=0, backoff_base=10, backoff_max=60, explore=0)
+
+    def _fail(self):
+        index = self.sched.choose()
+        self.assertEqual(index, 0)
+        with self.assertLogs(scheduler.logger, 'INFO'):
+            self.sched.finish(index, FAILED)
+        return self.sched.snapshot()[TASKS[0][1]]['backoff_until'] - self.clock.now
+
+    def test_backoff_doubles_and_is_capped(self):
+        delays = []
+        for _ in range(5):
+            delays.append(self._fail())
+            self.assertIsNone(self.sched.choose())
+            self.clock.now += delays[-1]
+        self.assertEqual(delays, [10, 20, 40, 60, 60])
+
+    def test_success_clears_backoff(self):
+        self._fail()
+        self.clock.now += 10
+        self.sched.finish(self.sched.choose(), OK)
+        entry = self.sched.snapshot()[TASKS[0][1]]
+        self.assertEqual((entry['consecutive_failures'], entry['backoff_until']), (0, 0.0))
+        self.assertEqual(self._fail(), 10)
+
+    def test_zero_byte_success_counts_as_failure(self):
+        index = self.sched.choose()
+        with self.assertLogs(scheduler.logger, 'INFO'):
+            self.sched.finish(index, DownloadResult(True, 0, 1.0))
+        self.assertIsNone(self.sched.choose())
+
+    def test_retry_delay_is_bounded(self):
+        self._fail()
+        self.assertEqual(self.sched.retry_delay(), scheduler.MAX_RETRY_DELAY)
+        self.clock.now += 9.9
+        self.assertEqual(self.sched.retry_delay(), scheduler.MIN_RETRY_DELAY)
+        self.clock.now -= 2
+        self.assertAlmostEqual(self.sched.retry_delay(), 2.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+import multiprocessing
+
+from shared_state import ShmSharedState
+
+_fork = multiprocessing.get_context('fork')
+
+THREADS = 8
+ADDS = 20000
+
+
+def _hammer(state, name):
+    """多个线程同时累加同一个统计键 (同分段下载线程和连接池)"""
+    threads = [threading.Thread(target=lambda: [state.add_stat(name) for _ in range(ADDS)])
+               for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class StatTest(unittest.TestCase):
+    def test_concurrent_add_stat_loses_no_updates(self):
+        state = ShmSharedState(num_slots=4)
+        workers = [_fork.Process(target=_hammer, args=(state, 'conn_reused')) for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        _hammer(state, 'conn_reused')
+        for worker in workers:
+            worker.join(30)
+            self.assertEqual(worker.exitcode, 0)
+        self.assertEqual(state.get_stats()['conn_reused'], 3 * THREADS * ADDS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,56 +1,42 @@
 # -*- coding: utf-8 -*-
 
 import logging
-from datetime import datetime, time as dt_time, timedelta
+from datetime import datetime, timedelta
 
-import config
+from schedule_engine import get_schedule
 
 logger = logging.getLogger(__name__)
 
-def is_in_time_window():
+def is_in_time_window(now=None):
     """检查当前时间是否在允许的下载时间窗口内"""
-    now = datetime.now().time()
-    for start_str, end_str in config.ALLOWED_TIME_WINDOWS:
-        start_time = dt_time.fromisoformat(start_str)
-        end_time = dt_time.fromisoformat(end_str)
-        if start_time <= end_time:
-            if start_time <= now < end_time:
-                return True
-        else:  # 跨天的时间段
-            if now >= start_time or now < end_time:
-                return True
-    return False
-
-def get_next_allowed_time_start():
+    return get_schedule().is_allowed(now)
+
+def get_next_allowed_time_start(now=None):
     """
     计算下一个允许下载时间窗口的开始时间。
     """
-    now = datetime.now()
-    next_starts = []
-
-    for start_str, _ in config.ALLOWED_TIME_WINDOWS:
-        start_time_obj = dt_time.fromisoformat(start_str)
-        
-        # 尝试今天的开始时间
-        today_start = now.replace(
-            hour=start_time_obj.hour,
-            minute=start_time_obj.minute,
-            second=0, microsecond=0
-        )
-        if today_start > now:
-            next_starts.append(today_start)
-        
-        # 尝试明天的开始时间 (如果今天的已经过了)
-        tomorrow_start = (now + timedelta(days=1)).replace(
-            hour=start_time_obj.hour,
-            minute=start_time_obj.minute,
-            second=0, microsecond=0
-        )
-        next_starts.append(tomorrow_start)
-    
-    if not next_starts:
+    now = now or datetime.now()
+    next_start = get_schedule().next_allowed_start(now)
+    if next_start is None:
         # 如果没有配置时间窗口，或者解析失败，默认明天凌晨开始
         logger.warning("未配置有效的时间窗口。默认将在明天 00:00 恢复。")
         return (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return next_start
+
+def get_next_window_transition(now=None):
+    """
+    计算下一个时间窗口边界 (允许状态或速率目标发生变化的时间)，控制器据此设置唤醒定时器。
+    """
+    now = now or datetime.now()
+    transition = get_schedule().next_transition(now)
+    if transition is None:
+        return (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return transition
+
+def get_next_reset_time(now=None):
+    """计算下一次每日重置的时间点"""
+    return get_schedule().next_reset(now)
 
-    return min(next_starts)
+def get_previous_reset_time(now=None):
+    """计算最近一次已经到达的每日重置时间点"""
+    return get_schedule().previous_reset(now)